@@ -0,0 +1,174 @@
+"""Generate a synthetic collection, named as conf_fb.py expects
+
+    python -m bench.collection TARGET [--assets N] [--depth D] ...
+
+Preservation copies (.tif) go under Preservica_preservation, access
+copies (.jpg) under Preservica_access, each in nested folders named after
+their parent's id, e.g. Preservica_access/FB-1/FB-1-2/FB-1-2-001.jpg.
+Assets with both copies become paxes. Generation is seeded, so the same
+settings always give the same collection."""
+import os
+import math
+import random
+import hashlib
+import argparse
+from dataclasses import dataclass, asdict
+
+PRESERVATION = 'Preservica_preservation'
+ACCESS = 'Preservica_access'
+
+BLOCK_SIZE = 64 * 1024
+SUFFIXES = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def parse_size(value):
+    """Parse a size like 4096, 64K or 2M into bytes"""
+    value = value.strip().upper()
+    if value[-1:] in SUFFIXES:
+        return int(float(value[:-1]) * SUFFIXES[value[-1]])
+    return int(value)
+
+
+@dataclass
+class CollectionSpec:
+    assets: int = 1000
+    depth: int = 2               # numeric parts in parent ids, and folder levels
+    per_folder: int = 50         # assets in each leaf folder
+    access: float = 0.5          # fraction of assets with an access copy (so a pax)
+    access_only: float = 0.0     # fraction with only an access copy
+    min_size: int = 4 * 2**10
+    max_size: int = 64 * 2**10
+    md5: float = 0.5             # fraction of files with a .md5 sidecar
+    seed: int = 1
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def parent_ids(spec):
+    """Parent ids for each leaf folder, e.g. [1, 2] for FB-1-2"""
+    folders = max(1, math.ceil(spec.assets / spec.per_folder))
+    fanout = max(1, math.ceil(folders ** (1 / spec.depth)))
+
+    for n in range(folders):
+        digits = []
+        for _ in range(spec.depth):
+            n, digit = divmod(n, fanout)
+            digits.append(digit + 1)
+        yield list(reversed(digits))
+
+
+def write_file(path, size, rng, filler, md5_sidecar):
+    # A random start, so files differ and samples don't compress, then
+    # shared filler so big collections are quick to make
+    head = rng.randbytes(min(size, BLOCK_SIZE))
+    hasher = hashlib.md5(head)
+
+    with open(path, 'wb') as f:
+        f.write(head)
+        remaining = size - len(head)
+        while remaining > 0:
+            chunk = filler[:remaining]
+            f.write(chunk)
+            hasher.update(chunk)
+            remaining -= len(chunk)
+
+    if md5_sidecar:
+        base, _, _ = path.rpartition('.')
+        with open(base + '.md5', 'w') as f:
+            f.write(hasher.hexdigest())
+
+
+def generate(target, spec=CollectionSpec()):
+    """Write a collection into target, returning counts of what was made"""
+    rng = random.Random(spec.seed)
+    filler = rng.randbytes(BLOCK_SIZE)
+    counts = {'assets': 0, 'files': 0, 'bytes': 0, 'paxes': 0, 'md5': 0}
+
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, 'README.txt'), 'w') as f:
+        f.write(f"Synthetic collection: {spec.as_dict()}\n")  # ignored by conf_fb
+
+    parents = parent_ids(spec)
+    for number in range(spec.assets):
+        if number % spec.per_folder == 0:
+            parent = next(parents)
+            folders = ['FB-' + '-'.join(map(str, parent[:level + 1]))
+                       for level in range(len(parent))]
+
+        asset = f"{folders[-1]}-{number % spec.per_folder + 1:03d}"
+        roll = rng.random()
+        copies = []
+        if roll >= spec.access_only:
+            copies.append((PRESERVATION, 'tif'))
+        if roll < spec.access_only + spec.access:
+            copies.append((ACCESS, 'jpg'))
+
+        for kind, ext in copies:
+            folder = os.path.join(target, kind, *folders)
+            os.makedirs(folder, exist_ok=True)
+            size = rng.randint(spec.min_size, spec.max_size)
+            md5_sidecar = rng.random() < spec.md5
+            write_file(os.path.join(folder, f"{asset}.{ext}"), size, rng, filler, md5_sidecar)
+            counts['files'] += 1
+            counts['bytes'] += size
+            counts['md5'] += md5_sidecar
+
+        counts['assets'] += 1
+        counts['paxes'] += len(copies) > 1
+
+    return counts
+
+
+def add_arguments(parser):
+    """Options describing a collection, shared with bench.run"""
+    defaults = CollectionSpec()
+    parser.add_argument('--assets', type=int, default=defaults.assets,
+                        help=f'Number of assets (default {defaults.assets})')
+    parser.add_argument('--depth', type=int, default=defaults.depth,
+                        help=f'Folder levels above the assets (default {defaults.depth})')
+    parser.add_argument('--per-folder', type=int, default=defaults.per_folder,
+                        help=f'Assets per folder, at most 999 (default {defaults.per_folder})')
+    parser.add_argument('--access', type=float, default=defaults.access,
+                        help=f'Fraction of assets that also have an access copy, '
+                             f'and so a pax (default {defaults.access})')
+    parser.add_argument('--access-only', type=float, default=defaults.access_only,
+                        help=f'Fraction of assets with only an access copy '
+                             f'(default {defaults.access_only})')
+    parser.add_argument('--min-size', type=parse_size, default=defaults.min_size,
+                        help=f'Smallest file, e.g. 512, 4K or 1M (default {defaults.min_size})')
+    parser.add_argument('--max-size', type=parse_size, default=defaults.max_size,
+                        help=f'Largest file (default {defaults.max_size})')
+    parser.add_argument('--md5', type=float, default=defaults.md5,
+                        help=f'Fraction of files with an md5 sidecar (default {defaults.md5})')
+    parser.add_argument('--seed', type=int, default=defaults.seed,
+                        help=f'Random seed (default {defaults.seed})')
+
+
+def spec_from_arguments(args):
+    if not 0 < args.per_folder < 1000:
+        raise ValueError('--per-folder must be between 1 and 999')
+    if args.min_size > args.max_size:
+        raise ValueError('--min-size is bigger than --max-size')
+    return CollectionSpec(args.assets, args.depth, args.per_folder, args.access,
+                          args.access_only, args.min_size, args.max_size, args.md5, args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench.collection',
+                                     description='Generate a synthetic collection')
+    parser.add_argument('target', help='Folder to create the collection in')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        spec = spec_from_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    counts = generate(args.target, spec)
+    print(', '.join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
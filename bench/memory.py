@@ -0,0 +1,97 @@
+"""Measure the memory the Dir tree takes, and the time to list it
+
+    python -m bench.memory [--files N] [-o results.json]
+
+Builds a tree in memory (no files needed) as to_opex would from a
+collection named as conf_fb.py expects, then makes the upload plan from
+it. Results are JSON, like bench.run's, to compare across versions."""
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import opex.util as util
+from opex.util import Dir, AssetInfo
+
+
+def to_calm_id(name):
+    return name.replace('-', '/')
+
+
+def file_infos(count, per_folder=50):
+    """(target, info, stat) for count files, as conf_fb would give them"""
+    for n in range(count):
+        asset, copy = divmod(n, 2)  # a preservation and an access copy of each
+        folder, number = divmod(asset, per_folder)
+        parent = f"FB-{folder // 100 + 1}-{folder % 100 + 1}"
+        asset_id = f"{parent}-{number + 1:03d}"
+        kind, ext = [('Preservica_preservation', 'tif'), ('Preservica_access', 'jpg')][copy]
+
+        target = [(name, to_calm_id(name)) for name in [parent, asset_id]]
+        info = AssetInfo(filename=f"{asset_id}.{ext}", asset_id=to_calm_id(asset_id),
+                         source_path=f"/data/collection/{kind}/{parent}/{asset_id}.{ext}",
+                         is_access=bool(copy), fixity_type='MD5',
+                         fixity=f"{n:032x}")
+        stat = os.stat_result((0o100644, n, 2049, 1, 1000, 1000, n * 1000,
+                               1700000000, 1700000000, 1700000000))
+        yield target, info, stat
+
+
+def measure(count):
+    # Stats as main keeps them, where that's changed over time
+    keep_stat = getattr(util, 'FileStat', None)
+    keep_stat = keep_stat.of if keep_stat else (lambda stat: stat)
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    start = time.perf_counter()
+    tree = Dir()
+    for target, info, stat in file_infos(count):
+        info.stat = keep_stat(stat)
+        tree.add(target, info)
+    build_seconds = time.perf_counter() - start
+
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    plan = [[fileinfo.source_path, dir.path() + '/' + fileinfo.filename]
+            for dirname, dir in tree.all_subdirs()
+            for asset_id, files in dir.files.items()
+            for fileinfo in files]
+    plan_seconds = time.perf_counter() - start
+    assert len(plan) == count
+
+    return {
+        'files': count,
+        'tree_bytes': after - before,
+        'bytes_per_file': (after - before) / count,
+        'peak_bytes': peak - before,
+        'build_seconds': build_seconds,
+        'plan_seconds': plan_seconds,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench.memory', description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--files', type=int, default=200000,
+                        help='Files in the tree (default 200000)')
+    parser.add_argument('-o', '--output', help='Write results to this file, rather than stdout')
+    args = parser.parse_args(argv)
+
+    results = {'python': sys.version.split()[0], **measure(args.files)}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""Time the stages of to_opex and upload on a synthetic collection
+
+    python -m bench.run [-s scan,tree,...] [-o results.json] [--compare old.json]
+
+The collection (see bench.collection) is generated into a work folder,
+each scenario is run --repeat times and the results are written as JSON,
+so runs on different versions or configs can be compared."""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+from opex.util import Dir, FileStat, load_config, pick_name
+import opex.main
+import opex.walker as walker
+import opex.classify as classify
+import opex.compression as compression
+import opex.opex_generator as opex_generator
+import opex.pax_generator as pax_generator
+from opex.upload_plan import load_plan
+from bench import collection
+from bench.s3stub import StubS3Client
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(REPO, 'conf_fb.py')
+
+
+class Skip(Exception):
+    """A scenario can't run here, e.g. for want of an optional package"""
+
+
+class Context:
+    """Everything the scenarios share: the collection, config and options"""
+
+    def __init__(self, source, work, args):
+        self.source = source
+        self.work = work
+        self.args = args
+        self.conf = load_config(args.config)
+        self.runs = 0
+
+    def fresh_dir(self, name):
+        self.runs += 1
+        path = os.path.join(self.work, f"{name}-{self.runs}")
+        os.makedirs(path)
+        return path
+
+    def build_tree(self):
+        tree = Dir()
+        classify_dir = classify.classifier(self.conf)
+        for root, entries in walker.walk([self.source], self.args.scan_workers):
+            for entry, (target, info) in zip(entries, classify_dir(root, entries)):
+                if info:
+                    info.stat = FileStat.of(entry.stat())
+                    tree.add(target, info)
+        return tree
+
+    def to_opex(self, target):
+        argv = ['to_opex', '-c', self.args.config, '-t', target, self.source,
+                '--pax-workers', str(self.args.pax_workers)]
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            opex.main.main(argv)
+
+
+# Each scenario is (setup, run). setup(ctx) makes whatever run needs,
+# untimed; run(ctx, prepared) does the timed work and returns counts.
+
+def run_scan(ctx, prepared):
+    counts = {'folders': 0, 'files': 0}
+    for root, entries in walker.walk([ctx.source], ctx.args.scan_workers):
+        counts['folders'] += 1
+        counts['files'] += len(entries)
+    return counts
+
+
+def run_tree(ctx, prepared):
+    tree = ctx.build_tree()
+    return {'assets': sum(len(dir.files) for _, dir in tree.all_subdirs())}
+
+
+def run_opex(ctx, tree):
+    counts = {'opexes': 0, 'bytes': 0}
+    for _, dir in tree.all_subdirs(top_down=False):
+        for files in dir.files.values():
+            for info in files:
+                counts['bytes'] += len(opex_generator.render_file(info, ctx.conf))
+                counts['opexes'] += 1
+        counts['bytes'] += len(opex_generator.render_dir(dir, ctx.conf))
+        counts['opexes'] += 1
+    return counts
+
+
+def setup_pax(ctx):
+    tree = ctx.build_tree()
+    assets = [(asset_id, files) for _, dir in tree.all_subdirs()
+              for asset_id, files in dir.files.items() if len(files) > 1]
+    return ctx.fresh_dir('pax'), assets
+
+
+def run_pax(ctx, prepared):
+    target, assets = prepared
+    policy = compression.policy_from_config(ctx.conf)
+    counts = {'paxes': 0, 'bytes': 0}
+    for asset_id, files in assets:
+        prefix = pick_name(asset_id, files)
+        zip_path = os.path.join(target, prefix + '.pax.zip')
+        pax_generator.create_pax(asset_id, files, zip_path, prefix, compression=policy)
+        counts['paxes'] += 1
+        counts['bytes'] += os.path.getsize(zip_path)
+    return counts
+
+
+def run_to_opex(ctx, target):
+    ctx.to_opex(target)
+    with open(os.path.join(target, 'to_upload.txt')) as f:
+        return {'uploads': sum(1 for _ in f)}
+
+
+def setup_upload(ctx):
+    try:
+        import opex.uploader as uploader
+    except ImportError as e:
+        raise Skip(f"needs boto3 ({e})")
+
+    target = os.path.join(ctx.work, 'upload-source')
+    if not os.path.exists(target):
+        ctx.to_opex(target)
+
+    plan = [[source, uploader.map_upload(dest, 'bench', 'upload'), fixities]
+            for source, dest, fixities in load_plan(target)]
+    return uploader, plan
+
+
+def run_upload(ctx, prepared):
+    uploader, plan = prepared
+    client = StubS3Client(ctx.args.latency / 1000, ctx.args.corrupt,
+                          link=ctx.args.link_mib * 2**20 if ctx.args.link_mib else None,
+                          capacity=ctx.args.capacity)
+    scheduler = None
+    if ctx.args.adapt or ctx.args.max_mib_per_sec:
+        bytes_per_second = ctx.args.max_mib_per_sec * 2**20 if ctx.args.max_mib_per_sec else None
+        scheduler = uploader.UploadScheduler(ctx.args.upload_workers, ctx.args.max_upload_workers,
+                                             bytes_per_second, ctx.args.adapt,
+                                             ctx.args.adjust_interval)
+    transfer_config = uploader.TransferConfig(
+        multipart_threshold=uploader.MULTIPART_THRESHOLD * 2**20,
+        multipart_chunksize=uploader.MULTIPART_CHUNKSIZE * 2**20)
+    checksum = None if ctx.args.checksum == 'none' else ctx.args.checksum
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):  # it lists every upload
+        failed = uploader.Uploader(client, 'bench', ctx.args.upload_workers,
+                                   transfer_config, checksum=checksum, scheduler=scheduler,
+                                   lookahead=ctx.args.lookahead).upload(plan)
+    if failed:
+        raise RuntimeError(f"{len(failed)} uploads failed")
+    return {'uploads': len(client.objects), 'requests': client.requests,
+            'bytes': sum(size for size, _ in client.objects.values()),
+            'corrupted': len(client.corrupted), 'throttled': client.throttled,
+            'concurrency': scheduler.concurrency.limit if scheduler else ctx.args.upload_workers}
+
+
+SCENARIOS = {
+    'scan': (None, run_scan),
+    'tree': (None, run_tree),
+    'opex': (Context.build_tree, run_opex),
+    'pax': (setup_pax, run_pax),
+    'to_opex': (lambda ctx: ctx.fresh_dir('to_opex'), run_to_opex),
+    'upload': (setup_upload, run_upload),
+}
+
+
+def time_scenario(ctx, name, repeat):
+    setup, run = SCENARIOS[name]
+    seconds = []
+    counts = {}
+
+    for _ in range(repeat):
+        prepared = setup(ctx) if setup else None
+        start = time.perf_counter()
+        counts = run(ctx, prepared)
+        seconds.append(time.perf_counter() - start)
+
+    median = statistics.median(seconds)
+    return {
+        'seconds': seconds,
+        'median': median,
+        'min': min(seconds),
+        'counts': counts,
+        'per_second': {key: value / median for key, value in counts.items() if median},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_collection(work, spec):
+    """Generate the collection, unless it's already in work from an earlier run"""
+    source = os.path.join(work, 'collection')
+    marker = os.path.join(source, 'README.txt')
+    expected = f"Synthetic collection: {spec.as_dict()}\n"
+
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if f.read() == expected:
+                logger.info(f"Reusing collection in {source}")
+                return source
+        shutil.rmtree(source)
+
+    logger.info(f"Generating collection in {source}")
+    counts = collection.generate(source, spec)
+    logger.info(', '.join(f"{count} {name}" for name, count in counts.items()))
+    return source
+
+
+def compare(results, baseline):
+    """Lines comparing median times with a baseline's"""
+    if baseline.get('collection') != results['collection']:
+        yield "Warning: the baseline used a different collection"
+
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if 'median' not in result or not before or 'median' not in before:
+            continue
+        change = (result['median'] - before['median']) / before['median'] * 100
+        yield (f"{name:10} {before['median']:9.3f}s -> {result['median']:9.3f}s "
+               f"({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench.run', description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma separated scenarios to run (default {",".join(SCENARIOS)})')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Times to run each scenario (default 3)')
+    parser.add_argument('-o', '--output', help='Write results to this file, rather than stdout')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with')
+    parser.add_argument('-w', '--work',
+                        help='Folder for the collection and outputs, kept so the collection '
+                             'can be reused (default a temporary folder)')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG,
+                        help='to_opex config to use (default conf_fb.py)')
+    parser.add_argument('--scan-workers', type=int, default=walker.DEFAULT_WORKERS)
+    parser.add_argument('--pax-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--upload-workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds added to each stub S3 request (default 0)')
+    parser.add_argument('--corrupt', type=float, default=0.0,
+                        help='Fraction of stub S3 requests corrupted on the way (default 0)')
+    parser.add_argument('--checksum', default='MD5', choices=['MD5', 'SHA-256', 'none'],
+                        help='Checksum S3 checks uploads against (default MD5)')
+    parser.add_argument('--link-mib', type=float,
+                        help='MiB per second of the stub S3 link, shared by all uploads '
+                             '(default unlimited)')
+    parser.add_argument('--capacity', type=int,
+                        help='Requests the stub S3 serves at once, more told to slow down '
+                             '(default unlimited)')
+    parser.add_argument('--adapt', action='store_true',
+                        help='Adapt upload concurrency, from --upload-workers up to '
+                             '--max-upload-workers')
+    parser.add_argument('--max-upload-workers', type=int, default=32)
+    parser.add_argument('--adjust-interval', type=float, default=1.0,
+                        help='Seconds between changes in upload concurrency (default 1, '
+                             'shorter than upload.py, as bench runs are)')
+    parser.add_argument('--max-mib-per-sec', type=float, help='Cap on upload bandwidth')
+    parser.add_argument('--lookahead', type=int, default=1000,
+                        help='Entries to upload the largest of first (default 1000, 0 for '
+                             'plan order)')
+    collection.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    names = args.scenarios.split(',')
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario: {name}")
+    try:
+        spec = collection.spec_from_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Quieten to_opex, which would otherwise set up INFO logging
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s\t%(message)s')
+    logger.setLevel(logging.INFO)
+    logging.getLogger('opex').setLevel(logging.ERROR)  # e.g. assets lacking fixities
+
+    work = args.work or tempfile.mkdtemp(prefix='opex-bench-')
+    try:
+        os.makedirs(work, exist_ok=True)
+        source = prepare_collection(work, spec)
+        # Outputs from earlier runs would be in the way
+        for entry in os.listdir(work):
+            if entry != 'collection':
+                shutil.rmtree(os.path.join(work, entry))
+
+        ctx = Context(source, work, args)
+        results = {
+            'version': RESULTS_VERSION,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'collection': spec.as_dict(),
+            'options': {'config': os.path.basename(args.config), 'repeat': args.repeat,
+                        'scan_workers': args.scan_workers, 'pax_workers': args.pax_workers,
+                        'upload_workers': args.upload_workers, 'latency': args.latency,
+                        'corrupt': args.corrupt, 'checksum': args.checksum,
+                        'link_mib': args.link_mib, 'capacity': args.capacity,
+                        'adapt': args.adapt, 'max_upload_workers': args.max_upload_workers,
+                        'adjust_interval': args.adjust_interval,
+                        'max_mib_per_sec': args.max_mib_per_sec,
+                        'lookahead': args.lookahead},
+            'scenarios': {},
+        }
+
+        for name in names:
+            logger.info(f"Running {name}")
+            try:
+                result = time_scenario(ctx, name, args.repeat)
+                logger.info(f"{name}: {result['median']:.3f}s")
+            except Skip as e:
+                logger.warning(f"Skipping {name}: {e}")
+                result = {'skipped': str(e)}
+            results['scenarios'][name] = result
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for line in compare(results, baseline):
+            print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""A stand-in S3 client, for timing uploads without a network
+
+Implements the calls opex.uploader and opex.streamer make. Objects'
+contents are read (so the upload side does its real work) but only their
+sizes and ETags are kept. Like S3, it checks any checksums it's given,
+so it can stand in for a bad network too, corrupting some of what's sent,
+or for a slow one, or a busy S3 that tells clients to slow down."""
+import time
+import uuid
+import base64
+import random
+import hashlib
+import threading
+
+READ_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 10
+BACKOFF = 0.01  # seconds, doubled each retry
+
+
+def multipart_etag(part_digests):
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def encode(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+class StubError(Exception):
+    """Shaped like botocore's ClientError"""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class Paginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=''):
+        with self.client.lock:
+            contents = [{'Key': key, 'Size': size, 'ETag': f'"{etag}"'}
+                        for key, (size, etag) in sorted(self.client.objects.items())
+                        if key.startswith(Prefix)]
+        yield {'Contents': contents}
+
+
+class StubS3Client:
+    """Just enough of a boto3 S3 client
+
+    latency (seconds) is added to every request, to stand in for the
+    round trip to a real endpoint, and corrupt is the fraction of
+    requests whose data has a byte changed on the way. Keys whose
+    objects were stored corrupted (as nothing checked them) are kept.
+
+    link (bytes per second) is the speed of the one link all requests'
+    data shares, and capacity how many requests are served at once.
+    More are told to slow down, as S3 does, and like botocore we back off
+    and try again (up to MAX_ATTEMPTS times), saying how many retries it
+    took in the response's ResponseMetadata."""
+
+    def __init__(self, latency=0.0, corrupt=0.0, seed=0, link=None, capacity=None):
+        self.latency = latency
+        self.corrupt = corrupt
+        self.link = link
+        self.capacity = capacity
+        self.link_free = time.monotonic()  # when the link has sent everything so far
+        self.active = 0
+        self.throttled = 0
+        self.random = random.Random(seed)
+        self.objects = {}   # key -> (size, etag)
+        self.uploads = {}   # upload id -> (checksum algorithm, {part number: (size, md5, sha256, corrupted)})
+        self.corrupted = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _request(self, size=0):
+        """Serve a request sending size bytes, returning the retries it took"""
+        for retries in range(MAX_ATTEMPTS):
+            with self.lock:
+                self.requests += 1
+                if not self.capacity or self.active < self.capacity:
+                    self.active += 1
+                    break
+                self.throttled += 1
+            time.sleep(BACKOFF * 2**retries)
+        else:
+            raise StubError('SlowDown', "Please reduce your request rate.")
+
+        with self.lock:
+            if self.link:
+                self.link_free = max(self.link_free, time.monotonic()) + size / self.link
+                sent = self.link_free
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if self.link:
+                time.sleep(max(0.0, sent - time.monotonic()))
+        finally:
+            with self.lock:
+                self.active -= 1
+        return retries
+
+    def _receive(self, data, checksums):
+        """What arrives of data, and whether it was corrupted, as S3 checks it"""
+        with self.lock:
+            corrupted = bool(data) and self.random.random() < self.corrupt
+            if corrupted:
+                position = self.random.randrange(len(data))
+                data = data[:position] + bytes([data[position] ^ 0xff]) + data[position + 1:]
+
+        if 'ContentMD5' in checksums and encode(hashlib.md5(data).digest()) != checksums['ContentMD5']:
+            raise StubError('BadDigest', "The Content-MD5 you specified did not match what we received.")
+        sha256 = hashlib.sha256(data).digest()
+        if 'ChecksumSHA256' in checksums and encode(sha256) != checksums['ChecksumSHA256']:
+            raise StubError('BadDigest', "The SHA256 you specified did not match the calculated checksum.")
+        return data, sha256, corrupted
+
+    def _store(self, key, size, etag, corrupted=False):
+        with self.lock:
+            self.objects[key] = (size, etag)
+            if corrupted:
+                self.corrupted.add(key)
+            else:
+                self.corrupted.discard(key)
+        return {'ETag': f'"{etag}"'}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        retries = self._request(len(data))
+        data, sha256, corrupted = self._receive(data, kwargs)
+        response = self._store(Key, len(data), hashlib.md5(data).hexdigest(), corrupted)
+        response['ResponseMetadata'] = {'RetryAttempts': retries}
+        if 'ChecksumSHA256' in kwargs:
+            response['ChecksumSHA256'] = encode(sha256)
+        return response
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        chunk_size = Config.multipart_chunksize if Config else 8 * 2**20
+        digests = []
+        size = 0
+        corrupted = False
+
+        with open(Filename, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                self._request(len(chunk))
+                chunk, sha256, chunk_corrupted = self._receive(chunk, {})
+                corrupted = corrupted or chunk_corrupted
+                digests.append(hashlib.md5(chunk).digest())
+                size += len(chunk)
+                if Callback:
+                    Callback(len(chunk))
+
+        if len(digests) == 1:
+            etag = digests[0].hex()
+        else:
+            etag = multipart_etag(digests)
+        self._store(Key, size, etag, corrupted)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._request()
+        with self.lock:
+            size, etag = self.objects[Key]
+        return {'ContentLength': size, 'ETag': f'"{etag}"'}
+
+    def create_multipart_upload(self, Bucket, Key, ChecksumAlgorithm=None, **kwargs):
+        self._request()
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = (ChecksumAlgorithm, {})
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        retries = self._request(len(Body))
+        algorithm, parts = self.uploads[UploadId]
+        if algorithm == 'SHA256' and 'ChecksumSHA256' not in kwargs:
+            raise StubError('InvalidRequest', "Parts need a SHA256 checksum")
+        data, sha256, corrupted = self._receive(Body, kwargs)
+        digest = hashlib.md5(data).digest()
+        with self.lock:
+            parts[PartNumber] = (len(data), digest, sha256, corrupted)
+        response = {'ETag': f'"{digest.hex()}"', 'ResponseMetadata': {'RetryAttempts': retries}}
+        if algorithm == 'SHA256':
+            response['ChecksumSHA256'] = encode(sha256)
+        return response
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._request()
+        with self.lock:
+            algorithm, parts = self.uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        size = sum(parts[number][0] for number in numbers)
+        response = self._store(Key, size, multipart_etag([parts[number][1] for number in numbers]),
+                               any(parts[number][3] for number in numbers))
+        if algorithm == 'SHA256':
+            sha256s = [parts[number][2] for number in numbers]
+            response['ChecksumSHA256'] = (encode(hashlib.sha256(b''.join(sha256s)).digest())
+                                          + f"-{len(numbers)}")
+        return response
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._request()
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+    def get_paginator(self, operation_name):
+        return Paginator(self)
@@ -0,0 +1,127 @@
+"""Check the template serializers against ElementTree, and time both
+
+    python -m bench.serializer [-n ITERATIONS]
+
+Every case must give identical bytes, or this exits non-zero."""
+import sys
+import uuid
+import timeit
+import argparse
+import logging
+import itertools
+from unittest import mock
+import xml.etree.ElementTree as ET
+from opex.util import AssetInfo, Dir
+import opex.opex_generator as opex_generator
+import opex.pax_generator as pax_generator
+
+# Things ElementTree escapes, or might
+AWKWARD = ['plain', 'a & b', '<tag>', 'x > y', '"quoted"', "it's",
+           'tab\there', 'new\nline', 'cr\rhere', 'café', '日本', '']
+
+
+def sample_files(names=AWKWARD):
+    files = []
+    for n, name in enumerate(names):
+        fixities = {'SHA-256': name or 'x'} if n % 3 == 0 else {}
+        files.append(AssetInfo(filename=f"{name}.{n}.tif", asset_id=f"id/{name}",
+                               source_path=f"/src/{n}", is_access=bool(n % 2),
+                               fixity_type='MD5', fixity=name or None,
+                               is_metadata=n % 4 == 0, fixities=fixities))
+    return files
+
+
+def sample_dirs():
+    yield Dir()  # root: no name or id
+    yield Dir('empty', 'empty')
+
+    for name in AWKWARD:
+        dir = Dir(name, f"id/{name}")
+        for fileinfo in sample_files():
+            dir.add_file(fileinfo)
+        for subdir in AWKWARD:
+            dir.subdirs[subdir] = Dir(subdir, subdir, dir)
+        yield dir
+
+
+def fixed_uuids():
+    counter = itertools.count()
+    return lambda: uuid.UUID(int=next(counter))
+
+
+def check():
+    """All the mismatches between the old and new serializers"""
+    failures = []
+
+    for dir in sample_dirs():
+        expected = opex_generator.serialize(opex_generator.output_dir(dir, None))
+        if opex_generator.render_dir(dir, None) != expected:
+            failures.append(f"dir {dir.name!r}")
+
+    files = sample_files()
+    for fileinfo in files:
+        expected = opex_generator.serialize(opex_generator.output_file(fileinfo, None))
+        if opex_generator.render_file(fileinfo, None) != expected:
+            failures.append(f"file {fileinfo.filename!r}")
+
+    for id, some_files in [('a & <b>', files), ('none', []), ('one', files[:1])]:
+        sizes = {fileinfo.source_path: n for n, fileinfo in enumerate(some_files)}
+
+        with mock.patch('uuid.uuid4', fixed_uuids()):
+            xip = pax_generator.create_xip(id, some_files, sizes)
+            expected = ET.tostring(xip.getroot(), encoding='utf-8')
+        with mock.patch('uuid.uuid4', fixed_uuids()):
+            actual = pax_generator.render_xip(id, some_files, sizes)
+
+        if actual != expected:
+            failures.append(f"xip {id!r}")
+
+    return failures
+
+
+def benchmark(iterations):
+    dir = list(sample_dirs())[-1]
+    fileinfo = sample_files()[0]
+    files = sample_files()
+    sizes = {f.source_path: 1 for f in files}
+
+    cases = [
+        ('dir opex',
+         lambda: opex_generator.serialize(opex_generator.output_dir(dir, None)),
+         lambda: opex_generator.render_dir(dir, None)),
+        ('file opex',
+         lambda: opex_generator.serialize(opex_generator.output_file(fileinfo, None)),
+         lambda: opex_generator.render_file(fileinfo, None)),
+        ('xip',
+         lambda: ET.tostring(pax_generator.create_xip('id', files, sizes).getroot(),
+                             encoding='utf-8'),
+         lambda: pax_generator.render_xip('id', files, sizes)),
+    ]
+
+    for name, old, new in cases:
+        old_time = timeit.timeit(old, number=iterations)
+        new_time = timeit.timeit(new, number=iterations)
+        print(f"{name:10} ElementTree {old_time / iterations * 1e6:8.1f}us  "
+              f"template {new_time / iterations * 1e6:8.1f}us  "
+              f"x{old_time / new_time:.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench.serializer', description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    logging.getLogger('opex').setLevel(logging.ERROR)  # the samples lacking fixities
+
+    failures = check()
+    for failure in failures:
+        print(f"MISMATCH: {failure}")
+    if failures:
+        sys.exit(1)
+    print("Template output matches ElementTree")
+
+    benchmark(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Check sharded builds against a whole one, with local processes as nodes
+
+    python -m bench.shards [-n 3] [--by asset|folder] [collection options]
+
+Builds a synthetic collection (see bench.collection) with to_opex once
+whole, then as n shards run at once in separate processes, and merges
+the shards. The two must upload the same files to the same places: the
+same content, the same folder opexes (in any order) and paxes with the
+same members (their xips have fresh ids each time). Prints the times
+taken as JSON, and exits 1 if they differ."""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+import subprocess
+from bench import collection
+from bench.run import REPO, DEFAULT_CONFIG, prepare_collection
+from opex.upload_plan import read_plan
+
+logger = logging.getLogger(__name__)
+
+
+def to_opex(*args):
+    return [sys.executable, os.path.join(REPO, 'to_opex.py'), *args]
+
+
+def run(commands):
+    """Run commands at once, as separate nodes would, returning the seconds taken"""
+    start = time.perf_counter()
+    processes = [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                 for command in commands]
+    for command, process in zip(commands, processes):
+        _, errors = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"{' '.join(command)} failed:\n{errors.decode()}")
+    return time.perf_counter() - start
+
+
+def comparable(source, target):
+    """What should match between two builds, for an upload"""
+    if target.endswith('.pax.zip'):
+        with zipfile.ZipFile(source) as zip:
+            return sorted(zip.namelist())
+
+    with open(source, 'rb') as f:
+        data = f.read()
+    if target.endswith('.opex'):
+        # Folder opexes list things in the order they're found, and pax
+        # opexes have the fixity of a zip with fresh ids in it
+        return sorted(line for line in data.splitlines()
+                      if not (target.endswith('.pax.zip.opex') and b'opex:Fixity ' in line))
+    return data
+
+
+def differences(whole_dir, merged_dir):
+    whole = {target: source for source, target, fixities
+             in read_plan(os.path.join(whole_dir, 'upload_plan.tsv'))}
+    merged = {target: source for source, target, fixities
+              in read_plan(os.path.join(merged_dir, 'upload_plan.tsv'))}
+
+    for target in sorted(whole.keys() - merged.keys()):
+        yield f"Missing from merge: {target}"
+    for target in sorted(merged.keys() - whole.keys()):
+        yield f"Only in merge: {target}"
+    for target in sorted(whole.keys() & merged.keys()):
+        if comparable(whole[target], target) != comparable(merged[target], target):
+            yield f"Differs: {target}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bench.shards', description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--shards', type=int, default=3, help='Number of shards (default 3)')
+    parser.add_argument('--by', choices=['asset', 'folder'], default='asset',
+                        help='How to split the collection (default asset)')
+    parser.add_argument('-w', '--work',
+                        help='Folder for the collection and outputs (default a temporary folder)')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG,
+                        help='to_opex config to use (default conf_fb.py)')
+    parser.add_argument('--pax-workers', type=int, default=1,
+                        help='Pax workers for each process (default 1)')
+    collection.add_arguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        spec = collection.spec_from_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s\t%(message)s')
+
+    work = args.work or tempfile.mkdtemp(prefix='opex-shards-')
+    try:
+        os.makedirs(work, exist_ok=True)
+        source = prepare_collection(work, spec)
+        for entry in ['whole', 'merged', *[f"shard-{n}" for n in range(1, args.shards + 1)]]:
+            shutil.rmtree(os.path.join(work, entry), ignore_errors=True)
+
+        common = ['-c', args.config, '--pax-workers', str(args.pax_workers)]
+        whole_dir = os.path.join(work, 'whole')
+        shard_dirs = [os.path.join(work, f"shard-{n}") for n in range(1, args.shards + 1)]
+        merged_dir = os.path.join(work, 'merged')
+
+        logger.info("Building whole")
+        whole_seconds = run([to_opex(*common, '-t', whole_dir, source)])
+
+        logger.info(f"Building {args.shards} shards by {args.by}")
+        shard_seconds = run([to_opex(*common, '-t', shard_dir, '--shard', f"{n}/{args.shards}",
+                                     '--shard-by', args.by, source)
+                             for n, shard_dir in enumerate(shard_dirs, 1)])
+
+        logger.info("Merging")
+        merge_seconds = run([[sys.executable, os.path.join(REPO, 'merge_shards.py'),
+                              '-t', merged_dir, *shard_dirs]])
+
+        problems = list(differences(whole_dir, merged_dir))
+        for problem in problems[:20]:
+            logger.error(problem)
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    print(json.dumps({
+        'collection': spec.as_dict(),
+        'shards': args.shards,
+        'by': args.by,
+        'whole_seconds': whole_seconds,
+        'shard_seconds': shard_seconds,
+        'merge_seconds': merge_seconds,
+        'differences': len(problems),
+    }, indent=2))
+
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
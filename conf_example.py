@@ -1,4 +1,8 @@
 # Example configuration file
+#
+# Most collections can be described with rules instead, which are
+# simpler and quicker; see conf_fb.toml. A Python config like this is
+# for anything rules can't do.
 from opex.util import AssetInfo
 from os.path import exists
 
@@ -19,6 +23,19 @@ from os.path import exists
 # For the upload tool, target container for uploads
 CONTAINER = 'example_container'
 
+# How files are compressed in pax zips, by extension. Methods are
+# 'stored', 'deflate', 'bzip2' or 'lzma' (optionally with a level, e.g.
+# 'deflate:9'), or 'auto' to compress only if a sample of the file shrinks.
+# Leave this out to store everything, or start from
+# opex.compression.RECOMMENDED_RULES
+COMPRESSION = {
+    'default': 'auto',
+    'jpg': 'stored',
+    'png': 'stored',
+    'xml': 'deflate:9',
+    'xip': 'deflate:9',
+}
+
 
 def path_to_parts(path):
     # Break path into bits and return them
@@ -73,3 +90,24 @@ def get_info_for_file(path):
     )
 
     return target, info  # Path (as array) where asset will be uploaded to, and asset info
+
+
+# Optional: classify all the files in a folder at once. If this is
+# defined it is used instead of get_info_for_file, which saves a call per
+# file and lets you look for md5s in the folder listing rather than on
+# disk. entries are os.DirEntry objects (entry.name, entry.path), and
+# sidecars knows what's in the folder: sidecars.exists(path) and
+# sidecars.read(path) (None if it isn't there). Return one (target, info)
+# for each entry, in the same order, (None, None) for files to ignore
+def get_info_for_files(dirpath, entries, sidecars):
+    results = []
+    for entry in entries:
+        # ... as get_info_for_file, but with
+        # fixity = sidecars.read(md5file)
+        results.append(get_info_for_file(entry.path))
+    return results
+
+# Optional: hooks run around each stage timed for --stats, e.g. to run a
+# profiler. Each has start(name) and stop(name, seconds); see
+# opex.instrument.Hook
+# STATS_HOOKS = [MyProfilerHook()]
@@ -10,6 +10,24 @@ def to_calm_id(name):
     return re.sub('-', '/', name)
 
 
+def make_info(path, match, fixity_type, fixity):
+    parent, asset_id, ext = match.group(2), match.group(1), match.group(3)
+
+    # Map names to ids
+    target = [(name, to_calm_id(name)) for name in [parent, asset_id]]
+
+    info = AssetInfo(
+        filename=asset_id + '.' + ext,
+        asset_id=to_calm_id(asset_id),
+        source_path=path,
+        is_access="Preservica_access" in path,
+        fixity_type=fixity_type,
+        fixity=fixity
+    )
+
+    return target, info
+
+
 def get_info_for_file(path):
 
     match = GET_ID_EXT.search(path)
@@ -17,7 +35,7 @@ def get_info_for_file(path):
     if not match:
         return None, None
 
-    parent, asset_id, ext = match.group(2), match.group(1), match.group(3)
+    ext = match.group(3)
 
     if ext in ['md5']:
         # Not a file type we care about
@@ -32,16 +50,25 @@ def get_info_for_file(path):
         fixity_type = None
         fixity = None
 
-    # Map names to ids
-    target = [(name, to_calm_id(name)) for name in [parent, asset_id]]
+    return make_info(path, match, fixity_type, fixity)
 
-    info = AssetInfo(
-        filename=asset_id + '.' + ext,
-        asset_id=to_calm_id(asset_id),
-        source_path=path,
-        is_access="Preservica_access" in path,
-        fixity_type=fixity_type,
-        fixity=fixity
-    )
 
-    return target, info
+# As get_info_for_file, but for all of a folder's files at once. md5s
+# are looked up in the folder listing rather than on disk
+def get_info_for_files(dirpath, entries, sidecars):
+    results = []
+    for entry in entries:
+        # Ids can't contain a '/', so the name is enough to match
+        match = GET_ID_EXT.search(entry.name)
+
+        if not match or match.group(3) == 'md5':
+            results.append((None, None))
+            continue
+
+        path = entry.path
+        fixity = sidecars.read(path.replace(match.group(3), 'md5'))
+        fixity_type = 'MD5' if fixity is not None else None
+
+        results.append(make_info(path, match, fixity_type, fixity))
+
+    return results
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+import opex.shards
+import sys
+
+if __name__ == '__main__':
+    opex.shards.main(sys.argv)
@@ -0,0 +1,327 @@
+import os
+import sys
+import hashlib
+import argparse
+import logging
+import xml.etree.ElementTree as ET
+from opex.util import Dir, AssetInfo
+import opex.opex_generator as opex_generator
+import opex.upload_plan as upload_plan_file
+from opex.instrument import stats
+
+logger = logging.getLogger(__name__)
+
+# Starting points: big enough to be worth an ingest, small enough that
+# one going wrong isn't a disaster
+DEFAULT_MAX_GIB = 100
+DEFAULT_MAX_FILES = 10000
+
+# Lists the batches, in the order to upload them
+INDEX_FILENAME = 'batches.tsv'
+
+OPEX = '{' + opex_generator.opex + '}'
+
+
+def read_folder_opex(path):
+    """(dir id, [(filename, is_metadata)], [folder name]) from a folder's opex"""
+    root = ET.parse(path).getroot()
+    manifest = root.find(f'{OPEX}Transfer/{OPEX}Manifest')
+    files = [(file.text, file.get('type') == 'metadata')
+             for file in manifest.iterfind(f'{OPEX}Files/{OPEX}File')]
+    folders = [folder.text for folder in manifest.iterfind(f'{OPEX}Folders/{OPEX}Folder')]
+    dir_id = root.findtext(f'{OPEX}Properties/{OPEX}Identifiers/{OPEX}Identifier')
+    return dir_id, files, folders
+
+
+class Folder:
+    """A folder in an upload plan, with the sizes of it and all below it
+
+    Its files are grouped into units that must go together: a file and
+    its opex. Its own opex is kept apart, as a batch with only some of
+    the folder in it needs one listing just that."""
+
+    __slots__ = ('name', 'parent', 'subfolders', 'entries', 'units', 'opex', 'bytes', 'files')
+
+    def __init__(self, name=None, parent=None):
+        self.name = name
+        self.parent = parent
+        self.subfolders = {}
+        self.entries = {}  # filename -> plan entry, until grouped into units
+        self.units = []    # (bytes, [entries])
+        self.opex = None   # plan entry
+        self.bytes = 0
+        self.files = 0
+
+    def path(self):
+        return self.parent.path() + '/' + self.name if self.parent else ''
+
+    def opex_name(self):
+        return self.name + '.opex' if self.parent else 'root.opex'
+
+    def bottom_up(self):
+        for subfolder in self.subfolders.values():
+            yield from subfolder.bottom_up()
+        yield self
+
+    def all_entries(self):
+        yield self.opex
+        for bytes, unit in self.units:
+            yield from unit
+        for subfolder in self.subfolders.values():
+            yield from subfolder.all_entries()
+
+    def group(self):
+        """Sort the entries into units and add up the sizes"""
+        entries = self.entries
+        self.entries = None
+        self.opex = entries.pop(self.opex_name(), None)
+        if self.opex is None:
+            raise ValueError(f"Nothing in the plan for the opex of {self.path() or '/'}")
+
+        for filename, entry in entries.items():
+            if filename.endswith('.opex') and filename[:-len('.opex')] in entries:
+                continue  # goes with its file
+            unit = [entry]
+            if opex_entry := entries.get(filename + '.opex'):
+                unit.append(opex_entry)
+            self.units.append((sum(os.path.getsize(source) for source, _, _ in unit), unit))
+
+        self.bytes = (os.path.getsize(self.opex[0]) + sum(bytes for bytes, _ in self.units)
+                      + sum(subfolder.bytes for subfolder in self.subfolders.values()))
+        self.files = (1 + sum(len(unit) for _, unit in self.units)
+                      + sum(subfolder.files for subfolder in self.subfolders.values()))
+
+
+def read_tree(upload_plan):
+    """The Folder tree of an upload plan's targets"""
+    root = Folder()
+    for entry in upload_plan:
+        *names, filename = entry[1].split('/')[1:]
+        folder = root
+        for name in names:
+            subfolder = folder.subfolders.get(name)
+            if subfolder is None:
+                subfolder = folder.subfolders[name] = Folder(name, folder)
+            folder = subfolder
+        folder.entries[filename] = entry
+
+    for folder in root.bottom_up():
+        folder.group()
+    return root
+
+
+class Batch:
+    """Part of a collection that can be uploaded and ingested on its own
+
+    Folders are in a batch whole, with everything below them, or in
+    part, with some of their files. The latter, and the folders above
+    anything in the batch, get opexes of their own listing just what's
+    in the batch. Those count towards the batch's files, but being small
+    not its bytes."""
+
+    def __init__(self, number):
+        self.number = number
+        self.bytes = 0
+        self.files = 0
+        self.whole = []    # folders
+        self.parts = {}    # folder -> units of it in this batch
+        self.folders = {}  # folder -> None, for those with opexes made for this batch
+
+    def is_empty(self):
+        return not self.files
+
+    def new_folders(self, folder):
+        """The folders from folder up that something in it would add"""
+        new = []
+        while folder is not None and folder not in self.folders:
+            new.append(folder)
+            folder = folder.parent
+        return new
+
+    def fits(self, folder, bytes, files, max_bytes, max_files):
+        """Whether there's room for bytes and files more in folder"""
+        return (self.bytes + bytes <= max_bytes
+                and self.files + files + len(self.new_folders(folder)) <= max_files)
+
+    def _add(self, folder, bytes, files):
+        new = self.new_folders(folder)
+        self.folders.update(dict.fromkeys(new))
+        self.bytes += bytes
+        self.files += files + len(new)
+
+    def add_whole(self, folder):
+        self._add(folder.parent, folder.bytes, folder.files)
+        self.whole.append(folder)
+
+    def add_unit(self, folder, unit):
+        bytes, entries = unit
+        self._add(folder, bytes, len(entries))
+        self.parts.setdefault(folder, []).append(unit)
+
+
+class Scheduler:
+    """Splits a Folder tree into batches of at most max_bytes and max_files
+
+    Batches are filled in turn, in plan order. A folder goes into a
+    batch whole if there's room, or into the next batch if that would
+    have room. Only a folder too big for any batch is split, its files
+    and subfolders going into batches in the same way. A single file
+    (and its opex) too big for a batch gets one to itself."""
+
+    def __init__(self, max_bytes, max_files):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.batches = [Batch(1)]
+
+    def fits(self, batch, folder, bytes, files):
+        return batch.fits(folder, bytes, files, self.max_bytes, self.max_files)
+
+    def batch_for(self, folder, bytes, files):
+        batch = self.batches[-1]
+        if not batch.is_empty() and not self.fits(batch, folder, bytes, files):
+            batch = Batch(len(self.batches) + 1)
+            self.batches.append(batch)
+        return batch
+
+    def schedule(self, folder):
+        for unit in folder.units:
+            bytes, entries = unit
+            batch = self.batch_for(folder, bytes, len(entries))
+            if not self.fits(batch, folder, bytes, len(entries)):
+                logger.warning(f"{entries[0][1]} is bigger than a batch, so has one to itself")
+            batch.add_unit(folder, unit)
+
+        for subfolder in folder.subfolders.values():
+            if (self.fits(self.batches[-1], folder, subfolder.bytes, subfolder.files)
+                    or self.fits(Batch(0), folder, subfolder.bytes, subfolder.files)):
+                self.batch_for(folder, subfolder.bytes, subfolder.files).add_whole(subfolder)
+            else:
+                logger.debug(f"Splitting {subfolder.path()} between batches")
+                self.schedule(subfolder)
+
+        return self.batches
+
+
+def folder_opex(folder, batch):
+    """A folder's opex, listing only what of it is in batch"""
+    in_batch = {entry[1].rsplit('/', 1)[1]
+                for bytes, entries in batch.parts.get(folder, []) for entry in entries}
+    whole = set(batch.whole)
+
+    dir_id, files, folders = read_folder_opex(folder.opex[0])
+    dir = Dir(folder.name, dir_id)
+    dir.files = {None: [AssetInfo(filename, None, None, False, None, None, is_metadata)
+                        for filename, is_metadata in files if filename in in_batch]}
+    for name in folders:
+        subfolder = folder.subfolders.get(name)
+        if subfolder in whole or subfolder in batch.folders:
+            dir.subdirs[name] = subfolder
+    return opex_generator.render_dir(dir, None)
+
+
+def write_batch(batch, batch_dir):
+    """Write a batch's folder opexes and upload plan into batch_dir
+
+    Returns the number of files and bytes to upload."""
+    entries = []
+    for folder in batch.whole:
+        entries.extend(folder.all_entries())
+
+    for folder in batch.folders:
+        data = folder_opex(folder, batch)
+        folder_dir = os.path.join(batch_dir, *folder.path().split('/')[1:])
+        os.makedirs(folder_dir, exist_ok=True)
+        opex_path = os.path.join(folder_dir, folder.opex_name())
+        with open(opex_path, 'wb') as f:
+            f.write(data)
+        entries.append([opex_path, folder.path() + '/' + folder.opex_name(),
+                        upload_plan_file.format_fixities({'MD5': hashlib.md5(data).hexdigest()})])
+        entries.extend(entry for bytes, unit in batch.parts.get(folder, []) for entry in unit)
+
+    with open(os.path.join(batch_dir, upload_plan_file.LEGACY_FILENAME), 'w') as f:
+        for source, target, fixities in entries:
+            f.write(f"{source}\t{target}\n")
+    upload_plan_file.write_plan(os.path.join(batch_dir, upload_plan_file.PLAN_FILENAME),
+                                sorted(entries, key=upload_plan_file.order_key))
+
+    return len(entries), sum(os.path.getsize(source) for source, _, _ in entries)
+
+
+def read_index(batches_dir):
+    """The batch folders in batches_dir, in the order to upload them"""
+    with open(os.path.join(batches_dir, INDEX_FILENAME), 'r') as f:
+        return [os.path.join(batches_dir, line.split('\t', 1)[0])
+                for line in f if not line.startswith('#')]
+
+
+def split(target_dir, batches_dir, max_bytes, max_files):
+    """Split a target folder's upload into batches in batches_dir
+
+    Returns [(name, files, bytes)] for the batches, in order."""
+    root = read_tree(upload_plan_file.load_plan(target_dir))
+    logger.info(f"{root.files} files, {root.bytes} bytes to upload")
+
+    name = os.path.basename(os.path.abspath(target_dir))
+    batches = []
+    for batch in Scheduler(max_bytes, max_files).schedule(root):
+        batch_name = f"{name}-batch{batch.number:03d}"
+        with stats.timer('batch write', count=0) as timer:
+            batch_dir = os.path.join(batches_dir, batch_name)
+            os.makedirs(batch_dir)
+            files, bytes = write_batch(batch, batch_dir)
+            timer.count, timer.bytes = files, bytes
+        logger.info(f"{batch_name}: {files} files, {bytes} bytes")
+        batches.append((batch_name, files, bytes))
+
+    with open(os.path.join(batches_dir, INDEX_FILENAME), 'w') as f:
+        f.write('#batch\tfiles\tbytes\n')
+        for batch_name, files, bytes in batches:
+            f.write(f"{batch_name}\t{files}\t{bytes}\n")
+
+    return batches
+
+
+def main(argv):
+    argv.pop(0)
+
+    parser = argparse.ArgumentParser(prog='split_batches',
+                                     description='Split an upload into batches to ingest one '
+                                                 'at a time')
+    parser.add_argument('-t', '--target', required=True,
+                        help='The folder to_opex (or merge_shards) wrote the upload plan in')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Folder for the batches, each a folder to upload with upload.py, '
+                             'or all of them with upload.py --batches')
+    parser.add_argument('--max-gib', type=float, default=DEFAULT_MAX_GIB,
+                        help=f'Most GiB in a batch (default {DEFAULT_MAX_GIB})')
+    parser.add_argument('--max-files', type=int, default=DEFAULT_MAX_FILES,
+                        help=f'Most files in a batch, opexes included (default {DEFAULT_MAX_FILES})')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Explain what is happening')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Report time, counts and bytes for each stage at the end, '
+                             'as text (the default) or json')
+    parser.add_argument('--stats-file', help='Write the --stats report here rather than print it')
+
+    arguments = parser.parse_args(argv)
+
+    format = '%(levelname)s\t%(message)s'
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.INFO, format=format)
+    if arguments.stats:
+        stats.enable()
+
+    batches_dir = arguments.output
+    if os.path.exists(batches_dir) and os.listdir(batches_dir):
+        parser.error(f"{batches_dir} isn't empty, so old batches would be mixed in")
+
+    try:
+        batches = split(arguments.target, batches_dir, int(arguments.max_gib * 2**30),
+                        arguments.max_files)
+    except (OSError, ValueError) as e:
+        logger.error(f"Unable to split: {e}")
+        sys.exit(1)
+
+    print(f"{len(batches)} batches, listed in {os.path.join(batches_dir, INDEX_FILENAME)}")
+
+    if arguments.stats:
+        stats.write_report(arguments.stats, arguments.stats_file)
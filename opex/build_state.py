@@ -0,0 +1,135 @@
+import os
+import hashlib
+import sqlite3
+import logging
+from opex.upload_plan import format_fixities, parse_fixities
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILENAME = '.build_state.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifact (
+    path TEXT PRIMARY KEY,
+    signature TEXT NOT NULL,
+    run INTEGER NOT NULL
+)
+"""
+
+# Of artifacts only hashed as they're made, like paxes, for when they aren't
+FIXITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fixity (
+    path TEXT PRIMARY KEY,
+    fixities TEXT NOT NULL
+)
+"""
+
+
+def signature(*parts):
+    """A stable digest of everything that goes into an artifact"""
+    hasher = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        hasher.update(len(part).to_bytes(8, 'big'))
+        hasher.update(part)
+    return hasher.hexdigest()
+
+
+class BuildState:
+    """What we generated last time, and from what
+
+    Each generated file (artifact) is recorded with a signature of its
+    inputs, plus the run that last produced it. In incremental mode an
+    artifact that still exists with the same signature needn't be made
+    again, and anything from earlier runs that this run didn't produce is
+    stale. Signatures include the config hash, so changing the config
+    rebuilds everything. An artifact's fixities can be kept too, so one
+    that isn't made again can still be checked as it's uploaded."""
+
+    def __init__(self, path, config_hash, incremental=False):
+        self.path = path
+        self.config_hash = config_hash
+        self.incremental = incremental
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        self.db = sqlite3.connect(path)
+        self.db.execute(SCHEMA)
+        self.db.execute(FIXITY_SCHEMA)
+        last_run, = self.db.execute('SELECT MAX(run) FROM artifact').fetchone()
+        self.run = (last_run or 0) + 1
+
+    def signature(self, *parts):
+        return signature(self.config_hash, *parts)
+
+    def is_current(self, path, signature):
+        """Check (and count) whether an artifact needs to be made again
+
+        Only ever True in incremental mode, but the counts are kept
+        either way so we can say what changed."""
+        row = self.db.execute('SELECT signature FROM artifact WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None:
+            status = 'new'
+        elif row[0] == signature and os.path.exists(path):
+            status = 'unchanged'
+        else:
+            status = 'changed'
+
+        self.counts[status] += 1
+        return self.incremental and status == 'unchanged'
+
+    def record(self, path, signature):
+        self.db.execute('INSERT OR REPLACE INTO artifact VALUES (?, ?, ?)',
+                        (path, signature, self.run))
+
+    def record_fixities(self, path, fixities):
+        self.db.execute('INSERT OR REPLACE INTO fixity VALUES (?, ?)',
+                        (path, format_fixities(fixities, path)))
+
+    def fixities(self, path):
+        """The fixities (type -> value) last recorded for an artifact, if any"""
+        row = self.db.execute('SELECT fixities FROM fixity WHERE path = ?',
+                              (path,)).fetchone()
+        return parse_fixities(row[0]) if row else {}
+
+    def remove_stale(self, dry_run=False):
+        """Remove artifacts from earlier runs that weren't made this time
+
+        Folders they leave empty are removed too, up to the target folder
+        (which has this state in it)."""
+        stale = [path for path, in self.db.execute(
+            'SELECT path FROM artifact WHERE run != ?', (self.run,))]
+
+        for path in stale:
+            if dry_run:
+                logger.info(f"Dry run, not removing stale {path}")
+                continue
+
+            logger.debug(f"Removing stale {path}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.remove_empty(os.path.dirname(path))
+            self.db.execute('DELETE FROM artifact WHERE path = ?', (path,))
+            self.db.execute('DELETE FROM fixity WHERE path = ?', (path,))
+
+        self.counts['removed'] = len(stale)
+        return stale
+
+    def remove_empty(self, folder):
+        top = os.path.dirname(os.path.abspath(self.path))
+        folder = os.path.abspath(folder)
+        while folder.startswith(top + os.sep):
+            try:
+                os.rmdir(folder)
+            except OSError:  # not empty (or gone)
+                return
+            folder = os.path.dirname(folder)
+
+    def report(self):
+        return ', '.join(f"{count} {status}" for status, count in self.counts.items())
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
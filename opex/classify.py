@@ -0,0 +1,64 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Sidecars:
+    """What's in a directory, by name, from the listing the walker made
+
+    Lets a config look for the files that sit next to an asset (md5s and
+    the like) without going back to the file system for each one. Paths
+    outside the directory are checked on disk as before."""
+
+    def __init__(self, dirpath, entries):
+        self.dirpath = os.path.dirname(os.path.join(dirpath, ''))  # no trailing /
+        self.entries = {entry.name: entry for entry in entries}
+
+    def _local_name(self, path):
+        dirpath, name = os.path.split(path)
+        return name if dirpath == self.dirpath else None
+
+    def exists(self, path):
+        name = self._local_name(path)
+        if name is None:
+            return os.path.exists(path)
+        return name in self.entries
+
+    def read(self, path):
+        """The text of a sidecar, or None if there isn't one"""
+        if not self.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return f.read()
+
+
+def per_file(conf):
+    """Adapt a config's get_info_for_file to the batch interface"""
+    get_info_for_file = conf.get_info_for_file
+
+    def get_info_for_files(dirpath, entries, sidecars):
+        return [get_info_for_file(entry.path) for entry in entries]
+
+    return get_info_for_files
+
+
+def classifier(conf):
+    """(dirpath, entries) -> [(target, info)], one for each entry
+
+    Uses the config's get_info_for_files(dirpath, entries, sidecars) if
+    it has one, which is given a whole directory at a time, otherwise
+    calls its get_info_for_file(path) for each file."""
+    get_info_for_files = getattr(conf, 'get_info_for_files', None)
+    if get_info_for_files is None:
+        logger.debug("Config has no get_info_for_files, classifying a file at a time")
+        get_info_for_files = per_file(conf)
+
+    def classify(dirpath, entries):
+        results = get_info_for_files(dirpath, entries, Sidecars(dirpath, entries))
+        if len(results) != len(entries):
+            raise ValueError(f"get_info_for_files gave {len(results)} results "
+                             f"for {len(entries)} files in {dirpath}")
+        return results
+
+    return classify
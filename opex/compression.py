@@ -0,0 +1,148 @@
+import os
+import time
+import zlib
+import zipfile
+import logging
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+
+# Formats that are compressed already, so squeezing them again is wasted CPU
+INCOMPRESSIBLE = ['jpg', 'jpeg', 'jp2', 'j2k', 'jpx', 'png', 'gif', 'webp',
+                  'mp3', 'mp4', 'm4a', 'm4v', 'mov', 'mkv', 'avi', 'webm',
+                  'ogg', 'flac', 'zip', 'gz', 'bz2', 'xz', '7z', 'docx',
+                  'xlsx', 'pptx', 'epub']
+
+# Text-like formats that shrink a lot
+COMPRESSIBLE = ['xml', 'xip', 'txt', 'csv', 'tsv', 'json', 'html', 'htm',
+                'md5', 'sha1', 'sha256', 'log']
+
+# Used if the config doesn't have a COMPRESSION setting: store everything,
+# which is what we've always done
+DEFAULT_RULES = {'default': 'stored'}
+
+# Sensible starting point for configs: COMPRESSION = compression.RECOMMENDED_RULES
+RECOMMENDED_RULES = {
+    'default': 'auto',
+    **{ext: 'stored' for ext in INCOMPRESSIBLE},
+    **{ext: 'deflate:6' for ext in COMPRESSIBLE},
+}
+
+SAMPLE_SIZE = 64 * 1024
+AUTO_RATIO = 0.9  # sample must shrink to this fraction to be worth it
+AUTO_METHOD = 'deflate:6'
+
+
+def parse_method(value):
+    """Parse a rule like 'deflate:6' into (compress_type, level)"""
+    name, _, level = value.partition(':')
+    if name not in METHODS:
+        raise ValueError(f"Unknown compression method: {value}")
+    return METHODS[name], int(level) if level else None
+
+
+@dataclass
+class CompressionStats:
+    files: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    seconds: float = 0.0         # spent compressing members
+    stored_files: int = 0        # skipped, by rule or sampling
+    stored_bytes: int = 0
+    sample_bytes: int = 0        # for auto mode and estimating time saved
+    sample_seconds: float = 0.0
+
+    def add(self, other):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def record(self, zinfo, seconds):
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            self.stored_files += 1
+            self.stored_bytes += zinfo.file_size
+        else:
+            self.files += 1
+            self.bytes_in += zinfo.file_size
+            self.bytes_out += zinfo.compress_size
+            self.seconds += seconds
+
+    def seconds_saved(self):
+        """Estimate how long compressing the stored files would have taken"""
+        if self.sample_bytes and self.sample_seconds:
+            rate = self.sample_bytes / self.sample_seconds
+        elif self.bytes_in and self.seconds:
+            rate = self.bytes_in / self.seconds
+        else:
+            rate = calibrate()
+        return self.stored_bytes / rate
+
+    def report(self):
+        saved = self.bytes_in - self.bytes_out
+        return (f"Compression: {self.files} files compressed, "
+                f"{saved} bytes saved in {self.seconds:.1f}s; "
+                f"{self.stored_files} files ({self.stored_bytes} bytes) stored, "
+                f"saving ~{self.seconds_saved():.1f}s")
+
+
+def calibrate():
+    """Rough deflate throughput (bytes/sec), for estimates"""
+    data = os.urandom(1024 * 1024)
+    start = time.perf_counter()
+    zlib.compress(data, 6)
+    return len(data) / max(time.perf_counter() - start, 1e-9)
+
+
+class CompressionPolicy:
+    """Choose how to compress each pax member from its extension
+
+    rules maps (lower case) extensions to a method: 'stored', 'deflate',
+    'bzip2' or 'lzma', optionally with a level as in 'deflate:9', or
+    'auto' to compress a sample of the start of the file and only
+    compress the lot if it shrinks. The 'default' rule covers anything
+    else. Must be picklable, as it's sent to the pax workers."""
+
+    def __init__(self, rules=None):
+        rules = dict(DEFAULT_RULES if rules is None else rules)
+        self.default = rules.pop('default', 'stored')
+        self.rules = {ext.lower().lstrip('.'): rule for ext, rule in rules.items()}
+
+        # Check these now rather than part way through a run
+        for rule in [self.default, AUTO_METHOD, *self.rules.values()]:
+            if rule != 'auto':
+                parse_method(rule)
+
+    def rule_for(self, name):
+        _, _, ext = name.rpartition('.')
+        return self.rules.get(ext.lower(), self.default)
+
+    def choose(self, name, sample=None, stats=None):
+        """(compress_type, level) for a member, sample being its first bytes"""
+        rule = self.rule_for(name)
+
+        if rule == 'auto':
+            sample = bytes(sample[:SAMPLE_SIZE]) if sample else b''
+            if not sample:
+                return zipfile.ZIP_STORED, None
+
+            start = time.perf_counter()
+            ratio = len(zlib.compress(sample, 1)) / len(sample)
+            if stats:
+                stats.sample_bytes += len(sample)
+                stats.sample_seconds += time.perf_counter() - start
+
+            logger.debug(f"Sampled {name}, compresses to {ratio:.2f}")
+            rule = AUTO_METHOD if ratio < AUTO_RATIO else 'stored'
+
+        return parse_method(rule)
+
+
+def policy_from_config(conf):
+    """The compression policy set by a config's COMPRESSION, if any"""
+    return CompressionPolicy(getattr(conf, 'COMPRESSION', None))
@@ -0,0 +1,253 @@
+import hashlib
+import functools
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import opex.instrument as instrument
+
+logger = logging.getLogger(__name__)
+
+# Fixity types as Preservica names them, mapped to hashlib names
+ALGORITHMS = {
+    'MD5': 'md5',
+    'SHA-1': 'sha1',
+    'SHA-256': 'sha256',
+    'SHA-512': 'sha512',
+}
+
+DEFAULT_ALGORITHMS = ['MD5']
+HEX_DIGITS = '0123456789abcdef'
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 1024 * 1024  # 1MiB reads
+DEFAULT_BYTE_BUDGET = 64 * 1024 * 1024  # read buffers across all workers
+
+
+def algorithm_name(name):
+    """Normalise a fixity type name, e.g. sha256 -> SHA-256"""
+    normalised = name.upper().replace('-', '')
+    for algorithm in ALGORITHMS:
+        if algorithm.replace('-', '') == normalised:
+            return algorithm
+
+    raise ValueError(f"Unknown fixity algorithm: {name}")
+
+
+def hex_length(algorithm):
+    """Hex digits in a digest of a fixity type we know"""
+    return hashlib.new(ALGORITHMS[algorithm]).digest_size * 2
+
+
+def known_name(name):
+    """A fixity type as Preservica names it, if it's one we know, else as it is"""
+    try:
+        return algorithm_name(name)
+    except ValueError:
+        return name
+
+
+def xip_algorithm_name(name):
+    """XIP names algorithms without the dash, e.g. SHA-256 -> SHA256"""
+    return name.replace('-', '')
+
+
+def normalise_fixity(fixity_type, value):
+    """A fixity as lower case hex, or None if it isn't one
+
+    Sidecars often hold more than the digest, like md5sum's "hash  name"
+    and a newline, so the leading token is taken. It must be hex, and of
+    the right length for the algorithm if we know it."""
+    token = value.split(None, 1)[0].lower() if value and value.strip() else ''
+    if not token or token.strip(HEX_DIGITS):
+        return None
+    if fixity_type in ALGORITHMS and len(token) != hex_length(fixity_type):
+        return None
+    return token
+
+
+def normalise_fixities(fixities, name=None):
+    """Fixities (type -> value) normalised, dropping (and logging) any that aren't hex"""
+    normalised = {}
+    for fixity_type, value in fixities.items():
+        if (token := normalise_fixity(fixity_type, value)) is not None:
+            normalised[fixity_type] = token
+        else:
+            logger.warning(f"Ignoring {fixity_type} {value!r}{f' for {name}' if name else ''}, "
+                           f"as it isn't a hex digest")
+    return normalised
+
+
+class ByteBudget:
+    """Limit the number of bytes held in read buffers at any one time"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.limit)  # a single buffer can always have the lot
+        with self.cond:
+            self.cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+        return n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+def file_fixities(path, algorithms=DEFAULT_ALGORITHMS, chunk_size=CHUNK_SIZE,
+                  budget=None):
+    """Compute checksums of a file, reading it once in fixed size chunks
+
+    Each chunk is fed to every hasher, so asking for several algorithms
+    costs CPU but no extra I/O. Returns algorithm -> hex digest."""
+    hashers = {algorithm: hashlib.new(ALGORITHMS[algorithm])
+               for algorithm in algorithms}
+
+    if budget:
+        chunk_size = budget.acquire(chunk_size)
+
+    try:
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as f:
+            while n := f.readinto(buffer):
+                chunk = view[:n]
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+    finally:
+        if budget:
+            budget.release(chunk_size)
+
+    return {algorithm: hasher.hexdigest()
+            for algorithm, hasher in hashers.items()}
+
+
+def cacheable_fixities(fileinfo):
+    """A file's fixities that are fit to cache, as those from a config might be anything"""
+    return {fixity_type: token for fixity_type, value in fileinfo.all_fixities().items()
+            if (token := normalise_fixity(fixity_type, value)) is not None}
+
+
+class FixityEngine:
+    """Fill in missing fixities for assets using a pool of threads
+
+    Any of the requested algorithms an asset doesn't already have (from a
+    sidecar, say) are computed together in a single read of the file.
+
+    Assets are submitted as they are found, so hashing overlaps with
+    scanning, and `wait` blocks until everything submitted is done. Only
+    a count of what's pending is kept, not the futures, so memory doesn't
+    grow with the files hashed; failures are logged as they happen.
+    hashlib releases the GIL while hashing, so threads keep several
+    disks (and cores) busy. Memory is bounded by the byte budget.
+
+    With a FixityCache, unchanged files cost a lookup rather than a read,
+    and whatever we know (computed or from the config) is added to it."""
+
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS, workers=DEFAULT_WORKERS,
+                 chunk_size=CHUNK_SIZE, byte_budget=DEFAULT_BYTE_BUDGET,
+                 cache=None):
+        self.algorithms = [algorithm_name(algorithm) for algorithm in algorithms]
+        self.cache = cache
+        self.cache_hits = 0
+        self.chunk_size = chunk_size
+        self.budget = ByteBudget(byte_budget)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers),
+                                       thread_name_prefix='fixity')
+        self.done = threading.Condition()
+        self.pending = 0
+        self.computed = 0  # since the last wait
+        self.failures = 0
+
+    def normalise_types(self, fileinfo):
+        """Name a file's fixity types as Preservica does (md5 -> MD5)
+
+        A config might name them any which way, and then we wouldn't see
+        it had found one we were asked for."""
+        if fileinfo.fixity_type:
+            fileinfo.fixity_type = known_name(fileinfo.fixity_type)
+        if fileinfo.fixities:
+            fileinfo.fixities = {known_name(fixity_type): value
+                                 for fixity_type, value in fileinfo.fixities.items()}
+
+    def missing(self, fileinfo):
+        known = fileinfo.all_fixities()
+        return [algorithm for algorithm in self.algorithms
+                if algorithm not in known]
+
+    def _fill(self, fileinfo, algorithms):
+        size = fileinfo.stat.st_size if fileinfo.stat else 0
+        with instrument.stats.timer('fixity', bytes=size):
+            fileinfo.add_fixities(file_fixities(fileinfo.source_path, algorithms,
+                                                self.chunk_size, self.budget))
+        logger.debug(f"Computed {', '.join(algorithms)} for {fileinfo.source_path}")
+
+        if self.cache and fileinfo.stat:
+            self.cache.put(fileinfo.stat, cacheable_fixities(fileinfo), fileinfo.source_path)
+
+    def from_cache(self, fileinfo):
+        """Fill in whatever missing fixities the cache has for a file
+
+        Returns the cached fixities, so we can tell later if there's
+        anything new to remember."""
+        self.normalise_types(fileinfo)
+        cached = {}
+        if self.cache and fileinfo.stat:
+            cached = self.cache.get(fileinfo.stat)
+            for algorithm in self.missing(fileinfo):
+                if algorithm in cached:
+                    fileinfo.add_fixities({algorithm: cached[algorithm]})
+                    self.cache_hits += 1
+        return cached
+
+    def remember(self, fileinfo, cached=None):
+        """Add what we know about a file to the cache, if it's news"""
+        if self.cache and fileinfo.stat:
+            if cached is None:
+                cached = self.cache.get(fileinfo.stat)
+            known = cacheable_fixities(fileinfo)
+            if any(cached.get(algorithm) != value for algorithm, value in known.items()):
+                self.cache.put(fileinfo.stat, known, fileinfo.source_path)
+
+    def submit(self, fileinfo):
+        """Start filling in a file's missing fixities
+
+        Returns the future doing so, or None if there was nothing to do.
+        Errors are logged as it finishes, and needn't be looked for."""
+        cached = self.from_cache(fileinfo)
+
+        if algorithms := self.missing(fileinfo):
+            with self.done:
+                self.pending += 1
+            future = self.pool.submit(self._fill, fileinfo, algorithms)
+            future.add_done_callback(functools.partial(self._finished, fileinfo))
+            return future
+        else:
+            self.remember(fileinfo, cached)
+            return None
+
+    def _finished(self, fileinfo, future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Unable to compute fixity for {fileinfo.source_path}: {error}")
+        with self.done:
+            self.pending -= 1
+            if error is None:
+                self.computed += 1
+            else:
+                self.failures += 1
+            self.done.notify_all()
+
+    def wait(self):
+        """Wait for everything submitted, returning how many were filled in since last time"""
+        with self.done:
+            self.done.wait_for(lambda: not self.pending)
+            computed, self.computed = self.computed, 0
+        return computed
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
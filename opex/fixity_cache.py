@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Kept in the target folder unless asked otherwise, so upload.py can find it
+DEFAULT_FILENAME = '.fixity_cache.sqlite'
+
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fixity (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    value TEXT NOT NULL,
+    path TEXT,
+    PRIMARY KEY (dev, ino, algorithm)
+)
+"""
+
+
+class FixityCache:
+    """Fixities we've seen before, keyed on file identity
+
+    A file is identified by (device, inode) and an entry is only valid if
+    the size and modification time still match, so a changed file is
+    simply a miss (and its entries are replaced when recomputed). Safe to
+    share between threads, and between processes thanks to WAL mode."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, stat):
+        """Cached fixities (algorithm -> value) for a file's stat"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT algorithm, value FROM fixity '
+                'WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            return dict(rows.fetchall())
+
+    def put(self, stat, fixities, path=None):
+        with self.lock:
+            # Anything recorded for an older version of this file is stale
+            self.db.execute(
+                'DELETE FROM fixity WHERE dev = ? AND ino = ? '
+                'AND (size != ? OR mtime_ns != ?)',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO fixity VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                  algorithm, value, path)
+                 for algorithm, value in fixities.items()])
+
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.db.commit()
+                self.pending = 0
+
+    def lookup(self, path):
+        """Cached fixities for the file at path, costing just a stat"""
+        try:
+            return self.get(os.stat(path))
+        except OSError:
+            return {}
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def open_cache(path):
+    """Open a cache, or return None (with a warning) if we can't"""
+    try:
+        return FixityCache(path)
+    except sqlite3.Error as e:
+        logger.warning(f"Unable to open fixity cache {path}: {e}")
+        return None
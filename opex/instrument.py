@@ -0,0 +1,187 @@
+import json
+import time
+import functools
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """Totals for one stage: time spent, items and bytes"""
+
+    __slots__ = ('name', 'seconds', 'count', 'bytes')
+
+    def __init__(self, name, seconds=0.0, count=0, bytes=0):
+        self.name = name
+        self.seconds = seconds
+        self.count = count
+        self.bytes = bytes
+
+    def as_dict(self):
+        result = {'seconds': self.seconds, 'count': self.count, 'bytes': self.bytes}
+        if self.seconds:
+            result['per_second'] = self.count / self.seconds
+            result['bytes_per_second'] = self.bytes / self.seconds
+        return result
+
+
+class Timer:
+    """Times a block, adding it to a stage. Set count and bytes as you go"""
+
+    __slots__ = ('stats', 'name', 'count', 'bytes', 'start')
+
+    def __init__(self, stats, name, count, bytes):
+        self.stats = stats
+        self.name = name
+        self.count = count
+        self.bytes = bytes
+
+    def __enter__(self):
+        for hook in self.stats.hooks:
+            hook.start(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.stats.add(self.name, self.count, self.bytes, seconds)
+        for hook in self.stats.hooks:
+            hook.stop(self.name, seconds)
+
+
+class NullTimer:
+    """What timer gives when we're not collecting, so costs next to nothing"""
+
+    count = bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        pass  # shared, so ignore count and bytes
+
+
+NULL_TIMER = NullTimer()
+
+
+class Hook:
+    """Base for hooks, to run a profiler (say) around each timed stage
+
+    start and stop are called in whichever thread runs the stage, so
+    may overlap. Hooks only see stages run in this process: pax workers'
+    totals are merged in, but their hooks aren't called. A config can
+    set STATS_HOOKS to a list of them."""
+
+    def start(self, name):
+        pass
+
+    def stop(self, name, seconds):
+        pass
+
+
+class Stats:
+    """Per-stage timers and counters
+
+    Disabled (the default) everything is a no-op, so code can be
+    instrumented freely. Stages are added to from several threads, and
+    worker processes return their own Stats to be merged."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}  # name -> Stage, in the order first seen
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def enable(self, hooks=()):
+        self.enabled = True
+        self.hooks.extend(hooks)
+        self.started = time.perf_counter()
+
+    def timer(self, name, count=1, bytes=0):
+        """Context manager timing a block as part of a stage"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, count, bytes)
+
+    def add(self, name, count=1, bytes=0, seconds=0.0):
+        """Add to a stage's totals, e.g. a count with no time"""
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.seconds += seconds
+            stage.count += count
+            stage.bytes += bytes
+
+    def take(self):
+        """Hand over what we have so far, starting again from nothing"""
+        taken = Stats(self.enabled)
+        with self.lock:
+            taken.stages, self.stages = self.stages, {}
+        return taken
+
+    def merge(self, other):
+        """Add another Stats' totals (e.g. from a worker process) to ours"""
+        for stage in other.stages.values():
+            self.add(stage.name, stage.count, stage.bytes, stage.seconds)
+
+    def __getstate__(self):
+        # Sent back from worker processes without the lock or hooks
+        return {'enabled': self.enabled, 'stages': self.stages}
+
+    def __setstate__(self, state):
+        self.__init__(state['enabled'])
+        self.stages = state['stages']
+
+    def as_dict(self):
+        return {'elapsed': time.perf_counter() - self.started,
+                'stages': {name: stage.as_dict() for name, stage in self.stages.items()}}
+
+    def report(self, format='text'):
+        if format == 'json':
+            return json.dumps(self.as_dict(), indent=2)
+
+        lines = [f"{'Stage':20} {'Seconds':>9} {'Count':>9} {'Per sec':>10} "
+                 f"{'MiB':>10} {'MiB/s':>8}"]
+        for name, stage in self.stages.items():
+            rate = f"{stage.count / stage.seconds:10.1f}" if stage.seconds else f"{'':10}"
+            mib = stage.bytes / 2**20
+            mib_rate = f"{mib / stage.seconds:8.1f}" if stage.seconds and stage.bytes else f"{'':8}"
+            lines.append(f"{name:20} {stage.seconds:9.3f} {stage.count:9} {rate} "
+                         f"{mib:10.1f} {mib_rate}")
+        lines.append(f"Elapsed {time.perf_counter() - self.started:.3f}s. "
+                     f"Stages may overlap, or run in several threads or processes at once.")
+        return '\n'.join(lines)
+
+    def write_report(self, format='text', path=None):
+        report = self.report(format)
+        if path:
+            with open(path, 'w') as f:
+                f.write(report + '\n')
+            logger.info(f"Stats written to {path}")
+        else:
+            print(report)
+
+
+# Shared by everything in this process
+stats = Stats()
+
+
+def timed(name):
+    """Decorator timing every call of a function as a stage"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return function(*args, **kwargs)
+            with Timer(stats, name, 1, 0):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,66 @@
+import os
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How generated files are arranged in the target folder: in folders
+# mirroring the collection, in folders named by a hash of the collection
+# folder's path, or all in the target folder itself (as we used to)
+TREE = 'tree'
+HASHED = 'hashed'
+FLAT = 'flat'
+LAYOUTS = [TREE, HASHED, FLAT]
+DEFAULT_LAYOUT = TREE
+
+
+class Layout:
+    """Where the opexes and paxes made for each Dir go
+
+    In the tree layout a dir's files go in a folder with its upload path,
+    so the target folder looks just like the upload. In the hashed one
+    they go two folders down, whatever the depth of the collection, with
+    at most 256 folders at the top, for file systems that struggle with
+    long paths. Either way files from different dirs never share a
+    folder. In the flat layout they all do, so files with the same name
+    from different dirs overwrite each other, which is reported. To spot
+    that, every filename is kept, in names (anything with a dict's
+    setdefault, like spool.SpooledNames) if given, else in memory."""
+
+    def __init__(self, target_dir, kind=DEFAULT_LAYOUT, create=True, names=None):
+        if kind not in LAYOUTS:
+            raise ValueError(f"Unknown layout: {kind}")
+        self.target_dir = target_dir
+        self.kind = kind
+        self.create = create  # the folders, unless nothing's written (streaming)
+        self._last = (None, None)  # dir, folder: a dir's files are made together
+        self._flat_names = None  # filename -> dir path
+        if kind == FLAT:
+            self._flat_names = {} if names is None else names
+
+    def folder(self, dir):
+        last_dir, folder = self._last
+        if dir is last_dir:
+            return folder
+
+        if self.kind == TREE:
+            folder = os.path.join(self.target_dir, *dir.path().split('/')[1:])
+        elif self.kind == HASHED:
+            digest = hashlib.sha1(dir.path().encode('utf-8')).hexdigest()
+            folder = os.path.join(self.target_dir, digest[:2], digest[2:])
+        else:
+            folder = self.target_dir
+
+        if self.create:
+            os.makedirs(folder, exist_ok=True)
+        self._last = (dir, folder)
+        return folder
+
+    def path(self, dir, filename):
+        """Path for a file made for dir"""
+        if self._flat_names is not None:
+            where = self._flat_names.setdefault(filename, dir.path())
+            if where != dir.path():
+                logger.error(f"{filename} for {dir.path()} overwrites the one for "
+                             f"{where or '/'}, use another layout to keep both")
+        return os.path.join(self.folder(dir), filename)
@@ -1,28 +1,412 @@
-import importlib.util
 import os
+import sys
+import asyncio
+import hashlib
 import argparse
 import os.path
-from opex.util import Dir, AssetInfo, load_module, pick_name
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from opex.util import Dir, AssetInfo, FileStat, InlineExecutor, load_config, pick_name
 import opex.opex_generator as opex_generator
 import opex.pax_generator as pax_generator
+import opex.walker as walker
+import opex.layout as layouts
+import opex.classify as classify
+import opex.fixity as fixity
+import opex.fixity_cache as fixity_cache
+import opex.compression as compression
+import opex.build_state as build_state
+import opex.spool as spool
+import opex.pipeline as pipeline
+import opex.upload_plan as upload_plan_file
+import opex.instrument as instrument
+from opex.instrument import stats
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+def init_worker(level, format, collect_stats=False):
+    # Worker processes don't inherit our logging set up
+    logging.basicConfig(level=level, format=format)
+    if collect_stats:
+        stats.enable()
+
+
+def write_opex(data, path, state, outputs=None):
+    """Write an opex, unless it's already there and unchanged
+
+    If we're streaming, outputs collects the opex (by path) instead."""
+    if outputs is not None:
+        outputs[path] = data
+        return
+
+    signature = build_state.signature(data)  # the content says it all
+
+    if not state.is_current(path, signature):
+        with stats.timer('opex write', bytes=len(data)):
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    state.record(path, signature)
+
+
+def opex_info(filename, path, data):
+    """Info for an opex we made, with its MD5 so the upload can be checked"""
+    return AssetInfo(filename, None, path, False, 'MD5', hashlib.md5(data).hexdigest(), True)
+
+
+def write_dir_opex(dir, conf, layout, state, outputs=None):
+    """Write the opex for a (finished) dir and add it to the dir's files"""
+    dirname = dir.name
+
+    if dir.parent:
+        opex_filename = dirname + '.opex'
+    else:
+        # We are creating an opex for the root
+        # Call it 'root.opex'
+        opex_filename = 'root.opex'
+
+    logger.debug(f"Making opex for dir {dirname}")
+    opex_data = opex_generator.render_dir(dir, conf)
+    opex_filepath = layout.path(dir, opex_filename)
+    write_opex(opex_data, opex_filepath, state, outputs)
+
+    logger.debug(f"Adding {opex_filename} to {dir}")
+    dir.add_file(opex_info(opex_filename, opex_filepath, opex_data))
+
+
+def config_hash(conf_file, *settings):
+    """Hash of the config, and any options, that affect what we generate"""
+    with open(conf_file, 'rb') as f:
+        return build_state.signature(f.read(), *settings)
+
+
+class Builder:
+    """Makes the paxes and opexes for each Dir, bottom up
+
+    start sets a dir's paxes (and any missing fixities) going in the
+    background; finish waits for them and writes the opexes, leaving the
+    dir listing what is to be uploaded. Dirs must be finished after their
+    subdirs, so the dir opexes are there to list.
+
+    Without dir_opexes (as for a shard) only the files' opexes are
+    written, the dirs' being left for whatever has all their contents."""
+
+    def __init__(self, conf, layout, state, fixity_engine, pax_pool,
+                 fixity_algorithms=(), compression_policy=None, dry_run=False,
+                 stream_spool=None, dir_opexes=True):
+        self.conf = conf
+        self.dir_opexes = dir_opexes
+        self.layout = layout
+        self.state = state
+        self.fixity_engine = fixity_engine
+        self.pax_pool = pax_pool
+        self.fixity_algorithms = fixity_algorithms
+        self.compression_policy = compression_policy
+        self.dry_run = dry_run
+        self.compression_stats = compression.CompressionStats()
+        self.paxes = 0
+        self.computed = 0  # fixities
+
+        # If streaming, opexes are spooled (path -> bytes) and paxes are
+        # made as they are uploaded (zip path -> what goes in them)
+        self.outputs = stream_spool.outputs if stream_spool else None
+        self.streamed_paxes = stream_spool.paxes if stream_spool else {}
+
+    def start(self, dir):
+        """Start building the paxes for a dir, returning (jobs, fixities)
+
+        jobs is asset_id -> future, each giving (pax info, files,
+        compression stats, worker stats). Files going into a pax are
+        hashed as they are copied in; the rest by the fixity engine, and
+        fixities are its futures for them."""
+        state = self.state
+        jobs = {}
+        fixities = []
+        for asset_id, files in dir.files.items():
+            if len(files) > 1:  # More than one file has this asset id
+                logger.debug(f"{asset_id} in dir {dir.name} has more than one file and needs to be a pax")
+                for info in files:
+                    self.fixity_engine.from_cache(info)
+                # We will generate a pax
+                pax_prefix = pick_name(asset_id, files)  # name pax based on filenames or id
+                pax_filename = pax_prefix + '.pax.zip'
+                zip_path = self.layout.path(dir, pax_filename)
+                opex_filepath = self.layout.path(dir, pax_filename + '.opex')
+
+                # Computed fixities follow from size and mtime, so only the
+                # config's fixity is an input in its own right
+                signature = state.signature('pax', asset_id, pax_prefix, [
+                    (info.source_path, pax_generator.zip_location(info),
+                     info.stat.st_size, info.stat.st_mtime_ns, info.fixity_type, info.fixity)
+                    for info in files])
+
+                if self.outputs is not None:
+                    self.streamed_paxes[zip_path] = (asset_id, files, pax_prefix)
+                    pax_info = AssetInfo(pax_filename, asset_id, zip_path,
+                                         False, None, None, False)
+                    jobs[asset_id] = Future()
+                    jobs[asset_id].set_result((pax_info, files, compression.CompressionStats(),
+                                               instrument.Stats()))
+                    continue
+
+                # Both are counted, as both are recorded
+                zip_current = state.is_current(zip_path, signature)
+                opex_current = state.is_current(opex_filepath, signature)
+                if zip_current and opex_current:
+                    logger.debug(f"{zip_path} is up to date")
+                    pax_info = AssetInfo(pax_filename, asset_id, zip_path,
+                                         False, None, None, False,
+                                         fixities=state.fixities(zip_path) or None)
+                    # As from a run before they were recorded
+                    if future := self.fixity_engine.submit(pax_info):
+                        fixities.append(future)
+                    jobs[asset_id] = Future()
+                    jobs[asset_id].set_result((pax_info, files, compression.CompressionStats(),
+                                               instrument.Stats()))
+                else:
+                    jobs[asset_id] = self.pax_pool.submit(pax_generator.build_pax,
+                                                          asset_id, files, zip_path, pax_prefix,
+                                                          opex_filepath, self.fixity_algorithms,
+                                                          self.dry_run, self.compression_policy)
+
+                if not self.dry_run:
+                    state.record(zip_path, signature)
+                    state.record(opex_filepath, signature)
+            else:
+                # if config didn't find one
+                if future := self.fixity_engine.submit(files[0]):
+                    fixities.append(future)
+
+        self.paxes += len(jobs)
+        return jobs, fixities
+
+    def wait_for_fixities(self):
+        with stats.timer('fixity wait', count=0):
+            self.computed += self.fixity_engine.wait()
+
+    def finish(self, dir, jobs):
+        """Write the opexes for a dir, once its paxes and fixities are done"""
+        conf = self.conf
+        logger.debug(f"Making opexes and paxes for {dir}")
+
+        dir_contents = list(dir.files.items())  # defensive copy
+
+        for asset_id, files in dir_contents:
+
+            if not asset_id:
+                logger.warn(f'Skipping non-asset files: {files}')
+
+            if asset_id in jobs:
+                # Wait for the pax, and its opex, to be built
+                with stats.timer('pax wait'):
+                    pax_info, pax_files, pax_stats, worker_stats = jobs[asset_id].result()
+                self.compression_stats.add(pax_stats)
+                stats.merge(worker_stats)
+                for info in pax_files:
+                    self.fixity_engine.remember(info)
+                if pax_info.fixities and self.outputs is None and not self.dry_run:
+                    self.state.record_fixities(pax_info.source_path, pax_info.fixities)
+
+                # Files are now all in the pax zip, so we remove them from the dir
+                dir.files.pop(asset_id)
+
+                # And now add the pax file to replace them
+                dir.add_file(pax_info)
+
+                opex_filename = pax_info.filename + '.opex'
+                opex_filepath = pax_info.source_path + '.opex'
+                if self.outputs is not None:
+                    # Without the zip's fixity, as it isn't made yet
+                    opex_data = opex_generator.render_file(pax_info, conf)
+                    write_opex(opex_data, opex_filepath, self.state, self.outputs)
+                    dir.add_file(opex_info(opex_filename, opex_filepath, opex_data))
+                else:
+                    # Written by the pax's worker, so checked as it's uploaded
+                    dir.add_file(AssetInfo(opex_filename, None, opex_filepath,
+                                           False, None, None, True))
+            else:
+                logger.debug(f"{asset_id} in dir {dir.name} doesn't need a pax")
+
+                info = files[0]  # only 1 file with this id
+                logger.debug(f"Sole file for asset {asset_id}: {info.filename}")
+                opex_data = opex_generator.render_file(info, conf)
+                opex_filename = info.filename + '.opex'
+                opex_filepath = self.layout.path(dir, opex_filename)
+                write_opex(opex_data, opex_filepath, self.state, self.outputs)
+                dir.add_file(opex_info(opex_filename, opex_filepath, opex_data))
+
+        if self.dir_opexes:
+            write_dir_opex(dir, conf, self.layout, self.state, self.outputs)
+
+    def report(self):
+        stats.add('fixity cache hits', self.fixity_engine.cache_hits)
+        logger.info(f"Computed {self.computed} missing fixities, "
+                    f"{self.fixity_engine.cache_hits} found in cache")
+        if self.fixity_engine.failures:
+            logger.warning(f"Unable to compute {self.fixity_engine.failures} fixities")
+
+        if self.compression_stats.files:
+            logger.info(self.compression_stats.report())
+        elif self.paxes:
+            logger.debug(self.compression_stats.report())
+
+
+def upload_entries(dir):
+    """[source, target, fixities] for everything a (finished) dir has to upload"""
+    path = dir.path()
+    return [[fileinfo.source_path, path + '/' + fileinfo.filename,
+             upload_plan_file.format_fixities(fileinfo.all_fixities(), fileinfo.source_path)]
+            for asset_id, files in dir.files.items()
+            for fileinfo in files]
+
+
+def scan(sources, tree, classify_dir, scan_workers=walker.DEFAULT_WORKERS,
+         classify_workers=1, queue_size=pipeline.DEFAULT_QUEUE_SIZE, keep=None):
+    """Find and classify everything in the sources, adding it to tree
+
+    A pipeline: the walker lists folders in its threads, they are
+    classified in classify_workers threads, and what's found is added to
+    the tree (or spool) in the order the walker found it. If given,
+    keep(target, info) says which files we want (e.g. for a shard)."""
+    with stats.timer('scan', count=0) as scan_timer:
+
+        def classify_folder(listing):
+            root, entries = listing
+            logger.debug(f"In folder {root}")
+            with stats.timer('classify', count=len(entries)):
+                return entries, classify_dir(root, entries)
+
+        def collect(classified):
+            entries, results = classified
+            scan_timer.count += len(entries)
+            for entry, (target, info) in zip(entries, results):
+                if info and keep and not keep(target, info):
+                    logger.debug(f"Leaving {entry.name} to another shard")
+                elif info:
+                    # We have something to upload
+                    logger.debug(f"File will be uploaded: {entry.name} (Access? {info.is_access})")
+                    if info.stat is None:
+                        info.stat = FileStat.of(entry.stat())  # already cached by the walker
+                    tree.add(target, info)
+                else:
+                    logger.debug(f"Ignoring file: {entry.name}")
+
+        pipeline.run(walker.walk(sources, scan_workers), [
+            pipeline.Stage('classify', classify_folder, classify_workers, ordered=True,
+                           in_thread=classify_workers > 1),
+            pipeline.Stage('collect', collect),
+        ], queue_size, source_in_thread=True)
+
+
+def build(dirs, builder, window, queue_size=pipeline.DEFAULT_QUEUE_SIZE, finished=None):
+    """Build everything for dirs (bottom up), as a pipeline
+
+    Each dir is started in turn, setting its paxes and fixities going,
+    then up to window of them wait for those at once, and they are
+    finished in the order they were started. finished(dir) is called
+    after each, if given."""
+
+    def start(dir):
+        return (dir, *builder.start(dir))
+
+    async def wait(started):
+        dir, jobs, fixities = started
+        # Failures are for finish (paxes) and the fixity engine to report
+        await asyncio.gather(*[asyncio.wrap_future(future)
+                               for future in [*jobs.values(), *fixities]],
+                             return_exceptions=True)
+        return started
+
+    def finish(started):
+        dir, jobs, fixities = started
+        builder.finish(dir, jobs)
+        if finished:
+            finished(dir)
+
+    pipeline.run(dirs, [
+        pipeline.Stage('start', start),
+        pipeline.Stage('build', wait, window, ordered=True),
+        pipeline.Stage('write', finish),
+    ], queue_size)
+
+
 def main(argv):
     argv.pop(0)  # why do I need this?
 
     parser = argparse.ArgumentParser(prog='to_opex',
                                      description='Tool to prepare collections for import to preservica')
-    parser.add_argument('-c', '--config', required=True, help='Config file')
+    parser.add_argument('-c', '--config', required=True,
+                        help='Config file: rules (.toml) or a Python module')
     parser.add_argument('-t', '--target', required=True, help='Target folder')
     parser.add_argument('source', nargs='+', help='Source folder(s)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Explain what is happening')
     parser.add_argument('-d', '--dry-run', action='store_true',
                         help="Don't actually perform any actions, for testing")
+    parser.add_argument('-j', '--scan-workers', type=int, default=walker.DEFAULT_WORKERS,
+                        help=f'Threads used to scan source folders (default {walker.DEFAULT_WORKERS})')
+    parser.add_argument('--classify-workers', type=int, default=1,
+                        help='Threads used to classify files with the config (default 1)')
+    parser.add_argument('--fixity', default=','.join(fixity.DEFAULT_ALGORITHMS),
+                        help=f'Comma separated algorithms for fixities, from {", ".join(fixity.ALGORITHMS)} '
+                             f'(default {",".join(fixity.DEFAULT_ALGORITHMS)})')
+    parser.add_argument('--no-fixity', action='store_true',
+                        help="Don't compute fixities missing from the config")
+    parser.add_argument('--fixity-workers', type=int, default=fixity.DEFAULT_WORKERS,
+                        help=f'Threads used to compute fixities (default {fixity.DEFAULT_WORKERS})')
+    parser.add_argument('--fixity-budget', type=int, default=fixity.DEFAULT_BYTE_BUDGET // 2**20,
+                        help=f'MiB of read buffers for computing fixities '
+                             f'(default {fixity.DEFAULT_BYTE_BUDGET // 2**20})')
+    parser.add_argument('--fixity-cache',
+                        help=f'Fixity cache file, shareable between runs and targets '
+                             f'(default {fixity_cache.DEFAULT_FILENAME} in target)')
+    parser.add_argument('--no-fixity-cache', action='store_true',
+                        help="Don't cache fixities between runs")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Only regenerate what has changed since the last run, "
+                             "and remove what is no longer needed")
+    parser.add_argument('--stream-bucket',
+                        help='Upload straight to this bucket (defined in the S3 config) rather than '
+                             'writing opexes and paxes to the target folder. A streamed pax has its '
+                             'xip as the last member rather than the first, as it can\'t be gone '
+                             'back to once the files are in, and its opex has no fixity for it, as '
+                             'opexes go before the paxes are made. S3 still checks each of its parts')
+    parser.add_argument('--stream-container', help='Container to stream to')
+    parser.add_argument('--s3-config', default='~/S3.ini',
+                        help='S3 config file for streaming (default ~/S3.ini)')
+    parser.add_argument('--stream-workers', type=int, default=8,
+                        help='Files to stream at once (default 8)')
+    parser.add_argument('--part-size', type=int, default=16,
+                        help='MiB per part when streaming paxes, one held in memory per worker '
+                             '(default 16)')
+    parser.add_argument('--pax-workers', type=int, default=os.cpu_count(),
+                        help=f'Processes used to build paxes, 1 to build them in this process '
+                             f'(default {os.cpu_count()})')
+    parser.add_argument('--build-window', type=int,
+                        help='Folders whose paxes and fixities are built at once '
+                             '(default twice the pax workers)')
+    parser.add_argument('--queue-size', type=int, default=pipeline.DEFAULT_QUEUE_SIZE,
+                        help=f'Folders queued between each stage, holding up earlier stages '
+                             f'when full (default {pipeline.DEFAULT_QUEUE_SIZE})')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='Keep the scan on disk rather than in memory, and build a folder '
+                             'at a time, so memory use doesn\'t grow with the collection')
+    parser.add_argument('--layout', choices=layouts.LAYOUTS, default=layouts.DEFAULT_LAYOUT,
+                        help='Where generated files go: tree, in folders like the upload\'s; '
+                             'hashed, in two levels of folders named by hash; flat, all in the '
+                             f'target folder (default {layouts.DEFAULT_LAYOUT})')
+    parser.add_argument('--shard',
+                        help='Build only this share of the collection, e.g. 2/4 for the second '
+                             'of four, to be put together with merge_shards.py')
+    parser.add_argument('--shard-by', choices=['asset', 'folder'], default='asset',
+                        help='Share out assets by id, or whole top level folders (default asset)')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Report time, counts and bytes for each stage at the end, '
+                             'as text (the default) or json')
+    parser.add_argument('--stats-file', help='Write the --stats report here rather than print it')
 
     arguments = parser.parse_args(argv)
 
@@ -31,12 +415,46 @@ def main(argv):
     verbose = arguments.verbose
     dry_run = arguments.dry_run
     target_dir = arguments.target
+    scan_workers = arguments.scan_workers
+    pax_workers = arguments.pax_workers
+    incremental = arguments.incremental
+    streaming = arguments.stream_bucket is not None
+    low_memory = arguments.low_memory
+    build_window = arguments.build_window or max(1, pax_workers) * 2
+    queue_size = max(1, arguments.queue_size)
+
+    if streaming and not arguments.stream_container:
+        parser.error('--stream-container is needed to stream')
+
+    shard = None
+    if arguments.shard:
+        if streaming:
+            parser.error("A shard can't stream, as its folders' opexes are made by the merge")
+        # Only needed for sharding, so only imported for it
+        import opex.shards as shards
+        try:
+            shard = shards.Shard.parse(arguments.shard, arguments.shard_by)
+        except ValueError as e:
+            parser.error(str(e))
+    if arguments.no_fixity:
+        fixity_algorithms = []
+    else:
+        fixity_algorithms = [fixity.algorithm_name(name) for name in arguments.fixity.split(',')]
 
     print(f"conf_file: {conf_file}")
     print(f"sources: {', '.join(sources)}")
     print(f"verbose: {verbose}")
     print(f"dry_run: {dry_run}")
     print(f"target_dir: {target_dir}")
+    print(f"layout: {arguments.layout}")
+    print(f"scan_workers: {scan_workers}")
+    print(f"fixity: {', '.join(fixity_algorithms)}")
+    print(f"pax_workers: {pax_workers}")
+    print(f"build_window: {build_window}")
+    print(f"incremental: {incremental}")
+    print(f"streaming: {streaming}")
+    print(f"low_memory: {low_memory}")
+    print(f"shard: {shard}")
 
     format = '%(levelname)s\t%(message)s'
     if verbose:
@@ -45,105 +463,184 @@ def main(argv):
         logging.basicConfig(level=logging.INFO, format=format)
 
     logger.debug(f"Loading config file: {conf_file}")
-    conf = load_module(conf_file, "opex_config")
+    conf = load_config(conf_file)
+    compression_policy = compression.policy_from_config(conf)
+    if arguments.stats:
+        stats.enable(getattr(conf, 'STATS_HOOKS', []))
 
     if not os.path.exists(target_dir):
         logger.info(f'Creating target directory: {target_dir}')
         os.makedirs(target_dir)
 
-    to_upload = Dir()
+    if low_memory:
+        tree = spool.Spool(os.path.join(target_dir, spool.DEFAULT_FILENAME))
+    else:
+        tree = Dir()
 
-    for source in sources:
-        logger.debug(f"In source {source}")
-        for root, dirs, files in os.walk(source):
+    # What we made last time, and from what
+    state = build_state.BuildState(os.path.join(target_dir, build_state.DEFAULT_FILENAME),
+                                   config_hash(conf_file, fixity_algorithms,
+                                               vars(compression_policy)),
+                                   incremental)
 
-            for file in files:
-                target, info = conf.get_info_for_file(os.path.join(root, file))
+    cache = None
+    if fixity_algorithms and not arguments.no_fixity_cache:
+        cache_path = arguments.fixity_cache or os.path.join(target_dir, fixity_cache.DEFAULT_FILENAME)
+        logger.debug(f"Using fixity cache: {cache_path}")
+        cache = fixity_cache.open_cache(cache_path)
 
-                if info:
-                    # We have something to upload
-                    logger.debug(f"File will be uploaded: {file} (Access? {info.is_access})")
-                    to_upload.add(target, info)
-                else:
-                    logger.debug(f"Ignoring file: {file}")
+    # Computes fixities the config didn't find (if we want any)
+    fixity_engine = fixity.FixityEngine(fixity_algorithms, arguments.fixity_workers,
+                                        byte_budget=arguments.fixity_budget * 2**20,
+                                        cache=cache)
 
-    # We go through subdirs in reverse order (bottom up)
-    # to ensure dir opex is present in parent
-    for dirname, dir in to_upload.all_subdirs(top_down=False):
-        logger.debug(f"Making opexes and paxes for {dir}")
+    scan(sources, tree, classify.classifier(conf), scan_workers,
+         arguments.classify_workers, queue_size, shard.keeps if shard else None)
 
-        dir_contents = list(dir.files.items())  # defensive copy
+    if pax_workers > 1:
+        # forkserver, since the fixity threads are running
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        else:
+            mp_context = None
+        pax_pool = ProcessPoolExecutor(max_workers=pax_workers, mp_context=mp_context,
+                                       initializer=init_worker,
+                                       initargs=(logging.getLogger().level, format,
+                                                 stats.enabled))
+    else:
+        pax_pool = InlineExecutor()
 
-        for asset_id, files in dir_contents:
+    # Nothing's written to the target folder if streaming, but the spool
+    stream_spool = (spool.StreamSpool(os.path.join(target_dir, spool.STREAM_FILENAME))
+                    if streaming else None)
+    layout = layouts.Layout(target_dir, arguments.layout, create=not streaming,
+                            names=tree.flat_names() if low_memory else None)
+    builder = Builder(conf, layout, state, fixity_engine, pax_pool, fixity_algorithms,
+                      compression_policy, dry_run, stream_spool, dir_opexes=shard is None)
 
-            if not asset_id:
-                logger.warn(f'Skipping non-asset files: {files}')
+    # A shard lists what it made for the merge, rather than an upload plan
+    manifest = shards.ManifestWriter(target_dir, shard) if shard else None
 
-            if len(files) > 1:  # More than one file has this asset id
-                logger.debug(f"{asset_id} in dir {dir.name} has more than one file and needs to be a pax")
-                # We will generate a pax
-                pax_prefix = pick_name(asset_id, files)  # name pax based on filenames or id
-                pax_filename = pax_prefix + '.pax.zip'
-                zip_path = os.path.join(target_dir, pax_filename)
-                pax_generator.create_pax(asset_id, files, zip_path, pax_prefix, dry_run)
+    if low_memory:
+        def finished(dir):
+            if manifest:
+                manifest.add(dir)
+            tree.add_plan(dir, upload_entries(dir))
+            dir.release()
 
-                # Files are now all in the pax zip, so we remove them from the dir
-                dir.files.pop(asset_id)
+        # Dirs only hold their files while being built
+        build(tree.bottom_up(), builder, build_window, queue_size, finished)
+        upload_plan = tree.upload_plan()
+    else:
+        # We go through subdirs in reverse order (bottom up)
+        # to ensure dir opex is present in parent
+        build((dir for dirname, dir in tree.all_subdirs(top_down=False)),
+              builder, build_window, queue_size, manifest.add if manifest else None)
+        upload_plan = [entry for dirname, dir in tree.all_subdirs()
+                       for entry in upload_entries(dir)]
+    builder.wait_for_fixities()
 
-                # And now add the pax file to replace them
-                pax_info = AssetInfo(pax_filename, asset_id, zip_path,
-                                    False, None, None, False)
-                dir.add_file(pax_info)
+    pax_pool.shutdown()
+    builder.report()
+    fixity_engine.close()
+    if cache:
+        cache.close()
 
-                opex_data = opex_generator.output_file(pax_info, conf)
-                opex_filename = pax_info.filename + '.opex'
-                opex_filepath = os.path.join(target_dir, opex_filename)
-                opex_data.write(opex_filepath)
-                opex_info = AssetInfo(opex_filename, None, opex_filepath,
-                                    False, None, None, True)
-                dir.add_file(opex_info)
-            else:
-                logger.debug(f"{asset_id} in dir {dir.name} doesn't need a pax")
+    if streaming:
+        if low_memory:
+            sorted_plan = tree.sorted_upload_plan()
+        else:
+            sorted_plan = sorted(upload_plan, key=upload_plan_file.order_key)
+        try:
+            stream(sorted_plan, builder.outputs, builder.streamed_paxes, arguments, target_dir,
+                   fixity_algorithms, compression_policy, dry_run)
+        finally:
+            stream_spool.close()
+            if low_memory:
+                tree.close()
+        state.close()
+        if arguments.stats:
+            stats.write_report(arguments.stats, arguments.stats_file)
+        return
 
-                info = files[0]  # only 1 file with this id
-                logger.debug(f"Sole file for asset {asset_id}: {info.filename}")
-                opex_data = opex_generator.output_file(info, conf)
-                opex_filename = info.filename + '.opex'
-                opex_filepath = os.path.join(target_dir, opex_filename)
-                opex_data.write(opex_filepath)
-                opex_info = AssetInfo(opex_filename, None, opex_filepath,
-                                    False, None, None, True)
-                dir.add_file(opex_info)
+    if shard:
+        manifest.close()
+        if low_memory:
+            tree.close()
+    else:
+        uploads_file = os.path.join(target_dir, "to_upload.txt")
+        plan_path = os.path.join(target_dir, upload_plan_file.PLAN_FILENAME)
 
-        # Now create opex for dir
+        with open(uploads_file, "w") as f:
+            for source, dest, fixities in upload_plan:
+                f.write(source)
+                f.write("\t")
+                f.write(dest)
+                f.write('\n')
 
-        if dir.parent:
-            opex_filename = dirname + '.opex'
+        # The same again, but sorted ready for upload.py to stream
+        if low_memory:
+            upload_plan_file.write_plan(plan_path, tree.sorted_upload_plan())
+            tree.close()
         else:
-            # We are creating an opex for the root
-            # Call it 'root.opex'
-            opex_filename = 'root.opex'
-
-        logger.debug(f"Making opex for dir {dirname}")
-        opex_data = opex_generator.output_dir(dir, conf)
-        opex_filename = opex_filename
-        opex_filepath = os.path.join(target_dir, opex_filename)
-        opex_data.write(opex_filepath)
-        opex_info = AssetInfo(opex_filename, None, opex_filepath,
-                              False, None, None, True)
-
-        logger.debug(f"Adding {opex_filename} to {dir}")
-        dir.add_file(opex_info)
-
-    uploads_file = os.path.join(target_dir, "to_upload.txt")
-
-    with open(uploads_file, "w") as f:
-        for dirname, dir in to_upload.all_subdirs():
-            for asset_id, files in dir.files.items():
-                for fileinfo in files:
-                    f.write(fileinfo.source_path)
-                    f.write("\t")
-                    f.write(dir.path() + '/' + fileinfo.filename)
-                    f.write('\n')
-
-    print(f"Upload list is: {uploads_file}")
+            upload_plan_file.write_plan(plan_path,
+                                        sorted(upload_plan, key=upload_plan_file.order_key))
+
+    if incremental:
+        state.remove_stale(dry_run)
+    logger.info(f"Generated files: {state.report()}")
+    state.close()
+
+    if shard:
+        print(f"Shard {shard} manifest is: {manifest.path}")
+    else:
+        print(f"Upload list is: {uploads_file}")
+        print(f"Upload plan is: {plan_path}")
+
+    if arguments.stats:
+        stats.write_report(arguments.stats, arguments.stats_file)
+
+
+def stream(upload_plan, outputs, paxes, arguments, target_dir,
+           fixity_algorithms, compression_policy, dry_run):
+    """Upload a plan (in upload order) straight to S3, making paxes on the way
+
+    Only the upload journal, as a manifest of what was sent, and the
+    verification report are left in the target folder."""
+    # Only needed for streaming, so only imported for it
+    import opex.uploader as uploader
+    from opex.streamer import StreamUploader
+    from opex.upload_journal import UploadJournal, JOURNAL_FILENAME
+    import opex.upload_verify as upload_verify
+
+    access_key, secret_key, bucket_name = uploader.read_bucket_config(arguments.s3_config,
+                                                                      arguments.stream_bucket)
+    s3_client = uploader.make_client(access_key, secret_key, arguments.stream_workers)
+
+    upload_dir = uploader.upload_dir_name(target_dir)
+    journal = report = None
+    if not dry_run:
+        journal = UploadJournal.start(os.path.join(target_dir, JOURNAL_FILENAME), upload_dir)
+        report = upload_verify.VerificationReport(
+            os.path.join(target_dir, upload_verify.REPORT_FILENAME))
+
+    timestamped_upload_plan = (
+        [source, uploader.map_upload(dest, arguments.stream_container, upload_dir), fixities]
+        for source, dest, fixities in upload_plan)
+
+    streamer = StreamUploader(s3_client, bucket_name, outputs, paxes,
+                              arguments.part_size * 2**20, fixity_algorithms, compression_policy,
+                              workers=arguments.stream_workers, dry_run=dry_run, journal=journal,
+                              checksum=upload_verify.DEFAULT_CHECKSUM, report=report)
+    failed = streamer.upload(timestamped_upload_plan)
+
+    if journal:
+        journal.close()
+        report.close()
+
+    if failed:
+        print(f"\n{len(failed)} uploads failed, stopped. See {upload_dir} in "
+              f"{bucket_name}/{arguments.stream_container}")
+        sys.exit(1)
+
+    print(f"\nFinished. See {upload_dir} in {bucket_name}/{arguments.stream_container}")
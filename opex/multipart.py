@@ -0,0 +1,107 @@
+import hashlib
+import logging
+from opex.fixity import ALGORITHMS, xip_algorithm_name
+import opex.upload_verify as upload_verify
+
+logger = logging.getLogger(__name__)
+
+PART_SIZE = 16 * 1024 * 1024  # S3 wants at least 5MiB, except the last
+
+
+class MultipartWriter:
+    """A write-only file that uploads to S3, a part at a time
+
+    Only one part is held in memory. There is no seek or tell, so zipfile
+    writes a streamable zip (with data descriptors) into it.
+
+    With a checksum (see upload_verify.CHECKSUMS) S3 checks each part as
+    it arrives, and a part corrupted on the way is sent again, up to
+    retries times. digests, if given, is fed everything written."""
+
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE,
+                 checksum=None, retries=0, digests=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.checksum = checksum
+        self.retries = retries
+        self.digests = digests
+        self.buffer = bytearray()
+        self.parts = []
+        self.part_digests = []
+        self.size = 0
+        self.attempts = 1  # the most any part took
+        self.confirmed = True  # that S3 checked every part
+
+        args = {}
+        if checksum and checksum != 'MD5':  # an additional checksum
+            args['ChecksumAlgorithm'] = xip_algorithm_name(checksum)
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key,
+                                                           **args)['UploadId']
+
+    def write(self, data):
+        if self.digests:
+            self.digests.update(data)
+        self.size += len(data)
+        if not self.buffer and len(data) == self.part_size:
+            self._upload_part(data)  # a whole part already, as when copying a file
+            return len(data)
+
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass  # parts go when they're full
+
+    def _upload_part(self, data):
+        number = len(self.parts) + 1
+        data = bytes(data)
+        args = {}
+        if self.checksum:
+            digest = hashlib.new(ALGORITHMS[self.checksum], data).digest()
+            self.part_digests.append(digest)
+            args = upload_verify.checksum_args(self.checksum, digest)
+
+        def request():
+            response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key,
+                                                  UploadId=self.upload_id,
+                                                  PartNumber=number, Body=data, **args)
+            if args and not upload_verify.confirmed(response, args):
+                self.confirmed = False
+            return response
+
+        response, attempts = upload_verify.send(request, self.retries,
+                                                f"Part {number} of {self.key}")
+        self.attempts = max(self.attempts, attempts)
+        part = {'PartNumber': number, 'ETag': response['ETag']}
+        if 'ChecksumSHA256' in args:
+            part['ChecksumSHA256'] = args['ChecksumSHA256']  # needed to complete
+        self.parts.append(part)
+
+    def close(self):
+        """Finish the upload, returning the object's ETag"""
+        try:
+            if self.buffer or not self.parts:
+                self._upload_part(self.buffer)
+                self.buffer = bytearray()
+        except BaseException:
+            self.abort()
+            raise
+
+        response = self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+        if self.checksum and self.checksum != 'MD5':
+            composite = upload_verify.composite_checksum(self.part_digests)
+            if not upload_verify.confirmed(response, {'ChecksumSHA256': composite}):
+                self.confirmed = False
+        return response['ETag']
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                              UploadId=self.upload_id)
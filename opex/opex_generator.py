@@ -7,7 +7,8 @@ import uuid
 import sys
 import datetime
 import hashlib
-from opex.util import elem, subelem
+from opex.util import elem, subelem, leaf
+from opex.instrument import timed
 import logging
 
 opex = "http://www.openpreservationexchange.org/opex/v1.0"
@@ -81,14 +82,20 @@ def output_pax_file(root, file):
     root_tree.write(filename + ".opex")
 
 
+def serialize(root_tree):
+    """The bytes ElementTree.write would write for an opex"""
+    return ET.tostring(root_tree.getroot())
+
+
 def output_file(file_info, conf):
 
     root_elem = elem(opex, "OPEXMetadata")
-    if file_info.fixity:
+    all_fixities = file_info.all_fixities()
+    if all_fixities:
         transfer = subelem(root_elem, opex, "Transfer")
         fixities = subelem(transfer, opex, "Fixities")
-        subelem(fixities, opex, "Fixity", type=file_info.fixity_type,
-                value=file_info.fixity)
+        for fixity_type, fixity in all_fixities.items():
+            subelem(fixities, opex, "Fixity", type=fixity_type, value=fixity)
     else:
         logger.warn(f"No fixity for {file_info.filename}")
 
@@ -97,3 +104,75 @@ def output_file(file_info, conf):
     root_tree = ET.ElementTree(element=root_elem)
     ET.indent(root_tree)
     return root_tree
+
+
+# Fast versions of the above. Opexes all have the same shape, so rather
+# than build and indent a tree for each we write the text directly. The
+# output is byte for byte what serialize(output_...) gives.
+
+OPEX_START = f'<opex:OPEXMetadata xmlns:legacyxip="{legacy}" xmlns:opex="{opex}">\n'
+OPEX_END = '</opex:OPEXMetadata>'
+
+PROPERTIES_START = ('  <opex:Properties>\n'
+                    '    <opex:SecurityDescriptor>open</opex:SecurityDescriptor>\n'
+                    '    <opex:Identifiers>\n')
+PROPERTIES_END = ('    </opex:Identifiers>\n'
+                  '  </opex:Properties>\n'
+                  '  <opex:DescriptiveMetadata>\n'
+                  '    <legacyxip:LegacyXIP>\n'
+                  '{}'
+                  '    </legacyxip:LegacyXIP>\n'
+                  '  </opex:DescriptiveMetadata>\n')
+VIRTUAL = PROPERTIES_END.format('      <legacyxip:Virtual>true</legacyxip:Virtual>\n')
+NOT_VIRTUAL = PROPERTIES_END.format('      <legacyxip:AccessionRef>catalogue</legacyxip:AccessionRef>\n')
+
+
+def render_properties(id, virtual):
+    return (PROPERTIES_START
+            + leaf('      ', 'opex:Identifier', id, type='code')
+            + (VIRTUAL if virtual else NOT_VIRTUAL))
+
+
+@timed('opex render')
+def render_dir(dir, conf):
+    """Same as serialize(output_dir(dir, conf)), only quicker"""
+    parts = [OPEX_START, '  <opex:Transfer>\n', '    <opex:Manifest>\n']
+
+    files = [leaf('        ', 'opex:File', fileinfo.filename,
+                  type='metadata' if fileinfo.is_metadata else 'content')
+             for files in dir.files.values()
+             for fileinfo in files]
+    if files:
+        parts += ['      <opex:Files>\n', *files, '      </opex:Files>\n']
+    else:
+        parts.append('      <opex:Files />\n')
+
+    folders = [leaf('        ', 'opex:Folder', dirname) for dirname in dir.subdirs]
+    if folders:
+        parts += ['      <opex:Folders>\n', *folders, '      </opex:Folders>\n']
+    else:
+        parts.append('      <opex:Folders />\n')
+
+    parts += ['    </opex:Manifest>\n', '  </opex:Transfer>\n',
+              render_properties(dir.dir_id, True), OPEX_END]
+
+    return ''.join(parts).encode('ascii', 'xmlcharrefreplace')
+
+
+@timed('opex render')
+def render_file(file_info, conf):
+    """Same as serialize(output_file(file_info, conf)), only quicker"""
+    parts = [OPEX_START]
+
+    all_fixities = file_info.all_fixities()
+    if all_fixities:
+        parts += ['  <opex:Transfer>\n', '    <opex:Fixities>\n']
+        parts += [leaf('      ', 'opex:Fixity', type=fixity_type, value=fixity)
+                  for fixity_type, fixity in all_fixities.items()]
+        parts += ['    </opex:Fixities>\n', '  </opex:Transfer>\n']
+    else:
+        logger.warn(f"No fixity for {file_info.filename}")
+
+    parts += [render_properties(file_info.asset_id, False), OPEX_END]
+
+    return ''.join(parts).encode('ascii', 'xmlcharrefreplace')
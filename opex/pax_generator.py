@@ -1,9 +1,15 @@
 import xml.etree.ElementTree as ET
-import zipfile
 import uuid
 import datetime
 import os
-from opex.util import elem, subelem
+from dataclasses import replace
+from opex.util import elem, subelem, leaf, AssetInfo
+from opex.fixity import xip_algorithm_name, file_fixities, hex_length
+from opex.pax_writer import PaxWriter
+from opex.compression import CompressionStats
+import opex.opex_generator as opex_generator
+import opex.instrument as instrument
+from opex.instrument import timed
 import logging
 
 xip = "http://preservica.com/XIP/v6.3"
@@ -61,26 +67,36 @@ def create_generation(root_elem, entries, content_id, is_pres):
         subelem(bs_elem, xip, 'Bitstream', '/'.join(zip_location(file)))
 
 
-def create_bitstream(root_elem, fileinfo):
+def create_bitstream(root_elem, fileinfo, size=None):
     dirname, filename = zip_location(fileinfo)
-    size = os.path.getsize(fileinfo.source_path)
+    if size is not None:
+        pass  # counted as it went into the zip
+    elif fileinfo.stat:
+        size = fileinfo.stat.st_size  # we already have this from the scan
+    else:
+        size = os.path.getsize(fileinfo.source_path)
 
     bs_elem = subelem(root_elem, xip, 'Bitstream')
     subelem(bs_elem, xip, 'Filename', filename)
     subelem(bs_elem, xip, 'FileSize', str(size))
     subelem(bs_elem, xip, 'PhysicalLocation', dirname)
 
-    if fileinfo.fixity:
+    all_fixities = fileinfo.all_fixities()
+    if all_fixities:
         fxs = subelem(bs_elem, xip, 'Fixities')
-        fx = subelem(fxs, xip, 'Fixity')
-        subelem(fx, xip, 'FixityAlgorithmRef', fileinfo.fixity_type)
-        subelem(fx, xip, 'FixityValue', fileinfo.fixity)
+        for fixity_type, fixity in all_fixities.items():
+            fx = subelem(fxs, xip, 'Fixity')
+            subelem(fx, xip, 'FixityAlgorithmRef', xip_algorithm_name(fixity_type))
+            subelem(fx, xip, 'FixityValue', fixity)
     else:
         logger.warn(f"No fixity for {fileinfo.source_path}")
 
 
-def create_xip(id, files):
-    """Create a xip file to go in the pax file"""
+def create_xip(id, files, sizes=None):
+    """Create a xip file to go in the pax file
+
+    sizes maps source paths to sizes, where we already know them"""
+    sizes = sizes or {}
     root_elem = elem(xip, "XIP")
 
     info_obj = subelem(root_elem, xip, 'InformationObject')
@@ -112,7 +128,7 @@ def create_xip(id, files):
                       is_pres=False)
 
     for fileinfo in files:
-        create_bitstream(root_elem, fileinfo)
+        create_bitstream(root_elem, fileinfo, sizes.get(fileinfo.source_path))
 
     root_tree = ET.ElementTree(element=root_elem)
 
@@ -121,23 +137,188 @@ def create_xip(id, files):
     return root_tree
 
 
-def create_pax(id, files, zip_path, pax_prefix, dry_run=False):
+# Fast version of create_xip, writing the text directly rather than
+# building a tree. Gives the same bytes as ET.tostring(create_xip(...)
+# .getroot(), encoding='utf-8'), given the same uuids.
 
-    if dry_run:
-        logger.info(f"Dry run, not creating zip {zip_path}")
+XIP_START = f"<xip:XIP xmlns:xip=\"{xip}\">\n"
+XIP_END = '</xip:XIP>'
 
-    if not dry_run:
-        zip = zipfile.ZipFile(zip_path, mode='w')
 
-    xip = create_xip(id, files)
+def render_representation(name, parent_id, item_id, is_pres):
+    return ('  <xip:Representation>\n'
+            + leaf('    ', 'xip:InformationObject', parent_id)
+            + leaf('    ', 'xip:Name', name)
+            + leaf('    ', 'xip:Type', 'Preservation' if is_pres else 'Access')
+            + '    <xip:ContentObjects>\n'
+            + leaf('      ', 'xip:ContentObject', item_id)
+            + '    </xip:ContentObjects>\n'
+              '    <xip:RepresentationFormats />\n'
+              '    <xip:RepresentationProperties />\n'
+              '  </xip:Representation>\n')
 
-    if not dry_run:
-        zip.writestr(pax_prefix + '.xip',
-                     ET.tostring(xip.getroot(), encoding='utf-8'))
 
-    for fileinfo in files:
-        if not dry_run:
-            zip.write(fileinfo.source_path, '/'.join(zip_location(fileinfo)))
+def render_content(parent_id, content_id, name):
+    return ('  <xip:ContentObject>\n'
+            + leaf('    ', 'xip:Ref', content_id)
+            + leaf('    ', 'xip:Title', name)
+            + '    <xip:SecurityTag>open</xip:SecurityTag>\n'
+            + leaf('    ', 'xip:Parent', parent_id)
+            + '  </xip:ContentObject>\n')
+
+
+def render_generation(entries, content_id, is_pres):
+    original = 'true' if is_pres else 'false'
+    parts = [f'  <xip:Generation original="{original}" active="true">\n',
+             leaf('    ', 'xip:ContentObject', content_id),
+             leaf('    ', 'xip:EffectiveDate', datetime.date.today().isoformat())]
 
-    if not dry_run:
-        zip.close()
+    if entries:
+        parts.append('    <xip:Bitstreams>\n')
+        parts += [leaf('      ', 'xip:Bitstream', '/'.join(zip_location(file)))
+                  for file in entries]
+        parts.append('    </xip:Bitstreams>\n')
+    else:
+        parts.append('    <xip:Bitstreams />\n')
+
+    parts.append('  </xip:Generation>\n')
+    return ''.join(parts)
+
+
+def render_bitstream(fileinfo, size=None):
+    dirname, filename = zip_location(fileinfo)
+    if size is None:
+        size = fileinfo.stat.st_size if fileinfo.stat else os.path.getsize(fileinfo.source_path)
+
+    parts = ['  <xip:Bitstream>\n',
+             leaf('    ', 'xip:Filename', filename),
+             leaf('    ', 'xip:FileSize', str(size)),
+             leaf('    ', 'xip:PhysicalLocation', dirname)]
+
+    all_fixities = fileinfo.all_fixities()
+    if all_fixities:
+        parts.append('    <xip:Fixities>\n')
+        for fixity_type, fixity in all_fixities.items():
+            parts += ['      <xip:Fixity>\n',
+                      leaf('        ', 'xip:FixityAlgorithmRef', xip_algorithm_name(fixity_type)),
+                      leaf('        ', 'xip:FixityValue', fixity),
+                      '      </xip:Fixity>\n']
+        parts.append('    </xip:Fixities>\n')
+    else:
+        logger.warn(f"No fixity for {fileinfo.source_path}")
+
+    parts.append('  </xip:Bitstream>\n')
+    return ''.join(parts)
+
+
+@timed('xip render')
+def render_xip(id, files, sizes=None):
+    """Same as create_xip, but returns the encoded xip file"""
+    sizes = sizes or {}
+    ref_id = str(uuid.uuid4())
+    pres_content_id = str(uuid.uuid4())
+    acc_content_id = str(uuid.uuid4())
+
+    preserve_files = [f for f in files if not f.is_access]
+    access_files = [f for f in files if f.is_access]
+
+    parts = [XIP_START,
+             '  <xip:InformationObject>\n',
+             leaf('    ', 'xip:Ref', ref_id),
+             leaf('    ', 'xip:Title', id),
+             '    <xip:SecurityTag>open</xip:SecurityTag>\n',
+             '  </xip:InformationObject>\n',
+             render_representation('Representation_Preservation', ref_id,
+                                   pres_content_id, is_pres=True),
+             render_representation('Representation_Access', ref_id,
+                                   acc_content_id, is_pres=False),
+             render_content(ref_id, pres_content_id, 'Preservation content'),
+             render_content(ref_id, acc_content_id, 'Access content'),
+             render_generation(preserve_files, pres_content_id, is_pres=True),
+             render_generation(access_files, acc_content_id, is_pres=False)]
+
+    parts += [render_bitstream(fileinfo, sizes.get(fileinfo.source_path))
+              for fileinfo in files]
+    parts.append(XIP_END)
+
+    return ''.join(parts).encode('utf-8', 'xmlcharrefreplace')
+
+
+def create_pax(id, files, zip_path, pax_prefix, dry_run=False,
+               fixity_algorithms=(), compression=None):
+    """Create a pax zip for the files of an asset
+
+    The xip describing the files is the first member, then they are
+    copied in, computing any of fixity_algorithms they don't have yet on
+    the way. As the xip can't say what those are until then, room is
+    made for it, with placeholders of the same length, and it's filled
+    in at the end. A zip that can't be sought in (one being streamed to
+    S3) has the xip added last instead. Returns the CompressionStats for
+    the zip."""
+
+    if dry_run:
+        logger.info(f"Dry run, not creating zip {zip_path}")
+        render_xip(id, files)
+        return CompressionStats()
+
+    sizes = {}
+    missing = {}
+    for fileinfo in files:
+        known = fileinfo.all_fixities()
+        missing[fileinfo.source_path] = [a for a in fixity_algorithms if a not in known]
+
+    with PaxWriter(zip_path, compression) as writer:
+        xip_name = pax_prefix + '.xip'
+        reserved = None
+        if writer.seekable:
+            placeholders = [replace(fileinfo, fixities={
+                **(fileinfo.fixities or {}),
+                **{a: '0' * hex_length(a) for a in missing[fileinfo.source_path]}})
+                for fileinfo in files]
+            reserved = writer.reserve(xip_name, render_xip(id, placeholders))
+
+        for fileinfo in files:
+            size, fixities = writer.write_file(fileinfo.source_path,
+                                               '/'.join(zip_location(fileinfo)),
+                                               missing[fileinfo.source_path])
+            fileinfo.add_fixities(fixities)
+            sizes[fileinfo.source_path] = size
+
+        data = render_xip(id, files, sizes)
+        if reserved is None:
+            writer.writestr(xip_name, data)
+        else:
+            if len(data) < reserved.file_size:
+                # A file shrank since it was scanned; whitespace can follow the xip
+                data += b' ' * (reserved.file_size - len(data))
+            writer.fill(reserved, data)
+
+    return writer.stats
+
+
+def build_pax(id, files, zip_path, pax_prefix, opex_path,
+              fixity_algorithms=(), dry_run=False, compression=None):
+    """Create a pax zip and the opex to go with it
+
+    Everything needed is passed in (and returned) so this can run in a
+    worker process. Returns the pax's info, the files with any fixities
+    computed along the way, the compression stats and this process's
+    instrumentation (see instrument.Stats.take) to merge."""
+    input_bytes = sum(info.stat.st_size for info in files if info.stat)
+    with instrument.stats.timer('pax', bytes=input_bytes):
+        stats = create_pax(id, files, zip_path, pax_prefix, dry_run,
+                           fixity_algorithms, compression)
+
+    pax_info = AssetInfo(os.path.basename(zip_path), id, zip_path,
+                         False, None, None, False)
+    if fixity_algorithms and not dry_run:
+        with instrument.stats.timer('pax fixity') as timer:
+            pax_info.fixities = file_fixities(zip_path, fixity_algorithms)
+            timer.bytes = os.path.getsize(zip_path)
+
+    data = opex_generator.render_file(pax_info, None)
+    with instrument.stats.timer('opex write', bytes=len(data)):
+        with open(opex_path, 'wb') as f:
+            f.write(data)
+
+    return pax_info, files, stats, instrument.stats.take()
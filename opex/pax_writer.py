@@ -0,0 +1,146 @@
+import os
+import hashlib
+import zipfile
+import time
+import zlib
+import logging
+import threading
+from opex.fixity import ALGORITHMS
+from opex.compression import CompressionPolicy, CompressionStats
+
+logger = logging.getLogger(__name__)
+
+# ZipFile.write copies in 8KiB pieces, far too small for multi-GB TIFFs
+COPY_BUFFER = 8 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+def copy_buffer(size):
+    """A buffer to copy through, kept for the next pax this thread writes
+
+    Allocating (and so zeroing and faulting in) a fresh 8MiB for each pax
+    can cost more than writing a small one."""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def advise_sequential(fd):
+    """Tell the OS we'll read this file start to end, so it reads ahead"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass  # only a hint
+
+
+class PaxWriter:
+    """Write a pax zip, streaming files in with large buffers
+
+    Files are hashed as they are copied, so the sizes and fixities for the
+    xip come from the same bytes that went into the zip. Zip64 is used
+    automatically for members (and archives) over 4GiB. How each member is
+    compressed is up to the CompressionPolicy, which gets the first block
+    read as a sample, and what that saved is added up in stats.
+
+    zip_path can also be a writable file object, which we don't close. If
+    it can't seek (as when streaming to S3), members can't be reserved."""
+
+    def __init__(self, zip_path, policy=None, buffer_size=COPY_BUFFER):
+        self.zip_path = zip_path
+        self.policy = policy or CompressionPolicy()
+        self.stats = CompressionStats()
+        if isinstance(zip_path, str):
+            self.fp = open(zip_path, 'wb', buffering=buffer_size)
+        else:
+            self.fp = None
+        self.seekable = self.fp is not None or (hasattr(zip_path, 'seekable')
+                                                and zip_path.seekable())
+        self.zip = zipfile.ZipFile(self.fp or zip_path, mode='w', allowZip64=True)
+        self.buffer = copy_buffer(buffer_size)
+
+    def write_file(self, source_path, arcname, algorithms=()):
+        """Copy a file into the zip, returning (size, {algorithm: fixity})"""
+        zinfo = zipfile.ZipInfo.from_file(source_path, arcname)
+
+        hashers = {algorithm: hashlib.new(ALGORITHMS[algorithm])
+                   for algorithm in algorithms}
+        view = memoryview(self.buffer)
+        size = 0
+
+        with open(source_path, 'rb', buffering=0) as src:
+            advise_sequential(src.fileno())
+
+            n = src.readinto(self.buffer)
+            compress_type, level = self.policy.choose(arcname, view[:n], self.stats)
+            zinfo.compress_type = compress_type
+            if hasattr(zinfo, 'compress_level'):
+                zinfo.compress_level = level
+            else:
+                zinfo._compresslevel = level  # no public way to set this before 3.13
+
+            start = time.perf_counter()
+
+            # zipfile decides on zip64 from zinfo.file_size, set by from_file
+            with self.zip.open(zinfo, mode='w') as dest:
+                while n:
+                    chunk = view[:n]
+                    dest.write(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    size += n
+                    n = src.readinto(self.buffer)
+
+            self.stats.record(zinfo, time.perf_counter() - start)
+
+        logger.debug(f"Copied {size} bytes from {source_path} to {arcname} "
+                     f"({zinfo.compress_size} in zip)")
+
+        return size, {algorithm: hasher.hexdigest()
+                      for algorithm, hasher in hashers.items()}
+
+    def writestr(self, arcname, data):
+        compress_type, level = self.policy.choose(arcname, data, self.stats)
+        start = time.perf_counter()
+        self.zip.writestr(arcname, data, compress_type, level)
+        self.stats.record(self.zip.getinfo(arcname), time.perf_counter() - start)
+
+    def reserve(self, arcname, data):
+        """Add a member now, stored, to be filled in later by fill
+
+        So something that must come first, like the xip, can be written
+        before what it describes is known. Returns the member's ZipInfo."""
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = len(data)
+        with self.zip.open(zinfo, mode='w') as dest:
+            dest.write(data)
+        self.stats.record(zinfo, 0)
+        return zinfo
+
+    def fill(self, zinfo, data):
+        """Overwrite a reserved member, in place, with data of the same length"""
+        if len(data) != zinfo.file_size:
+            raise ValueError(f"{len(data)} bytes for {zinfo.filename}, "
+                             f"which has {zinfo.file_size} reserved")
+        zinfo.CRC = zlib.crc32(data)
+        fp = self.zip.fp
+        end = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader())  # the same length, with the new CRC
+        fp.write(data)
+        fp.seek(end)
+
+    def close(self):
+        self.zip.close()
+        if self.fp:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from opex.instrument import stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 16
+
+# Put on a queue after the last item
+DONE = object()
+
+
+class Stage:
+    """A step in a pipeline: fn applied to each item, up to workers at once
+
+    fn can be a coroutine function, a function run in a thread of the
+    stage's own (in_thread, for blocking work that releases the GIL or
+    waits on I/O) or, by default, a function run in the event loop, for
+    quick work that must stay in one thread (e.g. anything using SQLite).
+    Results go on to the next stage in the order items arrived if
+    ordered, otherwise as they're ready. A result of None goes no
+    further."""
+
+    def __init__(self, name, fn, workers=1, ordered=False, in_thread=False):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.ordered = ordered
+        self.in_thread = in_thread
+
+    async def run(self, inbox, outbox):
+        pool = None
+        if self.in_thread:
+            pool = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix=self.name)
+
+        # Results waiting for earlier ones, if ordered. The slots keep that
+        # (and what's being worked on) within bounds
+        finished = {}
+        next_out = 0
+        slots = asyncio.Semaphore(self.workers + outbox.maxsize)
+
+        async def put(result):
+            if result is None:
+                pass
+            elif stats.enabled and outbox.full():  # time held up by the next stage
+                started = time.perf_counter()
+                await outbox.put(result)
+                stats.add(f"{self.name} blocked", 1, 0, time.perf_counter() - started)
+            else:
+                await outbox.put(result)
+
+        loop = asyncio.get_running_loop()
+        is_coroutine = asyncio.iscoroutinefunction(self.fn)
+
+        async def worker():
+            nonlocal next_out
+            while True:
+                await slots.acquire()
+                seq, item = await inbox.get()
+                if item is DONE:
+                    await inbox.put((seq, DONE))  # for the other workers
+                    slots.release()
+                    return
+
+                if is_coroutine:
+                    result = await self.fn(item)
+                elif pool:
+                    result = await loop.run_in_executor(pool, self.fn, item)
+                else:
+                    result = self.fn(item)
+
+                if not self.ordered:
+                    await put(result)
+                    slots.release()
+                    continue
+
+                finished[seq] = result
+                while next_out in finished:
+                    await put(finished.pop(next_out))
+                    next_out += 1
+                    slots.release()
+
+        try:
+            await gather_or_cancel([worker() for _ in range(self.workers)])
+        finally:
+            if pool:
+                pool.shutdown()
+        await outbox.put(DONE)
+
+
+class Numbered:
+    """Wraps a queue, numbering items on the way in"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.maxsize = queue.maxsize
+        self.seq = 0
+
+    def full(self):
+        return self.queue.full()
+
+    async def put(self, item):
+        if item is not DONE:
+            item, self.seq = (self.seq, item), self.seq + 1
+        else:
+            item = (self.seq, DONE)
+        await self.queue.put(item)
+
+
+async def gather_or_cancel(coroutines):
+    """Run coroutines together; if any fails, stop the rest and raise"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def feed(source, outbox, in_thread):
+    """Put everything from an iterator on a queue, then DONE"""
+    iterator = iter(source)
+    if in_thread:
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='source') as pool:
+            while (item := await loop.run_in_executor(pool, next, iterator, DONE)) is not DONE:
+                await outbox.put(item)
+    else:
+        for item in iterator:
+            await outbox.put(item)
+    await outbox.put(DONE)
+
+
+async def drain(inbox):
+    while (await inbox.get())[1] is not DONE:
+        pass
+
+
+async def run_async(source, stages, queue_size=DEFAULT_QUEUE_SIZE, source_in_thread=False):
+    queues = [Numbered(asyncio.Queue(queue_size)) for _ in range(len(stages) + 1)]
+    await gather_or_cancel(
+        [feed(source, queues[0], source_in_thread)]
+        + [stage.run(inbox.queue, outbox) for stage, inbox, outbox
+           in zip(stages, queues, queues[1:])]
+        + [drain(queues[-1].queue)])
+
+
+def run(source, stages, queue_size=DEFAULT_QUEUE_SIZE, source_in_thread=False):
+    """Pass everything from source through the stages in turn
+
+    Stages are joined by queues of at most queue_size items, so a slow
+    stage holds up those before it rather than letting work pile up, and
+    all the stages run at once. source is iterated in a thread of its
+    own if source_in_thread (e.g. if it blocks on I/O), otherwise in the
+    event loop. Whatever the last stage returns is dropped. If a stage
+    fails everything is stopped and the exception raised here."""
+    asyncio.run(run_async(source, stages, queue_size, source_in_thread))
@@ -0,0 +1,253 @@
+import os
+import re
+import logging
+import string
+import operator
+import tomllib
+from opex.util import AssetInfo
+
+logger = logging.getLogger(__name__)
+
+# (?P<name>...) and (?P=name), to give each rule's groups their own names
+NAMED_GROUP = re.compile(r'\(\?P([<=])(\w+)')
+
+# A regex a token at a time: escapes (with any digits after), global flags
+# like (?i), and the brackets of [classes], whose insides aren't the same
+PATTERN_TOKEN = re.compile(r'\\(\d+)|\\.|(\(\?[aiLmsux]+\))|(\[\^?\]?)|(\])|.', re.DOTALL)
+OCTAL_DIGITS = set('01234567')
+
+DEFAULT_FILENAME = '{asset}.{ext}'
+
+# Settings a [[rule]] can have, or inherit from the top level
+RULE_SETTINGS = {'pattern', 'target', 'filename', 'access', 'fixity', 'ids'}
+
+
+def read_text(path):
+    """The text of a file, or None if there isn't one"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def template_fields(template):
+    """The names a template like {asset}.{ext} uses, e.g. asset of {asset[0]}"""
+    return {re.split(r'[.\[]', field, 1)[0]
+            for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+def combining_problem(pattern):
+    """Why a pattern can't be one rule's part of the combined regex, or None
+
+    A numeric backreference (like \\1) would count every rule's groups, not
+    just this one's, and global flags (like (?i)) must start the regex."""
+    in_class = False
+    for token in PATTERN_TOKEN.finditer(pattern):
+        digits, flags, class_start, class_end = token.groups()
+        if in_class:
+            in_class = class_end is None
+        elif class_start:
+            in_class = True
+        elif flags:
+            return (f"sets global flags with {flags}, which can't be part of the rules' "
+                    f"combined regex: use {flags[:-1]}:...) around the pattern")
+        elif digits and not (digits[0] == '0'
+                             or (len(digits) >= 3 and set(digits[:3]) <= OCTAL_DIGITS)):
+            # Not \0 or three octal digits, which are characters
+            return (f"has a numeric backreference \\{digits[:2]}, "
+                    f"which must name its group as (?P=name)")
+    return None
+
+
+def compile_template(template):
+    """values -> text, for a template like {asset}.{ext}"""
+    name = template[1:-1]
+    if template == '{' + name + '}' and name.isidentifier():
+        return operator.itemgetter(name)  # just a group, as most are
+    return template.format_map
+
+
+def compile_replacements(replacements):
+    """name -> id, making each replacement in turn"""
+    replacements = list(replacements.items())
+    if not replacements:
+        return str
+    if len(replacements) == 1:
+        (old, new), = replacements
+        return lambda name: name.replace(old, new)
+
+    def to_id(name):
+        for old, new in replacements:
+            name = name.replace(old, new)
+        return name
+    return to_id
+
+
+class Rule:
+    """One [[rule]]: a pattern, and what to make of the files it matches"""
+
+    def __init__(self, number, settings):
+        self.number = number
+        pattern = settings.get('pattern')
+        if not pattern:
+            raise ValueError(f"Rule {number} has no pattern")
+        try:
+            groups = re.compile(pattern).groupindex
+        except re.error as e:
+            raise ValueError(f"Rule {number} pattern is not a valid regex: {e}")
+        if 'asset' not in groups:
+            raise ValueError(f"Rule {number} pattern has no (?P<asset>...) group")
+        if problem := combining_problem(pattern):
+            raise ValueError(f"Rule {number} pattern {problem}")
+
+        # Group names are prefixed so the rules can share one regex
+        self.prefix = f"r{number}_"
+        self.pattern = NAMED_GROUP.sub(lambda m: f"(?P{m[1]}{self.prefix}{m[2]}", pattern)
+        self.group_names = list(groups)
+        self.groups = []  # (name, group number in the combined regex), once compiled
+
+        target = settings.get('target')
+        if not target:
+            raise ValueError(f"Rule {number} has no target")
+        self.target = [self.template(template, 'target') for template in target]
+        self.filename = self.template(settings.get('filename', DEFAULT_FILENAME), 'filename')
+
+        access = settings.get('access', {})
+        self.access_extensions = frozenset(access.get('extensions', []))
+        access_paths = access.get('path_contains', [])
+        self.access_path = (re.compile('|'.join(map(re.escape, access_paths))).search
+                            if access_paths else None)
+
+        fixity = settings.get('fixity', {})
+        sidecar = fixity.get('sidecar')
+        self.sidecar = self.template(sidecar, 'sidecar') if sidecar else None
+        self.fixity_type = fixity.get('type', 'MD5')
+        extract = fixity.get('extract')
+        self.extract = re.compile(extract).search if extract else None
+
+        self.to_id = compile_replacements(settings.get('ids', {}).get('replace', {}))
+
+    def template(self, template, setting):
+        """Compile a template, once it's checked it only uses our groups, name and ext"""
+        try:
+            fields = template_fields(template)
+        except ValueError as e:
+            raise ValueError(f"Rule {self.number} {setting} {template!r} is not a valid "
+                             f"template: {e}")
+        if unknown := fields - {*self.group_names, 'name', 'ext'}:
+            raise ValueError(f"Rule {self.number} {setting} {template!r} uses "
+                             f"{', '.join(sorted(unknown)) or 'a field'}, which the pattern "
+                             f"has no group for")
+        return compile_template(template)
+
+    def bind(self, regex):
+        self.groups = [(name, regex.groupindex[self.prefix + name])
+                       for name in self.group_names]
+
+    def info(self, match, name, ext, path, read_sidecar):
+        """(target, info) for a file, read_sidecar(name) giving the text of
+        a file in the same folder, or None"""
+        values = {'name': name, 'ext': ext}
+        for group, number in self.groups:
+            values[group] = match.group(number) or ''
+
+        to_id = self.to_id
+        target = []
+        for template in self.target:
+            folder = template(values)
+            target.append((folder, to_id(folder)))
+
+        fixity_type = fixity = None
+        if self.sidecar:
+            fixity = read_sidecar(self.sidecar(values))
+            if fixity is not None and self.extract:
+                found = self.extract(fixity)
+                fixity = found.group(0) if found else None
+            elif fixity is not None:
+                fixity = fixity.strip() or None  # without the newline, at least
+            if fixity is not None:
+                fixity_type = self.fixity_type
+
+        info = AssetInfo(
+            filename=self.filename(values),
+            asset_id=to_id(values['asset']),
+            source_path=path,
+            is_access=(ext in self.access_extensions
+                       or (self.access_path is not None and self.access_path(path) is not None)),
+            fixity_type=fixity_type,
+            fixity=fixity
+        )
+
+        return target, info
+
+
+class RuleConfig:
+    """A rules file (see conf_fb.toml), compiled, standing in for a config module
+
+    Settings at the top level are defaults for every [[rule]]. The rules'
+    patterns are compiled into one regex, so each file name is searched
+    once however many rules there are, and extensions are looked up in
+    sets. Where two rules match, the match starting first in the name
+    wins, then the rule listed first."""
+
+    def __init__(self, settings, name='rules'):
+        self.name = name
+        defaults = {key: value for key, value in settings.items() if key in RULE_SETTINGS}
+        rules = settings.get('rule', [])
+        if not rules:
+            raise ValueError(f"{name} has no [[rule]]s")
+        self.rules = [Rule(number, {**defaults, **rule}) for number, rule in enumerate(rules)]
+
+        self.ignore = frozenset(settings.get('ignore', []))
+
+        # One regex for all the rules. A rule's outer group closes after any
+        # inside it, so the match's lastindex says which rule it was
+        self.regex = re.compile('|'.join(f"(?P<rule{rule.number}>{rule.pattern})"
+                                         for rule in self.rules))
+        self.by_group = {}
+        for rule in self.rules:
+            rule.bind(self.regex)
+            self.by_group[self.regex.groupindex[f"rule{rule.number}"]] = rule
+
+        # The settings a Python config would have
+        self.CONTAINER = settings.get('container')
+        if 'compression' in settings:
+            self.COMPRESSION = settings['compression']
+
+    def classify(self, name, path, read_sidecar):
+        ext = name.rpartition('.')[2]
+        if ext in self.ignore:
+            return None, None
+
+        match = self.regex.search(name)
+        if not match:
+            return None, None
+
+        return self.by_group[match.lastindex].info(match, name, ext, path, read_sidecar)
+
+    def get_info_for_file(self, path):
+        dirpath, name = os.path.split(path)
+
+        def read_sidecar(sidecar):
+            return read_text(os.path.join(dirpath, sidecar))
+
+        return self.classify(name, path, read_sidecar)
+
+    def get_info_for_files(self, dirpath, entries, sidecars):
+        listing = sidecars.entries
+
+        def read_sidecar(sidecar):
+            entry = listing.get(sidecar)
+            return read_text(entry.path) if entry is not None else None
+
+        classify = self.classify
+        return [classify(entry.name, entry.path, read_sidecar) for entry in entries]
+
+
+def load_rules(path):
+    with open(path, 'rb') as f:
+        try:
+            settings = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError(f"Unable to read rules from {path}: {e}")
+    return RuleConfig(settings, path)
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+import logging
+from opex.util import Dir, AssetInfo, load_config
+from opex.main import write_dir_opex, upload_entries
+import opex.build_state as build_state
+import opex.layout as layouts
+import opex.upload_plan as upload_plan_file
+from opex.instrument import stats
+
+logger = logging.getLogger(__name__)
+
+# Written by each shard in its target folder, in place of to_upload.txt
+MANIFEST_FILENAME = 'shard_manifest.jsonl'
+MANIFEST_VERSION = 2
+
+# What decides an asset's shard: its top level target folder (keeping
+# folders whole) or its id (spreading the work most evenly)
+BY_FOLDER = 'folder'
+BY_ASSET = 'asset'
+SHARD_BY = [BY_ASSET, BY_FOLDER]
+
+
+class Shard:
+    """This run's share of a collection, e.g. 2/4 is the second of four
+
+    Every shard scans the whole collection (in the same order) and keeps
+    just its share, hashed so that all an asset's files, which go into
+    the same target folder, stay together."""
+
+    def __init__(self, number, count, by=BY_ASSET):
+        if not 1 <= number <= count:
+            raise ValueError(f"Shard {number} of {count} doesn't exist")
+        if by not in SHARD_BY:
+            raise ValueError(f"Can't shard by {by}")
+        self.number = number
+        self.count = count
+        self.by = by
+
+    @classmethod
+    def parse(cls, text, by=BY_ASSET):
+        """A shard from 'number/count', e.g. '2/4'"""
+        number, _, count = text.partition('/')
+        try:
+            return cls(int(number), int(count), by)
+        except ValueError as e:
+            raise ValueError(f"Shard should be number/count, e.g. 2/4, not {text}: {e}")
+
+    def __str__(self):
+        return f"{self.number}/{self.count} by {self.by}"
+
+    def keeps(self, target, info):
+        if self.by == BY_FOLDER:
+            key = target[0] if target else ''
+            key = key[0] if type(key) is tuple else key
+        else:
+            key = info.asset_id or ''
+        # Not hash(), which differs from one process to the next
+        return zlib.crc32(key.encode('utf-8')) % self.count == self.number - 1
+
+
+class ManifestWriter:
+    """Records a shard's finished dirs: where they are and what's in them
+
+    Files in the target folder are recorded relative to it, so the
+    shard's output can be merged from wherever it ends up."""
+
+    def __init__(self, target_dir, shard):
+        self.path = os.path.join(target_dir, MANIFEST_FILENAME)
+        self.target_dir = os.path.abspath(target_dir)
+        self.file = open(self.path, 'w')
+        self._write({'version': MANIFEST_VERSION, 'shard': shard.number,
+                     'count': shard.count, 'by': shard.by})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False))
+        self.file.write('\n')
+
+    def source(self, path):
+        path = os.path.abspath(path)
+        if path.startswith(self.target_dir + os.sep):
+            return os.path.relpath(path, self.target_dir)
+        return path
+
+    def add(self, dir):
+        path = []
+        parent = dir
+        while parent.parent:
+            path.append([parent.name, parent.dir_id])
+            parent = parent.parent
+        path.reverse()
+        self._write({'path': path,
+                     'files': [[info.filename, self.source(info.source_path), info.is_metadata,
+                                info.all_fixities()]
+                               for files in dir.files.values() for info in files]})
+
+    def close(self):
+        self.file.close()
+
+
+def read_manifest(shard_dir):
+    """(header, iterator of dir records) for a shard's output"""
+    path = os.path.join(shard_dir, MANIFEST_FILENAME)
+    f = open(path, 'r')
+    header = json.loads(f.readline())
+    if header.get('version') != MANIFEST_VERSION:
+        f.close()
+        raise ValueError(f"{path} isn't a shard manifest this version understands")
+
+    def records():
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    return header, records()
+
+
+def merge_tree(shard_dirs):
+    """A Dir tree of everything the shards made, checking they're all there"""
+    manifests = [read_manifest(shard_dir) for shard_dir in shard_dirs]
+
+    headers = [header for header, records in manifests]
+    count = headers[0]['count']
+    numbers = sorted(header['shard'] for header in headers)
+    if numbers != list(range(1, count + 1)) or {h['count'] for h in headers} != {count}:
+        raise ValueError(f"Need each of {count} shards once, got {', '.join(map(str, numbers))}")
+    if len({header['by'] for header in headers}) > 1:
+        raise ValueError("Shards were split different ways")
+
+    tree = Dir()
+    for shard_dir, (header, records) in zip(shard_dirs, manifests):
+        logger.info(f"Merging shard {header['shard']}/{count} from {shard_dir}")
+        for record in records:
+            dir = tree
+            for name, dir_id in record['path']:
+                subdir = dir.subdirs.get(name)
+                if subdir is None:
+                    subdir = dir.subdirs[name] = Dir(name, dir_id, dir)
+                dir = subdir
+
+            for filename, source, is_metadata, fixities in record['files']:
+                if not os.path.isabs(source):
+                    source = os.path.join(shard_dir, source)
+                info = AssetInfo(filename, None, source, False, None, None, is_metadata)
+                if fixities:
+                    info.add_fixities(fixities)  # for the upload plan
+                dir.add_file(info)
+
+    return tree
+
+
+def check_names(dir):
+    seen = set()
+    for files in dir.files.values():
+        for info in files:
+            if info.filename in seen:
+                logger.error(f"More than one {info.filename} in {dir.path() or '/'}")
+            seen.add(info.filename)
+
+
+def merge(shard_dirs, target_dir, conf=None, dry_run=False, layout=layouts.DEFAULT_LAYOUT):
+    """Combine shards' output, adding the dir opexes and upload plan
+
+    Returns the upload plan, top down as for an unsharded run."""
+    tree = merge_tree(shard_dirs)
+    if dry_run:
+        for dirname, dir in tree.all_subdirs():
+            check_names(dir)
+        return []
+
+    os.makedirs(target_dir, exist_ok=True)
+    layout = layouts.Layout(target_dir, layout)
+    state = build_state.BuildState(os.path.join(target_dir, build_state.DEFAULT_FILENAME),
+                                   build_state.signature(MANIFEST_FILENAME))
+
+    for dirname, dir in tree.all_subdirs(top_down=False):
+        check_names(dir)
+        write_dir_opex(dir, conf, layout, state)
+
+    logger.info(f"Generated files: {state.report()}")
+    state.close()
+
+    return [entry for dirname, dir in tree.all_subdirs()
+            for entry in upload_entries(dir)]
+
+
+def main(argv):
+    argv.pop(0)
+
+    parser = argparse.ArgumentParser(prog='merge_shards',
+                                     description='Combine the output of to_opex --shard runs')
+    parser.add_argument('-t', '--target', required=True,
+                        help='Folder for the folder opexes and the upload plan')
+    parser.add_argument('shards', nargs='+', help="Each shard's target folder")
+    parser.add_argument('-c', '--config', help='Config file, as used for the shards')
+    parser.add_argument('--layout', choices=layouts.LAYOUTS, default=layouts.DEFAULT_LAYOUT,
+                        help=f'Where the folder opexes go, as for to_opex (default {layouts.DEFAULT_LAYOUT})')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Explain what is happening')
+    parser.add_argument('-d', '--dry-run', action='store_true',
+                        help="Don't write anything, just check the shards")
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Report time, counts and bytes for each stage at the end, '
+                             'as text (the default) or json')
+    parser.add_argument('--stats-file', help='Write the --stats report here rather than print it')
+
+    arguments = parser.parse_args(argv)
+
+    format = '%(levelname)s\t%(message)s'
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.INFO, format=format)
+    if arguments.stats:
+        stats.enable()
+
+    conf = load_config(arguments.config) if arguments.config else None
+    target_dir = arguments.target
+
+    try:
+        upload_plan = merge(arguments.shards, target_dir, conf, arguments.dry_run,
+                            arguments.layout)
+    except (OSError, ValueError) as e:
+        logger.error(f"Unable to merge: {e}")
+        sys.exit(1)
+
+    if not arguments.dry_run:
+        uploads_file = os.path.join(target_dir, upload_plan_file.LEGACY_FILENAME)
+        with open(uploads_file, "w") as f:
+            for source, dest, fixities in upload_plan:
+                f.write(f"{source}\t{dest}\n")
+
+        plan_path = os.path.join(target_dir, upload_plan_file.PLAN_FILENAME)
+        upload_plan_file.write_plan(plan_path, sorted(upload_plan, key=upload_plan_file.order_key))
+
+        print(f"Upload list is: {uploads_file}")
+        print(f"Upload plan is: {plan_path}")
+
+    if arguments.stats:
+        stats.write_report(arguments.stats, arguments.stats_file)
@@ -0,0 +1,265 @@
+import os
+import pickle
+import sqlite3
+import logging
+import threading
+from opex.util import Dir
+from opex.upload_plan import upload_wave
+
+logger = logging.getLogger(__name__)
+
+# Sits in the target folder while we run
+DEFAULT_FILENAME = '.scan_spool.sqlite'
+
+# Dirs are keyed by the sequence number of the first file found under
+# them, one fixed width field per level. Sorting by key then gives the
+# order a Dir tree would list them in, top down (a dir's key is a
+# prefix of its subdirs' keys)
+KEY_WIDTH = 12
+
+SCHEMA = """
+CREATE TABLE dir (
+    key TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dir_id TEXT,
+    UNIQUE (parent, name)
+);
+CREATE TABLE file (
+    seq INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    info BLOB NOT NULL
+);
+CREATE INDEX file_dir ON file (dir, seq);
+CREATE TABLE plan (
+    key TEXT PRIMARY KEY,
+    entries TEXT NOT NULL
+);
+CREATE TABLE upload (
+    wave INTEGER NOT NULL,
+    target TEXT NOT NULL,
+    source TEXT NOT NULL,
+    fixities TEXT NOT NULL
+);
+CREATE INDEX upload_order ON upload (wave, target);
+CREATE TABLE flat_name (
+    filename TEXT PRIMARY KEY,
+    dir TEXT NOT NULL
+);
+"""
+
+# Also in the target folder while we run, if streaming
+STREAM_FILENAME = '.stream_spool.sqlite'
+
+STREAM_SCHEMA = """
+CREATE TABLE output (
+    path TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE pax (
+    path TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+"""
+
+CACHE_SIZE = 100000  # (parent key, name) -> key, for the dirs we've just seen
+
+
+class SpooledDir(Dir):
+    """A Dir read back from the spool, which knows its key"""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key, name=None, dir_id=None, parent=None):
+        super().__init__(name, dir_id, parent)
+        self.key = key
+
+    def release(self):
+        """Let go of the contents, once finished with"""
+        self.files = {}
+        self.subdirs = {}
+
+
+class SpooledNames:
+    """filename -> dir path, as the flat layout keeps to spot collisions, on disk"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def setdefault(self, filename, path):
+        row = self.db.execute('SELECT dir FROM flat_name WHERE filename = ?',
+                              (filename,)).fetchone()
+        if row:
+            return row[0]
+        self.db.execute('INSERT INTO flat_name VALUES (?, ?)', (filename, path))
+        return path
+
+
+class Spool:
+    """The results of a scan, kept on disk rather than as a Dir tree
+
+    Files are added as they're found, as to a Dir, then read back a dir
+    at a time, bottom up. Which target dir a file goes in needn't follow
+    the source layout (the access and preservation copies of an asset
+    can be far apart) so we can only know a dir is complete once the
+    scan is over. The spool lets us wait for that without holding the
+    whole collection in memory.
+
+    Each dir's upload entries are stored as it's finished, and read back
+    in the same order as for a Dir tree, so to_upload.txt is the same."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)  # left by a run that died
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.executescript(SCHEMA)
+        self.seq = 0
+        self.keys = {}
+
+    def _dir_key(self, parent, name, dir_id):
+        key = self.keys.get((parent, name))
+        if key is None:
+            row = self.db.execute('SELECT key FROM dir WHERE parent = ? AND name = ?',
+                                  (parent, name)).fetchone()
+            if row:
+                key, = row
+            else:
+                key = parent + str(self.seq).zfill(KEY_WIDTH)
+                self.db.execute('INSERT INTO dir VALUES (?, ?, ?, ?)',
+                                (key, parent, name, dir_id))
+
+            if len(self.keys) >= CACHE_SIZE:
+                self.keys.clear()
+            self.keys[(parent, name)] = key
+        return key
+
+    def add(self, path: list, fileinfo):
+        """As Dir.add"""
+        key = ''
+        for part in path:
+            if type(part) is tuple:
+                dirname, dir_id = part
+            else:
+                dirname = dir_id = part
+            key = self._dir_key(key, dirname, dir_id)
+
+        self.db.execute('INSERT INTO file VALUES (?, ?, ?)',
+                        (self.seq, key, pickle.dumps(fileinfo, pickle.HIGHEST_PROTOCOL)))
+        self.seq += 1
+
+    def _read_files(self, dir):
+        for info, in self.db.execute('SELECT info FROM file WHERE dir = ? ORDER BY seq',
+                                     (dir.key,)):
+            dir.add_file(pickle.loads(info))
+
+    def bottom_up(self):
+        """Yield dirs with their files, each after all its subdirs
+
+        Only the dirs on the way down to the current one are held. A dir's
+        subdirs are all listed (for its opex) but only hold anything until
+        they are released."""
+        root = SpooledDir('')
+        self._read_files(root)
+        stack = [root]
+
+        dirs = self.db.execute('SELECT key, parent, name, dir_id FROM dir ORDER BY key')
+        for key, parent_key, name, dir_id in dirs:
+            while stack[-1].key != parent_key:
+                yield stack.pop()  # we've seen all it has
+
+            parent = stack[-1]
+            dir = parent.subdirs[name] = SpooledDir(key, name, dir_id, parent)
+            self._read_files(dir)
+            stack.append(dir)
+
+        while stack:
+            yield stack.pop()
+
+    def flat_names(self):
+        """A store for layout.Layout's names, so the flat layout doesn't hold them all"""
+        return SpooledNames(self.db)
+
+    def add_plan(self, dir, entries):
+        self.db.execute('INSERT INTO plan VALUES (?, ?)',
+                        (dir.key, ''.join(f"{source}\t{target}\t{fixities}\n"
+                                          for source, target, fixities in entries)))
+        self.db.executemany('INSERT INTO upload VALUES (?, ?, ?, ?)',
+                            [(upload_wave(target), target, source, fixities)
+                             for source, target, fixities in entries])
+
+    def upload_plan(self):
+        """All the [source, target, fixities] entries added, top down"""
+        for entries, in self.db.execute('SELECT entries FROM plan ORDER BY key'):
+            for line in entries.splitlines():
+                yield line.split('\t')
+
+    def sorted_upload_plan(self):
+        """All the [source, target, fixities] entries added, in upload order"""
+        for target, source, fixities in self.db.execute(
+                'SELECT target, source, fixities FROM upload ORDER BY wave, target'):
+            yield [source, target, fixities]
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+
+class SpooledMapping:
+    """path -> value, in one of a StreamSpool's tables
+
+    As much of a dict as Builder and StreamUploader use."""
+
+    def __init__(self, spool, table, encode=bytes, decode=bytes):
+        self.spool = spool
+        self.table = table
+        self.encode = encode
+        self.decode = decode
+
+    def __setitem__(self, path, value):
+        with self.spool.lock:
+            self.spool.db.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)',
+                                  (path, self.encode(value)))
+
+    def __getitem__(self, path):
+        with self.spool.lock:
+            row = self.spool.db.execute(f'SELECT value FROM {self.table} WHERE path = ?',
+                                        (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return self.decode(row[0])
+
+    def __contains__(self, path):
+        with self.spool.lock:
+            return self.spool.db.execute(f'SELECT 1 FROM {self.table} WHERE path = ?',
+                                         (path,)).fetchone() is not None
+
+
+class StreamSpool:
+    """What's to be streamed to S3, kept on disk until it's uploaded
+
+    outputs maps would-be local paths to generated opexes, and paxes
+    would-be pax zip paths to (asset_id, files, prefix), as
+    StreamUploader wants them. Opexes can't go as their folders finish,
+    as every opex has to land before any content (see upload_plan), so
+    they wait here rather than in memory. Shared by the upload threads."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)  # left by a run that died
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.executescript(STREAM_SCHEMA)
+        self.outputs = SpooledMapping(self, 'output')
+        self.paxes = SpooledMapping(self, 'pax',
+                                    lambda recipe: pickle.dumps(recipe, pickle.HIGHEST_PROTOCOL),
+                                    pickle.loads)
+
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
@@ -0,0 +1,65 @@
+import logging
+from opex.uploader import Uploader
+from opex.multipart import MultipartWriter, PART_SIZE
+from opex.upload_verify import Check, Digests
+import opex.pax_generator as pax_generator
+
+logger = logging.getLogger(__name__)
+
+
+class StreamUploader(Uploader):
+    """Upload a plan whose opexes and paxes were never written to disk
+
+    outputs maps would-be local paths to the bytes of generated opexes,
+    and paxes maps would-be pax zip paths to (asset_id, files, prefix),
+    built straight into a multipart upload. Either can be a dict or a
+    spool.StreamSpool's. Anything else in the plan is an ordinary file."""
+
+    def __init__(self, s3_client, bucket, outputs, paxes, part_size=PART_SIZE,
+                 fixity_algorithms=(), compression=None, **kwargs):
+        super().__init__(s3_client, bucket, **kwargs)
+        self.outputs = outputs
+        self.paxes = paxes
+        self.part_size = part_size
+        self.fixity_algorithms = fixity_algorithms
+        self.compression = compression
+
+    def size(self, source):
+        if source in self.outputs:
+            return len(self.outputs[source])
+        if source in self.paxes:
+            # What goes in, near enough what comes out
+            return sum(super(StreamUploader, self).size(info.source_path)
+                       for info in self.paxes[source][1])
+        return super().size(source)
+
+    def put(self, source, target, fixities='', size=None):
+        if source in self.outputs:
+            data = self.outputs[source]
+            if self.checksum:
+                return self.put_data(data, target, fixities)
+            response = self.s3_client.put_object(Bucket=self.bucket, Key=target, Body=data)
+            return len(data), response['ETag'].strip('"'), None
+
+        if source in self.paxes:
+            asset_id, files, pax_prefix = self.paxes[source]
+            # There's nothing to check a pax against until it's made
+            digests = Digests([self.checksum]) if self.checksum else None
+            writer = MultipartWriter(self.s3_client, self.bucket, target, self.part_size,
+                                     self.checksum, self.retries, digests)
+            try:
+                pax_generator.create_pax(asset_id, files, writer, pax_prefix,
+                                         fixity_algorithms=self.fixity_algorithms,
+                                         compression=self.compression)
+            except BaseException:
+                writer.abort()
+                raise
+            etag = writer.close().strip('"')
+
+            check = None
+            if self.checksum:
+                check = Check(self.checksum, digests.hexdigest(self.checksum),
+                              attempts=writer.attempts, confirmed=writer.confirmed)
+            return writer.size, etag, check
+
+        return super().put(source, target, fixities, size)
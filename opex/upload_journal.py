@@ -0,0 +1,119 @@
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sits next to to_upload.txt in the target folder
+JOURNAL_FILENAME = 'upload_journal.tsv'
+
+HEADER = '#upload_dir'
+
+
+class UploadJournal:
+    """Append-only record of what an upload has completed
+
+    The first line names the timestamped upload dir, so a resumed upload
+    goes to the same place, then each completed upload is a line of
+    key, size and ETag. Lines are flushed as they are written, so the
+    journal survives the upload dying."""
+
+    def __init__(self, path, upload_dir, entries=None):
+        self.path = path
+        self.upload_dir = upload_dir
+        self.entries = entries or {}  # key -> (size, etag)
+        self.lock = threading.Lock()
+        self.file = None
+
+    @classmethod
+    def start(cls, path, upload_dir):
+        """Start a fresh journal for a new upload"""
+        journal = cls(path, upload_dir)
+        journal.file = open(path, 'w')
+        journal.file.write(f"{HEADER}\t{upload_dir}\n")
+        journal.file.flush()
+        return journal
+
+    @classmethod
+    def resume(cls, path):
+        """Reopen the journal of an earlier upload to carry on with it"""
+        entries = {}
+        upload_dir = None
+
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == HEADER:
+                    upload_dir = fields[1]
+                elif len(fields) == 3:  # ignore a partly written last line
+                    key, size, etag = fields
+                    entries[key] = (int(size), etag)
+
+        if not upload_dir:
+            raise ValueError(f"{path} isn't an upload journal")
+
+        journal = cls(path, upload_dir, entries)
+        journal.file = open(path, 'a')
+        return journal
+
+    def record(self, key, size, etag):
+        with self.lock:
+            self.entries[key] = (size, etag)
+            self.file.write(f"{key}\t{size}\t{etag}\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def list_uploaded(s3_client, bucket, prefix):
+    """Everything under prefix in the bucket, key -> (size, etag)
+
+    One paginated listing rather than a HEAD per object."""
+    uploaded = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            uploaded[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+    return uploaded
+
+
+def still_to_upload(upload_plan, journal, uploaded, skipped=None):
+    """Yield the [source, target, fixities] entries that are missing or don't match
+
+    An object counts as done if it is in the bucket with the size of the
+    local file and, if the journal knows its ETag, with that ETag too.
+    skipped, if given, is called with the size of each that's done. The
+    plan is streamed through, keeping its order. A source that can't be
+    looked at (moved, say, since to_opex ran) is passed on, to fail as
+    any other upload would, not stop the resume."""
+    done = 0
+
+    for entry in upload_plan:
+        source, target, fixities = entry
+        if target not in uploaded:
+            yield entry
+            continue
+
+        try:
+            size = os.path.getsize(source)
+        except OSError as e:
+            logger.error(f"Unable to check {target} against {source}: {e}")
+            yield entry
+            continue
+        uploaded_size, uploaded_etag = uploaded[target]
+        journal_entry = journal.entries.get(target)
+
+        if uploaded_size != size:
+            logger.info(f"Size of {target} doesn't match, will upload again")
+            yield entry
+        elif journal_entry and journal_entry[1] != uploaded_etag:
+            logger.info(f"ETag of {target} doesn't match, will upload again")
+            yield entry
+        else:
+            logger.debug(f"Already uploaded {target}")
+            done += 1
+            if skipped:
+                skipped(size)
+
+    logger.info(f"Skipped {done} files already uploaded")
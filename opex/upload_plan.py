@@ -0,0 +1,138 @@
+import os
+import heapq
+import logging
+import tempfile
+from itertools import islice
+from opex.fixity import normalise_fixities
+
+logger = logging.getLogger(__name__)
+
+# Written by to_opex next to to_upload.txt, already in upload order
+PLAN_FILENAME = 'upload_plan.tsv'
+LEGACY_FILENAME = 'to_upload.txt'
+
+HEADER = '#upload_plan'
+VERSION = '2'
+VERSIONS = ['1', '2']  # 1 had no fixities
+
+# Opexes go first, so Preservica never sees content before the metadata
+# describing it
+METADATA_WAVE = 0
+CONTENT_WAVE = 1
+
+SORT_CHUNK = 1000000  # entries sorted in memory at a time, for old plans
+
+
+def upload_wave(target):
+    return METADATA_WAVE if target.endswith('.opex') else CONTENT_WAVE
+
+
+def format_fixities(fixities, name=None):
+    """Fixities (type -> value) as a plan writes them, e.g. MD5:d41d8...
+
+    They're normalised (see fixity.normalise_fixity) on the way, as ones
+    from a config's sidecars can have a file name or newline after them.
+    Any that aren't hex are left out, logged as for name."""
+    return ','.join(f"{fixity_type}:{value}"
+                    for fixity_type, value in normalise_fixities(fixities, name).items())
+
+
+def parse_fixities(text):
+    """type -> value, from what format_fixities wrote"""
+    return dict(fixity.split(':', 1) for fixity in text.split(',')) if text else {}
+
+
+def order_key(entry):
+    """Where a [source, target, fixities] entry comes in the upload"""
+    target = entry[1]
+    return upload_wave(target), target
+
+
+def write_plan(path, entries):
+    """Write [source, target, fixities] entries, which must be in upload order
+
+    Each line is wave, source, target and the fixities known for the
+    source (see format_fixities, so the upload can be checked), after a
+    header line giving the format and version."""
+    with open(path, 'w') as f:
+        f.write(f"{HEADER}\t{VERSION}\n")
+        for entry in entries:
+            for field in entry:
+                if '\t' in field or '\n' in field:
+                    raise ValueError(f"Can't write {field!r} in an upload plan, "
+                                     f"as it has a tab or newline")
+            source, target, fixities = entry
+            f.write(f"{upload_wave(target)}\t{source}\t{target}\t{fixities}\n")
+
+
+def read_plan(path):
+    """Stream [source, target, fixities] entries from a plan, in upload order"""
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if len(header) != 2 or header[0] != HEADER or header[1] not in VERSIONS:
+            raise ValueError(f"{path} isn't an upload plan this version understands")
+
+        for line in f:
+            wave, source, target, *fixities = line.rstrip('\n').split('\t', 3)
+            yield [source, target, fixities[0] if fixities else '']
+
+
+def read_legacy(path):
+    """Stream [source, target, fixities] entries from a to_upload.txt, as written
+
+    It has no fixities, so those are always empty."""
+    with open(path, 'r') as uploads:
+        for line in uploads:
+            source, target = line.strip().split("\t", 1)
+            yield [source, target, '']
+
+
+def _write_run(entries, dir):
+    run = tempfile.TemporaryFile('w+', dir=dir)
+    for source, target, fixities in entries:
+        run.write(f"{source}\t{target}\t{fixities}\n")
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    for line in run:
+        yield line.rstrip('\n').split('\t', 2)
+
+
+def sort_entries(entries, chunk_size=SORT_CHUNK, tmp_dir=None):
+    """Put [source, target, fixities] entries into upload order
+
+    Chunks are sorted in memory and, if there's more than one, spilled
+    to temporary files and merged, so memory is bounded however long
+    the plan."""
+    entries = iter(entries)
+    first = sorted(islice(entries, chunk_size), key=order_key)
+    if len(first) < chunk_size:
+        yield from first  # it all fitted
+        return
+
+    runs = [_write_run(first, tmp_dir)]
+    del first
+    while chunk := sorted(islice(entries, chunk_size), key=order_key):
+        runs.append(_write_run(chunk, tmp_dir))
+    logger.debug(f"Merging {len(runs)} sorted runs of the upload plan")
+
+    try:
+        yield from heapq.merge(*[_read_run(run) for run in runs], key=order_key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def load_plan(dir):
+    """Stream a target folder's upload plan, in upload order
+
+    Uses the plan to_opex wrote if there is one, otherwise sorts an
+    older to_upload.txt."""
+    plan_path = os.path.join(dir, PLAN_FILENAME)
+    if os.path.exists(plan_path):
+        return read_plan(plan_path)
+
+    logger.info(f"No {PLAN_FILENAME}, sorting {LEGACY_FILENAME}")
+    return sort_entries(read_legacy(os.path.join(dir, LEGACY_FILENAME)), tmp_dir=dir)
@@ -0,0 +1,360 @@
+import os
+import time
+import heapq
+import datetime
+import threading
+import logging
+from contextlib import contextmanager
+from opex.instrument import stats
+from opex.upload_plan import upload_wave
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_LOOKAHEAD = 1000  # entries of a wave to pick the largest from
+
+ADJUST_INTERVAL = 5.0     # seconds between changes to how many upload at once
+PROGRESS_INTERVAL = 10.0  # seconds between progress lines
+GAIN = 1.05               # more throughput an increase must bring to try another
+PROBE_WINDOWS = 6         # intervals after one that didn't before trying again
+ERROR_RATE = 0.05         # of requests failing, over which we back off
+SMOOTHING = 0.3           # weight of the latest interval in the rate for the ETA
+BURST = 1.0               # seconds of the bandwidth cap that can go at once
+
+# S3's (and botocore's) ways of saying slow down
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException', 'ServiceUnavailable', 'RequestTimeout'}
+THROTTLE_STATUSES = {429, 503}
+
+
+def is_throttled(error):
+    # botocore's ClientError, or anything shaped like it
+    response = getattr(error, 'response', None) or {}
+    return (response.get('Error', {}).get('Code') in THROTTLE_CODES
+            or response.get('ResponseMetadata', {}).get('HTTPStatusCode') in THROTTLE_STATUSES)
+
+
+def retries(response):
+    """Times botocore retried a request, as when S3 told it to slow down"""
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    return 0
+
+
+def body_size(body):
+    """Bytes left to send of a request body, bytes or a file"""
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    return os.fstat(body.fileno()).st_size - body.tell()
+
+
+def sized(upload_plan, size, scheduler=None):
+    """Yield (size, entry) for a plan's entries, counting them into scheduler's totals"""
+    for entry in upload_plan:
+        entry_size = size(entry[0])
+        if scheduler:
+            scheduler.planned(entry_size)
+        yield entry_size, entry
+    if scheduler:
+        scheduler.planned_all()
+
+
+def largest_first(sized_plan, lookahead):
+    """Yield (size, entry) pairs, the largest of the next lookahead in a wave first
+
+    Waves (see upload_plan.upload_wave) still go in order, so metadata
+    still goes before content, but within one big uploads start early
+    rather than being left to hold up the end of it. Only lookahead
+    entries are held at once, so the plan can still be streamed."""
+    heap = []
+    wave = None
+    for count, (size, entry) in enumerate(sized_plan):
+        entry_wave = upload_wave(entry[1])
+        if entry_wave != wave:
+            while heap:
+                yield heapq.heappop(heap)[2]
+            wave = entry_wave
+        heapq.heappush(heap, (-size, count, (size, entry)))
+        if len(heap) >= lookahead:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def format_mib(bytes):
+    return f"{bytes / 2**20:.1f} MiB"
+
+
+class Bandwidth:
+    """A cap on bytes sent per second, shared by every upload thread
+
+    Each request waits for its turn before sending, allowing a burst of
+    BURST seconds' worth. So the cap holds over a few seconds, though a
+    big part goes as fast as the link allows once its turn comes."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.due = time.monotonic()  # when what's been sent so far has been paid for
+        self.waits = 0
+
+    def spend(self, size):
+        """Wait until size more bytes can be sent within the cap"""
+        with self.lock:
+            now = time.monotonic()
+            self.due = max(self.due, now) + size / self.rate
+            delay = self.due - now - BURST
+            if delay > 0:
+                self.waits += 1
+        if delay > 0:
+            stats.add('bandwidth wait', 1, seconds=delay)
+            time.sleep(delay)
+
+
+class Concurrency:
+    """A gate letting limit uploads through at once, a limit that can change"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.peak = 0  # most active since last asked
+        self.changed = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.changed:
+            while self.active >= self.limit:
+                self.changed.wait()
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            yield
+        finally:
+            with self.changed:
+                self.active -= 1
+                self.changed.notify()
+
+    def set_limit(self, limit):
+        with self.changed:
+            self.limit = limit
+            self.changed.notify_all()
+
+    def take_peak(self):
+        with self.changed:
+            peak, self.peak = self.peak, self.active
+            return peak
+
+
+class MeteredClient:
+    """An S3 client whose uploads go through a scheduler
+
+    Anything that isn't sending data goes straight to the client."""
+
+    def __init__(self, s3_client, scheduler):
+        self.s3_client = s3_client
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+    def put_object(self, Body=b'', **kwargs):
+        return self.scheduler.request(
+            body_size(Body), lambda: self.s3_client.put_object(Body=Body, **kwargs))
+
+    def upload_part(self, Body=b'', **kwargs):
+        return self.scheduler.request(
+            body_size(Body), lambda: self.s3_client.upload_part(Body=Body, **kwargs))
+
+    def upload_file(self, filename, bucket, key, Callback=None, **kwargs):
+        # boto3 sends it in threads of its own, telling us as it goes, and
+        # taking back (with a negative size) what it has to send again
+        def sent(size):
+            self.scheduler.sending(size)
+            if Callback:
+                Callback(size)
+
+        return self.scheduler.request(0, lambda: self.s3_client.upload_file(
+            filename, bucket, key, Callback=sent, **kwargs))
+
+
+class UploadScheduler:
+    """Paces an Uploader's uploads, and reports their progress
+
+    Requests wait for the bandwidth cap, if there is one. How many
+    uploads run at once starts at workers and, if adapting, changes
+    every interval seconds, AIMD style: halved if S3 throttled us or more
+    than ERROR_RATE of requests failed (or were retried by botocore, which
+    retries throttling itself), otherwise one more if the last increase
+    raised throughput (of bytes or of requests) by GAIN, or it's been
+    PROBE_WINDOWS intervals since one. Not while the bandwidth cap is
+    what holds us back, or fewer ran than could, as more won't go any
+    faster.
+
+    Progress (files, bytes, rate and ETA) is logged every
+    PROGRESS_INTERVAL, against totals counted as the plan is read (see
+    sized), so the plan needn't be read twice. Until all of it has been,
+    they're only a lower bound, and there's no ETA."""
+
+    def __init__(self, workers, max_workers=DEFAULT_MAX_WORKERS, bytes_per_second=None,
+                 adapt=True, interval=ADJUST_INTERVAL):
+        self.adapt = adapt
+        self.interval = interval
+        self.max_workers = max(1, max_workers if adapt else workers)
+        self.concurrency = Concurrency(max(1, min(workers, self.max_workers)))
+        self.bandwidth = Bandwidth(bytes_per_second) if bytes_per_second else None
+        self.lock = threading.Lock()
+
+        self.total_files = self.total_bytes = 0  # so far
+        self.totalled = False  # all of the plan
+        self.files = 0    # uploaded or skipped
+        self.skipped = 0  # bytes already uploaded
+        self.sent = 0     # bytes
+        self.rate = None  # bytes per second, smoothed
+
+        now = time.monotonic()
+        self.started = now
+        self.last_progress = now
+        self.last_throughputs = None  # (bytes, requests) per second
+        self.increased = False
+        self.since_increase = 0
+        self._start_window(now)
+
+    def _start_window(self, now):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_requests = 0
+        self.window_errors = 0
+        self.window_throttled = 0
+        self.window_waits = self.bandwidth.waits if self.bandwidth else 0
+
+    def client(self, s3_client):
+        return MeteredClient(s3_client, self)
+
+    def slot(self):
+        """Context manager to hold while uploading a file"""
+        return self.concurrency.slot()
+
+    def planned(self, size):
+        """Count a file read from the plan into the totals"""
+        with self.lock:
+            self.total_files += 1
+            self.total_bytes += size
+
+    def planned_all(self):
+        with self.lock:
+            self.totalled = True
+
+    def request(self, size, call):
+        """Make a request sending size bytes, when the cap allows"""
+        if self.bandwidth and size:
+            self.bandwidth.spend(size)
+        try:
+            response = call()
+        except Exception as e:
+            self._record(0, e)
+            raise
+        self._record(size, retried=retries(response))
+        return response
+
+    def sending(self, size):
+        """Bytes being sent as part of a request, or taken back if negative
+
+        What's taken back still went over the link, so it's only left out
+        of the progress, which counts what has been sent for good."""
+        if self.bandwidth and size > 0:
+            self.bandwidth.spend(size)
+        with self.lock:
+            self.sent += size
+            self.window_bytes += max(0, size)
+            self._tick()
+
+    def _record(self, size, error=None, retried=0):
+        with self.lock:
+            self.sent += size
+            self.window_bytes += size
+            self.window_requests += 1
+            if retried:
+                self.window_errors += 1
+            if error is not None:
+                self.window_errors += 1
+                if is_throttled(error):
+                    self.window_throttled += 1
+            self._tick()
+
+    def finished(self):
+        with self.lock:
+            self.files += 1
+
+    def already_uploaded(self, size):
+        """Count a file skipped as already there as done"""
+        with self.lock:
+            self.files += 1
+            self.skipped += size
+            self.total_files += 1
+            self.total_bytes += size
+
+    def _tick(self):
+        now = time.monotonic()
+        if now - self.window_start >= self.interval:
+            self._adjust(now)
+        if now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            logger.info(self.progress())
+
+    def _adjust(self, now):
+        elapsed = now - self.window_start
+        throughput = self.window_bytes / elapsed
+        # Small files are held up by round trips rather than bandwidth
+        throughputs = (throughput, self.window_requests / elapsed)
+        self.rate = (throughput if self.rate is None
+                     else SMOOTHING * throughput + (1 - SMOOTHING) * self.rate)
+
+        if self.adapt:
+            limit = self.concurrency.limit
+            peak = self.concurrency.take_peak()
+            capped = self.bandwidth and self.bandwidth.waits > self.window_waits
+            logger.debug(f"{self.window_requests} requests, {self.window_errors} failed or retried, "
+                         f"{format_mib(throughput)}/s, {peak} of {limit} at once")
+            new_limit = limit
+
+            if self.window_throttled or self.window_errors > ERROR_RATE * self.window_requests:
+                new_limit = max(1, limit // 2)
+                logger.info(f"{self.window_errors} of {self.window_requests} requests failed or "
+                            f"were retried ({self.window_throttled} throttled), uploading "
+                            f"{new_limit} at once")
+            elif capped or peak < limit:
+                pass
+            elif (self.last_throughputs is None or self.since_increase >= PROBE_WINDOWS
+                    or (self.increased and any(new >= last * GAIN for new, last
+                                               in zip(throughputs, self.last_throughputs)))):
+                new_limit = min(self.max_workers, limit + 1)
+                logger.debug(f"Uploading {new_limit} at once, at {format_mib(throughput)}/s")
+
+            self.increased = new_limit > limit
+            self.since_increase = 0 if self.increased else self.since_increase + 1
+            if new_limit != limit:
+                self.concurrency.set_limit(new_limit)
+                stats.add('upload concurrency change', 1)
+
+        self.last_throughputs = throughputs
+        self._start_window(now)
+
+    def progress(self):
+        """A line on how it's going"""
+        done = self.sent + self.skipped
+        more = '' if self.totalled else '+'
+        line = (f"Uploaded {self.files} of {self.total_files}{more} files, "
+                f"{format_mib(done)} of {format_mib(self.total_bytes)}{more}, "
+                f"{self.concurrency.limit} at once")
+        # Until the first interval's done, the average so far
+        rate = self.rate or self.sent / max(time.monotonic() - self.started, 1e-3)
+        if rate:
+            line += f", {format_mib(rate)}/s"
+            if self.totalled:
+                eta = max(0, self.total_bytes - done) / rate
+                line += f", ETA {datetime.timedelta(seconds=round(eta))}"
+        return line
+
+    def log_progress(self):
+        with self.lock:
+            logger.info(self.progress())
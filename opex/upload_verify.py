@@ -0,0 +1,182 @@
+import os
+import base64
+import hashlib
+import threading
+import logging
+from dataclasses import dataclass
+from opex.fixity import ALGORITHMS, CHUNK_SIZE, normalise_fixities
+from opex.instrument import stats
+
+logger = logging.getLogger(__name__)
+
+# Sits next to the upload journal in the target folder
+REPORT_FILENAME = 'upload_verification.tsv'
+REPORT_HEADER = '#key\tsize\tchecksum\tvalue\tagainst\tattempts\tresult'
+
+# Checksums S3 checks uploads against as they arrive
+CHECKSUMS = ['MD5', 'SHA-256']
+DEFAULT_CHECKSUM = 'MD5'
+DEFAULT_RETRIES = 3
+
+# What an upload was checked against: the fixity to_opex knew for the
+# file, or just what was sent (as nothing was known)
+FIXITY = 'fixity'
+SENT = 'sent'
+
+# S3's error codes for data that didn't match its checksum
+CORRUPTED_CODES = {'BadDigest', 'XAmzContentSHA256Mismatch'}
+
+
+class TransferCorrupted(Exception):
+    """What S3 got isn't what was sent"""
+
+
+class SourceMismatch(Exception):
+    """A file doesn't match the fixity to_opex knew for it"""
+
+
+def is_corrupted(error):
+    if isinstance(error, TransferCorrupted):
+        return True
+    # botocore's ClientError, or anything shaped like it
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in CORRUPTED_CODES
+
+
+@dataclass
+class Check:
+    """How an upload was checked, for the report"""
+    checksum: str
+    value: str  # hex, of the whole file
+    against: str = SENT
+    attempts: int = 1
+    confirmed: bool = True  # False if S3 didn't say it had checked
+
+    def result(self):
+        return 'verified' if self.confirmed else 'unconfirmed'
+
+
+class Digests:
+    """Hashes of several fixity types at once, fed data as it's read"""
+
+    def __init__(self, fixity_types):
+        self.hashers = {fixity_type: hashlib.new(ALGORITHMS[fixity_type])
+                        for fixity_type in fixity_types}
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def feed(self, body):
+        """Hash a request body: bytes, or a file, read from the start and rewound after"""
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            self.update(body)
+            return
+        body.seek(0)
+        while chunk := body.read(CHUNK_SIZE):
+            self.update(chunk)
+        body.seek(0)
+
+    def digest(self, fixity_type):
+        return self.hashers[fixity_type].digest()
+
+    def hexdigest(self, fixity_type):
+        return self.hashers[fixity_type].hexdigest()
+
+    def check(self, known, name):
+        """Raise SourceMismatch unless the data matched the known fixities"""
+        for fixity_type, value in known.items():
+            actual = self.hexdigest(fixity_type)
+            if actual != value:
+                raise SourceMismatch(f"{name} has {fixity_type} {actual}, not {value} "
+                                     f"as when it was prepared")
+
+
+def known_fixities(fixities, name=None):
+    """The fixities (type -> hex value) we can check, normalised
+
+    One that isn't a hex digest is logged and left out, so the upload
+    is checked against what was sent instead."""
+    return normalise_fixities({fixity_type: value for fixity_type, value in fixities.items()
+                               if fixity_type in ALGORITHMS}, name)
+
+
+def checksum_args(checksum, digest):
+    """Arguments for a request that has S3 check its data against digest"""
+    encoded = base64.b64encode(digest).decode('ascii')
+    if checksum == 'MD5':
+        return {'ContentMD5': encoded}
+    return {'ChecksumSHA256': encoded}
+
+
+def composite_checksum(part_digests):
+    """The SHA-256 S3 gives a multipart upload: of its parts' SHA-256s"""
+    digest = hashlib.sha256(b''.join(part_digests)).digest()
+    return base64.b64encode(digest).decode('ascii') + f"-{len(part_digests)}"
+
+
+def confirmed(response, args):
+    """Whether S3 says it checked what args asked it to
+
+    A bad Content-MD5 fails the request, so S3 has always checked that.
+    An additional checksum is sent back; if it isn't, S3 (or something
+    like it) doesn't do them, and if it differs, what arrived was
+    corrupted."""
+    if 'ContentMD5' in args:
+        return True
+    echoed = response.get('ChecksumSHA256')
+    if echoed is None:
+        return False
+    if echoed != args['ChecksumSHA256']:
+        raise TransferCorrupted(f"S3 got SHA-256 {echoed}, not {args['ChecksumSHA256']}")
+    return True
+
+
+def send(request, retries, name):
+    """Make a request, again (up to retries times) if S3 says its data was corrupted
+
+    Returns the response and how many attempts it took."""
+    attempt = 1
+    while True:
+        try:
+            return request(), attempt
+        except Exception as e:
+            if attempt > retries or not is_corrupted(e):
+                raise
+            logger.warning(f"{name} was corrupted on the way, sending it again: {e}")
+            stats.add('upload retry', 1)
+            attempt += 1
+
+
+class VerificationReport:
+    """Append-only record of how each upload was checked
+
+    A line per upload: its key and size, the checksum S3 checked and the
+    file's value of it, whether it was checked against the fixity to_opex
+    knew or just what was sent, the attempts it took and the result:
+    verified, unconfirmed (S3 didn't say it checked) or why it failed.
+    Lines are flushed as they are written, like the journal's."""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.lock = threading.Lock()
+        started = append and os.path.exists(path)
+        self.file = open(path, 'a' if append else 'w')
+        if not started:
+            self._write(REPORT_HEADER)
+
+    def _write(self, line):
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def record(self, key, size, check):
+        self._write(f"{key}\t{size}\t{check.checksum}\t{check.value}\t{check.against}\t"
+                    f"{check.attempts}\t{check.result()}")
+
+    def failed(self, key, error):
+        reason = ' '.join(str(error).split())  # on one line
+        self._write(f"{key}\t\t\t\t\t\tfailed: {reason}")
+
+    def close(self):
+        self.file.close()
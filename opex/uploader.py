@@ -0,0 +1,470 @@
+import os
+import argparse
+import datetime
+import sys
+import threading
+import configparser
+import logging
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from opex.instrument import stats
+from opex.fixity import algorithm_name
+from opex.multipart import MultipartWriter
+from opex.upload_journal import UploadJournal, JOURNAL_FILENAME, list_uploaded, still_to_upload
+from opex.upload_plan import load_plan, upload_wave, parse_fixities, format_fixities
+import opex.fixity_cache as fixity_cache
+import opex.upload_verify as upload_verify
+import opex.batches as batches
+from opex.upload_scheduler import (UploadScheduler, DEFAULT_MAX_WORKERS, DEFAULT_LOOKAHEAD,
+                                   largest_first, sized, body_size)
+from opex.upload_verify import Check, Digests, VerificationReport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+MULTIPART_THRESHOLD = 64  # MiB
+MULTIPART_CHUNKSIZE = 16  # MiB
+
+
+# Map upload plan to actual upload location with timestamp
+def map_upload(dest, container, dir):
+    if dest == '/root.opex':
+        # Special case
+        dest = dest.replace('root.opex', f"{dir}.opex")
+
+    return f"{container}/{dir}{dest}"
+
+
+def read_bucket_config(config_file, bucket):
+    """(access key, secret key, bucket name) for a bucket in the S3 config"""
+    config = configparser.ConfigParser()
+    config.read(os.path.expanduser(config_file))
+
+    if not bucket in config:
+        print(f"No bucket named {bucket} in config file {config_file}")
+        sys.exit(1)
+
+    return (config[bucket]['ACCESS_KEY'], config[bucket]['SECRET_KEY'],
+            config[bucket]['BUCKET_NAME'])
+
+
+def upload_dir_name(target_dir):
+    # We will use this to allow repeated uploads of the same material
+    # without overwriting
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H%M")
+
+    return f"{os.path.basename(target_dir)}-{timestamp}"  # Dir for this particular upload
+
+
+def with_cached_fixities(upload_plan, cache):
+    """Fill in the fixities a plan lacks (as a to_upload.txt does) from to_opex's cache"""
+    for source, target, fixities in upload_plan:
+        if not fixities:
+            fixities = format_fixities(cache.lookup(source), source)
+        yield [source, target, fixities]
+
+
+def make_client(access_key, secret_key, workers):
+    # One client shared by all threads, with enough connections for them
+    # all (and the threads each multipart upload uses)
+    config = Config(max_pool_connections=max(10, workers * 2),
+                    retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.client('s3', aws_access_key_id=access_key,
+                        aws_secret_access_key=secret_key, config=config)
+
+
+class Uploader:
+    """Upload a plan to a bucket with a pool of threads
+
+    The plan is uploaded in waves (see upload_plan.upload_wave), each
+    wave concurrently, and everything in one wave lands before the next
+    starts. If anything in a wave fails we stop there, rather than send
+    content whose metadata didn't make it. Completed uploads are
+    recorded in the journal, if there is one.
+
+    With a checksum (see upload_verify.CHECKSUMS) S3 checks everything
+    as it arrives (see put_checked), and how is recorded in the report,
+    if there is one.
+
+    Within a wave the largest of the next lookahead entries go first
+    (see upload_scheduler.largest_first). A scheduler, if given, paces
+    the uploads and reports progress, with up to its max_workers at once
+    rather than workers."""
+
+    def __init__(self, s3_client, bucket, workers=DEFAULT_WORKERS,
+                 transfer_config=None, dry_run=False, journal=None,
+                 checksum=None, retries=upload_verify.DEFAULT_RETRIES, report=None,
+                 scheduler=None, lookahead=DEFAULT_LOOKAHEAD):
+        self.s3_client = scheduler.client(s3_client) if scheduler else s3_client
+        self.bucket = bucket
+        self.workers = scheduler.max_workers if scheduler else workers
+        self.transfer_config = transfer_config or TransferConfig()
+        self.part_size = self.transfer_config.multipart_chunksize  # when checking uploads
+        self.dry_run = dry_run
+        self.journal = journal
+        self.checksum = checksum
+        self.retries = retries
+        self.report = report
+        self.scheduler = scheduler
+        self.lookahead = lookahead
+        self.print_lock = threading.Lock()
+
+    def size(self, source):
+        """Bytes to upload for source, or 0 if it can't be read (and so will fail)"""
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            return 0
+
+    def put(self, source, target, fixities='', size=None):
+        """Upload a file, returning its (size, ETag, how it was checked)
+
+        size is the file's, if upload already knows it."""
+        if self.checksum:
+            return self.put_checked(source, target, fixities, size)
+
+        if size is None:
+            size = os.path.getsize(source)
+
+        if size < self.transfer_config.multipart_threshold:
+            # A plain PUT tells us the ETag for free
+            with open(source, 'rb') as body:
+                response = self.s3_client.put_object(Bucket=self.bucket, Key=target,
+                                                     Body=body)
+        else:
+            self.s3_client.upload_file(source, self.bucket, target,
+                                       Config=self.transfer_config)
+            response = self.s3_client.head_object(Bucket=self.bucket, Key=target)
+
+        return size, response['ETag'].strip('"'), None
+
+    def put_checked(self, source, target, fixities, size=None):
+        """Upload a file for S3 to check as it arrives
+
+        A file under the multipart threshold is a plain PUT, streamed from
+        the file (see put_data), and anything bigger a multipart upload,
+        read just once, a part (part_size) at a time. A PUT is checked
+        against the fixity to_opex knew, if it's of the checksum's type,
+        otherwise against a checksum of what was read; a multipart
+        upload's parts against theirs. What was read is checked against
+        whatever fixities were known, so a file that has changed isn't
+        uploaded (SourceMismatch). Data S3 says was corrupted on the way
+        is sent again."""
+        part_size = self.part_size
+        if size is None:
+            size = os.path.getsize(source)
+        if size < self.transfer_config.multipart_threshold:
+            with open(source, 'rb') as body:
+                return self.put_data(body, target, fixities, source)
+
+        known = upload_verify.known_fixities(parse_fixities(fixities), source)
+        digests = Digests({self.checksum, *known})
+        writer = MultipartWriter(self.s3_client, self.bucket, target, part_size,
+                                 self.checksum, self.retries, digests)
+        try:
+            with open(source, 'rb') as f:
+                while chunk := f.read(part_size):
+                    writer.write(chunk)
+            digests.check(known, source)
+        except BaseException:
+            writer.abort()
+            raise
+        etag = writer.close().strip('"')
+
+        check = Check(self.checksum, digests.hexdigest(self.checksum),
+                      upload_verify.FIXITY if known else upload_verify.SENT,
+                      writer.attempts, writer.confirmed)
+        return writer.size, etag, check
+
+    def put_data(self, data, target, fixities, name=None):
+        """PUT data (from name, if it's a file) for S3 to check, as put_checked
+
+        data is bytes or a file open at its start. A file is read once to
+        hash it, unless S3 can check it against a known fixity, and then
+        again as it's sent, so only a chunk of it is held at a time."""
+        checksum = self.checksum
+        size = body_size(data)
+        rewind = getattr(data, 'seek', None)
+        known = upload_verify.known_fixities(parse_fixities(fixities), name or target)
+        if checksum in known:
+            # S3 checks it against the fixity, so needn't be hashed here
+            check = Check(checksum, known[checksum], upload_verify.FIXITY)
+            digest = bytes.fromhex(known[checksum])
+        else:
+            digests = Digests({checksum, *known})
+            digests.feed(data)
+            digests.check(known, name or target)
+            check = Check(checksum, digests.hexdigest(checksum),
+                          upload_verify.FIXITY if known else upload_verify.SENT)
+            digest = digests.digest(checksum)
+        args = upload_verify.checksum_args(checksum, digest)
+
+        def request():
+            if rewind:
+                rewind(0)
+            try:
+                response = self.s3_client.put_object(Bucket=self.bucket, Key=target,
+                                                     Body=data, **args)
+            except Exception as e:
+                if checksum in known and upload_verify.is_corrupted(e):
+                    # Is it the data that doesn't match the fixity, not the way there?
+                    digests = Digests([checksum])
+                    digests.feed(data)
+                    digests.check({checksum: known[checksum]}, name or target)
+                raise
+            check.confirmed = upload_verify.confirmed(response, args)
+            return response
+
+        response, check.attempts = upload_verify.send(request, self.retries, target)
+        return size, response['ETag'].strip('"'), check
+
+    def upload_one(self, source, target, fixities='', size=None):
+        with self.print_lock:
+            print(f"Upload {source}\n\tto {self.bucket}\n\tas {target}")
+
+        if self.dry_run:
+            return
+
+        try:
+            with self.scheduler.slot() if self.scheduler else nullcontext():
+                with stats.timer('upload') as timer:
+                    size, etag, check = self.put(source, target, fixities, size)
+                    timer.bytes = size
+        except Exception as e:
+            if self.report:
+                self.report.failed(target, e)
+            raise
+
+        if self.scheduler:
+            self.scheduler.finished()
+        if self.journal:
+            self.journal.record(target, size, etag)
+        if self.report and check:
+            self.report.record(target, size, check)
+
+    def upload(self, upload_plan):
+        """Upload [source, target, fixities] entries, returning those that failed
+
+        The plan must be in upload order (see upload_plan.order_key). It
+        is consumed as it goes, with only a few uploads per worker in
+        flight, so it can be streamed from a file."""
+        in_flight = deque()
+        failed = []
+        limit = max(1, self.workers) * 4
+        wave = None
+        # Each source is looked at once, as it's read from the plan
+        sized_plan = sized(upload_plan, self.size, self.scheduler)
+        if self.lookahead:
+            sized_plan = largest_first(sized_plan, self.lookahead)
+
+        def wait(limit):
+            while len(in_flight) > limit:
+                (source, target, fixities), future = in_flight.popleft()
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Failed to upload {source} as {target}: {e}")
+                    failed.append([source, target, fixities])
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers),
+                                thread_name_prefix='upload') as pool:
+            for size, (source, target, fixities) in sized_plan:
+                entry_wave = upload_wave(target)
+                if entry_wave != wave:
+                    if wave is not None and entry_wave < wave:
+                        raise ValueError(f"Upload plan out of order at {target}")
+                    wait(0)  # the last wave has to land first
+                    if failed:
+                        return failed
+                    wave = entry_wave
+
+                with stats.timer('upload queue', count=1):
+                    wait(limit - 1)
+                in_flight.append(([source, target, fixities],
+                                  pool.submit(self.upload_one, source, target, fixities,
+                                              size)))
+
+            wait(0)
+
+        if self.scheduler:
+            self.scheduler.log_progress()
+        return failed
+
+
+def main(argv):
+    argv.pop(0)  # why do I need this?
+
+    parser = argparse.ArgumentParser(prog='upload',
+                                     description='Tool to upload files to preservica')
+    parser.add_argument('--config', help='Config file (default ~/S3.ini)', default='~/S3.ini')
+    parser.add_argument('-t', '--target', required=True, help='The folder containing the opex files')
+    parser.add_argument('--batches', action='store_true',
+                        help='The target is a folder of batches from split_batches. Upload '
+                             'each in turn, into a dir of its own, to ingest while the next '
+                             'one uploads')
+    parser.add_argument('-b', '--bucket', required=True, help="Bucket (defined in config file)")
+    parser.add_argument('-c', '--container', required=True, help="Container to upload to")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Explain what is happening')
+    parser.add_argument('-d', '--dry-run', action='store_true',
+                        help="Don't actually perform any actions, for testing")
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Carry on with the last upload of this target, uploading '
+                             'only what is missing or different')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'Files to upload at once, to start with (default {DEFAULT_WORKERS})')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f'Most files to upload at once, as that adapts to the throughput '
+                             f'and to errors and throttling (default {DEFAULT_MAX_WORKERS})')
+    parser.add_argument('--fixed-workers', action='store_true',
+                        help='Always upload --workers files at once, rather than adapt')
+    parser.add_argument('--max-mib-per-sec', type=float,
+                        help='Cap on upload bandwidth in MiB per second, for a shared link '
+                             '(default none)')
+    parser.add_argument('--lookahead', type=int, default=DEFAULT_LOOKAHEAD,
+                        help=f'Upload the largest of the next this many files first, so big ones '
+                             f'start early, metadata still before content (default '
+                             f'{DEFAULT_LOOKAHEAD}, 0 for plan order)')
+    parser.add_argument('--multipart-threshold', type=int, default=MULTIPART_THRESHOLD,
+                        help=f'Use multipart uploads for files over this many MiB '
+                             f'(default {MULTIPART_THRESHOLD})')
+    parser.add_argument('--multipart-chunksize', type=int, default=MULTIPART_CHUNKSIZE,
+                        help=f'Size of multipart upload parts in MiB (default {MULTIPART_CHUNKSIZE})')
+    parser.add_argument('--checksum', default=upload_verify.DEFAULT_CHECKSUM,
+                        help=f'Checksum S3 checks each upload against, from '
+                             f'{", ".join(upload_verify.CHECKSUMS)} (default '
+                             f'{upload_verify.DEFAULT_CHECKSUM}). Files over the multipart '
+                             f'threshold are read a part at a time, smaller ones streamed')
+    parser.add_argument('--no-verify', action='store_true',
+                        help="Don't have S3 check uploads, or write a verification report")
+    parser.add_argument('--fixity-cache',
+                        help=f"to_opex's fixity cache, for the fixities of files the upload "
+                             f"plan lacks them for (default {fixity_cache.DEFAULT_FILENAME} in "
+                             f"target, if it's there)")
+    parser.add_argument('--retries', type=int, default=upload_verify.DEFAULT_RETRIES,
+                        help=f'Times to send data again if S3 says it was corrupted on the way '
+                             f'(default {upload_verify.DEFAULT_RETRIES})')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Report time, counts and bytes uploaded at the end, '
+                             'as text (the default) or json')
+    parser.add_argument('--stats-file', help='Write the --stats report here rather than print it')
+
+    args = parser.parse_args(argv)
+
+    checksum = None
+    if not args.no_verify:
+        try:
+            checksum = algorithm_name(args.checksum)
+        except ValueError as e:
+            parser.error(str(e))
+        if checksum not in upload_verify.CHECKSUMS:
+            parser.error(f"S3 can't check {checksum}, only {', '.join(upload_verify.CHECKSUMS)}")
+
+    format = '%(levelname)s\t%(message)s'
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG, format=format)
+    else:
+        logging.basicConfig(level=logging.INFO, format=format)
+
+    if args.stats:
+        stats.enable()
+
+    # get correct credentials for required bucket
+    ACCESS_KEY, SECRET_KEY, BUCKET_NAME = read_bucket_config(args.config, args.bucket)
+    s3_client = make_client(ACCESS_KEY, SECRET_KEY,
+                            args.workers if args.fixed_workers else max(args.workers, args.max_workers))
+
+    if args.batches:
+        try:
+            targets = batches.read_index(args.target)
+        except OSError as e:
+            parser.error(f"{args.target} has no batches: {e}")
+    else:
+        targets = [args.target]
+
+    for number, target_dir in enumerate(targets, 1):
+        if args.batches:
+            print(f"Batch {number} of {len(targets)}: {target_dir}")
+        upload_dir, failed = upload_target(s3_client, BUCKET_NAME, target_dir, args, checksum)
+        if failed:
+            break
+        if args.batches:
+            print(f"Batch {number} done, ready to ingest: {upload_dir} in "
+                  f"{BUCKET_NAME}/{args.container}")
+
+    if args.stats:
+        stats.write_report(args.stats, args.stats_file)
+
+    if failed:
+        print(f"\n{len(failed)} uploads failed, stopped. See {upload_dir} in {BUCKET_NAME}/{args.container}")
+        sys.exit(1)
+
+    print(f"\nFinished. See {upload_dir} in {BUCKET_NAME}/{args.container}")
+
+
+def upload_target(s3_client, bucket, target_dir, args, checksum):
+    """Upload the plan in a target folder into a timestamped dir of its own
+
+    Returns the dir and the uploads that failed."""
+    upload_plan = load_plan(target_dir)
+    journal_path = os.path.join(target_dir, JOURNAL_FILENAME)
+
+    # A batch not started yet starts now, when resuming the rest
+    resume = args.resume and (not args.batches or os.path.exists(journal_path))
+    if resume:
+        # Back into the same timestamped dir as before
+        journal = UploadJournal.resume(journal_path)
+        upload_dir = journal.upload_dir
+        print(f"Resuming upload to {upload_dir}")
+    else:
+        upload_dir = upload_dir_name(target_dir)
+        journal = None if args.dry_run else UploadJournal.start(journal_path, upload_dir)
+
+    report = None
+    if checksum and not args.dry_run:
+        report = VerificationReport(os.path.join(target_dir, upload_verify.REPORT_FILENAME),
+                                    append=resume)
+
+    scheduler = None
+    if not args.dry_run:
+        bytes_per_second = args.max_mib_per_sec * 2**20 if args.max_mib_per_sec else None
+        scheduler = UploadScheduler(args.workers, args.max_workers, bytes_per_second,
+                                    adapt=not args.fixed_workers)
+
+    cache = None
+    cache_path = args.fixity_cache or os.path.join(target_dir, fixity_cache.DEFAULT_FILENAME)
+    if checksum and os.path.exists(cache_path):
+        cache = fixity_cache.open_cache(cache_path)
+        if cache:
+            upload_plan = with_cached_fixities(upload_plan, cache)
+
+    timestamped_upload_plan = (
+        [source, map_upload(target, args.container, upload_dir), fixities]
+        for source, target, fixities in upload_plan)
+
+    if resume:
+        uploaded = list_uploaded(s3_client, bucket, f"{args.container}/{upload_dir}")
+        timestamped_upload_plan = still_to_upload(timestamped_upload_plan, journal, uploaded,
+                                                  scheduler.already_uploaded if scheduler else None)
+
+    # Upload
+    transfer_config = TransferConfig(multipart_threshold=args.multipart_threshold * 2**20,
+                                     multipart_chunksize=args.multipart_chunksize * 2**20)
+
+    uploader = Uploader(s3_client, bucket, args.workers, transfer_config, args.dry_run,
+                        journal, checksum, args.retries, report, scheduler, args.lookahead)
+    failed = uploader.upload(timestamped_upload_plan)
+
+    if journal:
+        journal.close()
+    if cache:
+        cache.close()
+    if report:
+        report.close()
+        print(f"Verification report is: {report.path}")
+
+    return upload_dir, failed
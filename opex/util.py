@@ -1,9 +1,11 @@
 from dataclasses import dataclass
+import os
 import xml.etree.ElementTree as ET
 import importlib.util
 import sys
 import logging
-from collections import defaultdict
+from typing import NamedTuple
+from concurrent.futures import Executor, Future
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +18,45 @@ def load_module(file_name, module_name):
     return module
 
 
-@dataclass
+def load_config(file_name, module_name="opex_config"):
+    """A config: rules (a .toml file) or, for anything they can't do, Python"""
+    if file_name.endswith('.toml'):
+        from opex.rules import load_rules
+        return load_rules(file_name)
+    return load_module(file_name, module_name)
+
+
+class InlineExecutor(Executor):
+    """An executor that just runs things as they are submitted"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class FileStat(NamedTuple):
+    """The parts of a stat we use, in a fraction of os.stat_result's memory"""
+    st_dev: int
+    st_ino: int
+    st_size: int
+    st_mtime_ns: int
+
+    @classmethod
+    def of(cls, stat):
+        return cls(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def intern(name):
+    # Ids and names turn up again and again (an asset's files, its dir)
+    return sys.intern(name) if type(name) is str else name
+
+
+# Slotted, as there's one of these for every file in a collection
+@dataclass(slots=True)
 class AssetInfo:
     filename: str
     asset_id: str
@@ -25,40 +65,65 @@ class AssetInfo:
     fixity_type: str
     fixity: str
     is_metadata: bool = False
+    stat: FileStat = None  # filled in from the scan if available
+    fixities: dict = None  # type -> value, e.g. computed ones. None until there are some
+
+    def __post_init__(self):
+        self.asset_id = intern(self.asset_id)
+        self.fixity_type = intern(self.fixity_type)
+
+    def add_fixities(self, fixities):
+        if self.fixities is None:
+            self.fixities = {}
+        self.fixities.update(fixities)
+
+    def all_fixities(self):
+        """All known fixities, type -> value, starting with the config's one"""
+        extra = self.fixities or {}
+        if self.fixity:
+            return {self.fixity_type: self.fixity, **extra}
+        else:
+            return dict(extra)
 
 
 class Dir:
 
+    __slots__ = ('parent', 'name', 'subdirs', 'files', 'dir_id', '_path')
+
     def __init__(self, name: str = None, dir_id: str = None, parent=None):
         self.parent = parent
-        self.name = name
+        self.name = intern(name)
         self.subdirs = {}
-        self.files = defaultdict(list)  # id -> [file(s)]
-        self.dir_id = dir_id
+        self.files = {}  # id -> [file(s)]
+        self.dir_id = intern(dir_id)
+        self._path = None
 
     def __str__(self):
         return f"<DIR {self.name} [{id(self)}]>"
 
     def add(self, path: list, fileinfo):
-        first, *rest = path
-
-        # Two options: simple path a,b,c
-        # or (a, a_id), (b, b_id), (c, c_id)
-        if type(first) is tuple:
-            dirname, dir_id = first
-        else:
-            dirname = dir_id = first
-
-        if dirname not in self.subdirs:
-            self.subdirs[dirname] = Dir(dirname, dir_id, self)
-
-        if rest:
-            self.subdirs[dirname].add(rest, fileinfo)
-        else:
-            self.subdirs[dirname].add_file(fileinfo)
+        dir = self
+        for part in path:
+            # Two options: simple path a,b,c
+            # or (a, a_id), (b, b_id), (c, c_id)
+            if type(part) is tuple:
+                dirname, dir_id = part
+            else:
+                dirname = dir_id = part
+
+            subdir = dir.subdirs.get(dirname)
+            if subdir is None:
+                subdir = dir.subdirs[dirname] = Dir(dirname, dir_id, dir)
+            dir = subdir
+
+        dir.add_file(fileinfo)
 
     def add_file(self, fileinfo):
-        self.files[fileinfo.asset_id].append(fileinfo)
+        files = self.files.get(fileinfo.asset_id)
+        if files is None:
+            self.files[fileinfo.asset_id] = [fileinfo]
+        else:
+            files.append(fileinfo)
 
     def all_subdirs(self, top_down=True):
         if top_down:  # Visit this first
@@ -74,10 +139,13 @@ class Dir:
         return not self.subdirs
 
     def path(self):
-        if self.parent:
-            return self.parent.path() + '/' + self.name
-        else:
-            return ''
+        # Names never change, so work this out once
+        if self._path is None:
+            if self.parent:
+                self._path = self.parent.path() + '/' + self.name
+            else:
+                self._path = ''
+        return self._path
 
     def remove_file(self, fileinfo):
         self.files[fileinfo.asset_id].remove(fileinfo)
@@ -109,6 +177,27 @@ def subelem(parent, ns, tag, text=None, **kwargs):
     return elem
 
 
+# For writing fixed-shape documents directly, exactly as ElementTree
+# (after ET.indent) would: same escaping, same indentation
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def escape_attrib(text):
+    return (escape_text(text).replace('"', '&quot;').replace('\r', '&#13;')
+            .replace('\n', '&#10;').replace('\t', '&#09;'))
+
+
+def leaf(indent, tag, text=None, **attrib):
+    """A line of XML for an element without children"""
+    attrs = ''.join(f' {name}="{escape_attrib(value)}"'
+                    for name, value in attrib.items())
+    if text:  # as subelem, empty text means no text
+        return f'{indent}<{tag}{attrs}>{escape_text(text)}</{tag}>\n'
+    else:
+        return f'{indent}<{tag}{attrs} />\n'
+
+
 # Work out a good name (prefix) for a number of files
 # falling back to munged id if not possible
 def pick_name(id, files: list[AssetInfo]):
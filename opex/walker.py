@@ -0,0 +1,71 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Directory listings are mostly waiting on the file system (especially
+# over NFS) so we can afford quite a few threads
+DEFAULT_WORKERS = 8
+
+
+def scan_dir(path):
+    """List a single directory, returning (files, subdirs)
+
+    files are DirEntry objects sorted by name, with their stat already
+    fetched (and cached on the entry) so it happens in the worker thread.
+    subdirs are paths sorted by name. Like os.walk we don't descend into
+    symlinked directories, and unreadable directories are logged and
+    treated as empty."""
+    files = []
+    subdirs = []
+
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        entry.stat()  # cache stat on the entry
+                        files.append(entry)
+                except OSError as e:
+                    logger.warning(f"Unable to stat {entry.path}: {e}")
+    except OSError as e:
+        logger.warning(f"Unable to scan {path}: {e}")
+
+    files.sort(key=lambda entry: entry.name)
+    subdirs.sort()
+
+    return files, subdirs
+
+
+def walk(sources, workers=DEFAULT_WORKERS, prefetch=None):
+    """Walk the source folders, yielding (dirpath, file entries)
+
+    Directories are listed by a pool of threads, up to `prefetch`
+    directories ahead of the consumer, across subtrees and sources. The
+    results are always yielded in the same order (sources in the order
+    given, then sorted pre-order) whatever the number of workers."""
+
+    if prefetch is None:
+        prefetch = workers * 4
+
+    with ThreadPoolExecutor(max_workers=max(1, workers),
+                            thread_name_prefix='walker') as pool:
+        # Stack of [path, future], future is None until submitted
+        stack = [[source, None] for source in reversed(sources)]
+
+        while stack:
+            # Make sure the next few directories we'll visit are being scanned
+            for node in stack[-prefetch:]:
+                if node[1] is None:
+                    node[1] = pool.submit(scan_dir, node[0])
+
+            path, future = stack.pop()
+            files, subdirs = future.result()
+
+            yield path, files
+
+            stack.extend([subdir, None] for subdir in reversed(subdirs))
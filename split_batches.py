@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+import opex.batches
+import sys
+
+if __name__ == '__main__':
+    opex.batches.main(sys.argv)
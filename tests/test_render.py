@@ -0,0 +1,124 @@
+import logging
+import pytest
+from unittest import mock
+import xml.etree.ElementTree as ET
+from bench.serializer import AWKWARD, fixed_uuids
+from opex.util import AssetInfo, Dir
+import opex.opex_generator as opex_generator
+import opex.pax_generator as pax_generator
+
+# A value of each length, so every fixity type can be carried at once
+FIXITIES = {'MD5': 'd41d8cd98f00b204e9800998ecf8427e',
+            'SHA-1': 'da39a3ee5e6b4b0d3255bfef95601890afd80709',
+            'SHA-256': 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855',
+            'SHA-512': 'cf83e1357eefb8bdf1542850d66d8007d620e4050b5715dc83f4a921d36ce9ce'
+                       '47d0d13c5d85f2b0ff8318d2877eec2f63b931bd47417a81a538327af927da3e'}
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    # Some samples lack fixities, which is logged
+    logging.getLogger('opex').setLevel(logging.ERROR)
+    yield
+    logging.getLogger('opex').setLevel(logging.NOTSET)
+
+
+def asset(name, fixity=None, fixities=None, is_access=False, is_metadata=False, n=0):
+    return AssetInfo(filename=f"{name}.tif", asset_id=f"id/{name}", source_path=f"/src/{n}",
+                     is_access=is_access, fixity_type='MD5' if fixity else None, fixity=fixity,
+                     is_metadata=is_metadata, fixities=fixities)
+
+
+def expected_file(fileinfo):
+    return opex_generator.serialize(opex_generator.output_file(fileinfo, None))
+
+
+def expected_dir(dir):
+    return opex_generator.serialize(opex_generator.output_dir(dir, None))
+
+
+def expected_xip(id, files, sizes):
+    with mock.patch('uuid.uuid4', fixed_uuids()):
+        return ET.tostring(pax_generator.create_xip(id, files, sizes).getroot(), encoding='utf-8')
+
+
+def rendered_xip(id, files, sizes):
+    with mock.patch('uuid.uuid4', fixed_uuids()):
+        return pax_generator.render_xip(id, files, sizes)
+
+
+@pytest.mark.parametrize('name', AWKWARD)
+def test_file_escaping(name):
+    fileinfo = asset(name, fixity=name or None, fixities={'SHA-256': name} if name else None)
+    assert opex_generator.render_file(fileinfo, None) == expected_file(fileinfo)
+
+
+@pytest.mark.parametrize('fixity, fixities', [
+    (None, None),                                       # no fixities at all
+    (FIXITIES['MD5'], None),                            # just the config's
+    (None, {'SHA-256': FIXITIES['SHA-256']}),           # just computed ones
+    (FIXITIES['MD5'], {k: v for k, v in FIXITIES.items() if k != 'MD5'}),  # every type
+])
+def test_file_fixities(fixity, fixities):
+    fileinfo = asset('file', fixity, fixities)
+    rendered = opex_generator.render_file(fileinfo, None)
+    assert rendered == expected_file(fileinfo)
+    assert rendered.count(b'<opex:Fixity ') == len(fileinfo.all_fixities())
+
+
+def test_file_non_ascii():
+    fileinfo = asset('café 日本', FIXITIES['MD5'])
+    rendered = opex_generator.render_file(fileinfo, None)
+    assert rendered == expected_file(fileinfo)
+    assert rendered.isascii()  # as character references
+    assert ET.fromstring(rendered).find('.//{*}Identifier').text == 'id/café 日本'
+
+
+def dir_with(files=(), subdirs=(), name='dir'):
+    dir = Dir(name, f"id/{name}")
+    for n, file_name in enumerate(files):
+        dir.add_file(asset(file_name, is_metadata=n % 2 == 1, n=n))
+    for subdir in subdirs:
+        dir.subdirs[subdir] = Dir(subdir, subdir, dir)
+    return dir
+
+
+@pytest.mark.parametrize('dir', [
+    Dir(),                                         # the root: no name or id
+    dir_with(),                                    # empty Files and Folders
+    dir_with(files=['a', 'b']),                    # empty Folders
+    dir_with(subdirs=['x', 'y']),                  # empty Files
+    dir_with(files=AWKWARD, subdirs=AWKWARD),      # escaping and non-ASCII
+    dir_with(files=['f'], subdirs=['s'], name='a & <b> café'),
+], ids=['root', 'empty', 'files', 'folders', 'awkward', 'awkward id'])
+def test_dir(dir):
+    assert opex_generator.render_dir(dir, None) == expected_dir(dir)
+
+
+def xip_files(names):
+    return [asset(name, fixity=FIXITIES['MD5'] if n % 3 else None,
+                  fixities={k: v for k, v in FIXITIES.items() if k != 'MD5'} if n % 2 else None,
+                  is_access=n % 2 == 1, n=n)
+            for n, name in enumerate(names)]
+
+
+@pytest.mark.parametrize('id, files', [
+    ('none', []),
+    ('one', xip_files(['only'])),
+    ('several', xip_files(['a', 'b', 'c', 'd'])),
+    ('a & <b> "c"', xip_files(AWKWARD)),
+    ('café 日本', xip_files(['café', '日本'])),
+], ids=['no files', 'one file', 'several fixities', 'escaping', 'non-ASCII'])
+def test_xip(id, files):
+    sizes = {fileinfo.source_path: 10 ** n for n, fileinfo in enumerate(files)}
+    rendered = rendered_xip(id, files, sizes)
+    assert rendered == expected_xip(id, files, sizes)
+    ET.fromstring(rendered)
+
+
+def test_xip_sizes_from_stat():
+    files = xip_files(['a', 'b'])
+    for n, fileinfo in enumerate(files):
+        fileinfo.stat = mock.Mock(st_size=1234 + n)
+    assert rendered_xip('stat', files, None) == expected_xip('stat', files, None)
+    assert b'<xip:FileSize>1235</xip:FileSize>' in rendered_xip('stat', files, None)
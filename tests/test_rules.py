@@ -0,0 +1,136 @@
+import os
+import pytest
+from opex.rules import RuleConfig, load_rules
+
+CONF_FB = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'conf_fb.toml')
+
+PATTERN = r'(?P<asset>(?P<parent>FB(?:-\d+)+)-\d\d\d+)\.(?P<ext>\w+)$'
+
+
+def config(*rules, **settings):
+    return RuleConfig({**settings, 'rule': list(rules)})
+
+
+def rule(pattern=PATTERN, target=('{parent}', '{asset}'), **settings):
+    return {'pattern': pattern, 'target': list(target), **settings}
+
+
+def no_sidecars(name):
+    return None
+
+
+def test_conf_fb():
+    conf = load_rules(CONF_FB)
+    sidecars = {'FB-1-2-003.md5': 'd41d8cd98f00b204e9800998ecf8427e  FB-1-2-003.tif\n'}
+
+    target, info = conf.classify('FB-1-2-003.tif', '/src/Preservica_access/FB-1-2-003.tif',
+                                 sidecars.get)
+    assert target == [('FB-1-2', 'FB/1/2'), ('FB-1-2-003', 'FB/1/2/003')]
+    assert info.filename == 'FB-1-2-003.tif'
+    assert info.asset_id == 'FB/1/2/003'
+    assert info.is_access
+    assert (info.fixity_type, info.fixity) == ('MD5', 'd41d8cd98f00b204e9800998ecf8427e')
+
+    assert conf.classify('FB-1-2-003.md5', '/src/FB-1-2-003.md5', sidecars.get) == (None, None)
+    assert conf.classify('notes.txt', '/src/notes.txt', sidecars.get) == (None, None)
+
+
+def test_unreadable_toml(tmp_path):
+    path = tmp_path / 'rules.toml'
+    path.write_text('pattern = ')
+    with pytest.raises(ValueError, match='Unable to read rules'):
+        load_rules(str(path))
+
+
+def test_first_rule_wins():
+    conf = config(rule(r'(?P<asset>a+)', target=['first']),
+                  rule(r'(?P<asset>a+b)', target=['second']),
+                  rule(r'(?P<asset>b)', target=['third']))
+    assert conf.classify('aab', 'aab', no_sidecars)[0] == [('first', 'first')]
+    # The match starting first in the name wins over the rule listed first
+    assert conf.classify('ba', 'ba', no_sidecars)[0] == [('third', 'third')]
+
+
+def test_rules_have_their_own_groups():
+    conf = config(rule(r'(?P<asset>x(?P<n>\d))(?P=n)', target=['x{n}']),
+                  rule(r'(?P<asset>y(?P<n>\d))(?P=n)', target=['y{n}']))
+    assert conf.classify('y11', 'y11', no_sidecars)[0] == [('y1', 'y1')]
+    assert conf.classify('y12', 'y12', no_sidecars) == (None, None)
+
+
+def test_defaults_and_ids():
+    conf = config(rule(), rule(r'(?P<asset>(?P<parent>XX)_\d+)\.(?P<ext>\w+)$', ids={}),
+                  ids={'replace': {'-': '/'}}, access={'extensions': ['jpg']})
+
+    target, info = conf.classify('FB-1-002.jpg', 'FB-1-002.jpg', no_sidecars)
+    assert (info.asset_id, info.is_access) == ('FB/1/002', True)
+    target, info = conf.classify('XX_1.tif', 'XX_1.tif', no_sidecars)
+    assert (info.asset_id, info.is_access) == ('XX_1', False)
+
+
+@pytest.mark.parametrize('sidecar, extract, fixity', [
+    ('abc123\n', None, 'abc123'),
+    ('  \n', None, None),
+    (None, None, None),
+    ('d41d8cd98f00b204e9800998ecf8427e  file.tif\n', '[0-9a-f]{32}',
+     'd41d8cd98f00b204e9800998ecf8427e'),
+    ('nothing here', '[0-9a-f]{32}', None),
+])
+def test_sidecar(sidecar, extract, fixity):
+    fixity_settings = {'sidecar': '{asset}.md5', 'type': 'SHA-256'}
+    if extract:
+        fixity_settings['extract'] = extract
+    conf = config(rule(fixity=fixity_settings))
+
+    def read_sidecar(name):
+        assert name == 'FB-1-002.md5'
+        return sidecar
+
+    target, info = conf.classify('FB-1-002.tif', 'FB-1-002.tif', read_sidecar)
+    assert info.fixity == fixity
+    assert info.fixity_type == ('SHA-256' if fixity else None)
+
+
+@pytest.mark.parametrize('settings, message', [
+    ({}, 'has no .*rule'),
+    ({'rule': [{'target': ['x']}]}, 'Rule 0 has no pattern'),
+    ({'rule': [rule('(?P<asset>')]}, 'Rule 0 pattern is not a valid regex'),
+    ({'rule': [rule(r'(?P<id>\w+)')]}, r'Rule 0 pattern has no \(\?P<asset>'),
+    ({'rule': [rule(target=[])]}, 'Rule 0 has no target'),
+    ({'rule': [rule(), rule(target=['{folder}'])]}, "Rule 1 target '{folder}' uses folder"),
+    ({'rule': [rule(filename='{asset')]}, 'Rule 0 filename .* is not a valid template'),
+    ({'rule': [rule(fixity={'sidecar': '{id}.md5'})]}, 'Rule 0 sidecar .* uses id'),
+])
+def test_invalid(settings, message):
+    with pytest.raises(ValueError, match=message):
+        RuleConfig(settings)
+
+
+@pytest.mark.parametrize('pattern', [
+    r'(?P<asset>(\w)\w*)\1',
+    r'(?P<asset>\w+)-(\d+)-\2',
+    r'(?P<asset>(a)(b))\2\1',
+])
+def test_numeric_backreference(pattern):
+    with pytest.raises(ValueError, match=r'Rule 1 pattern has a numeric backreference'):
+        config(rule(), rule(pattern, target=['x']))
+
+
+@pytest.mark.parametrize('pattern', ['(?i)(?P<asset>fb-\\d+)', '(?ms)(?P<asset>fb-\\d+)$'])
+def test_global_flags(pattern):
+    with pytest.raises(ValueError, match=r'Rule 1 pattern sets global flags'):
+        config(rule(), rule(pattern, target=['x']))
+
+
+@pytest.mark.parametrize('pattern, name', [
+    (r'(?P<asset>\w+)\\1', 'a\\1'),      # an escaped backslash, then 1
+    (r'(?P<asset>\w+)[\1]', 'a\x01'),    # in a class, a character
+    (r'(?P<asset>\w+)\0', 'a\x00'),      # octal escapes
+    (r'(?P<asset>\w+)\101', 'aA'),
+    (r'(?i:(?P<asset>fb))', 'FB'),       # scoped flags
+    (r'[(?i)]?(?P<asset>\w+)', 'a'),     # in a class, just characters
+])
+def test_not_backreferences_or_flags(pattern, name):
+    conf = config(rule(), rule(pattern, target=['x']))
+    target, info = conf.classify(name, name, no_sidecars)
+    assert target == [('x', 'x')]
@@ -0,0 +1,35 @@
+from opex.upload_scheduler import UploadScheduler, MeteredClient, largest_first, sized
+
+
+class RetryingClient:
+    """Sends a file as boto3 does when it has to send a part again"""
+
+    def upload_file(self, filename, bucket, key, Callback=None, **kwargs):
+        for size in [100, 50, -50, 50, 100]:
+            Callback(size)
+
+
+def test_retried_bytes_are_taken_back():
+    scheduler = UploadScheduler(4, bytes_per_second=10**9)
+    spent = []
+    scheduler.bandwidth.spend = spent.append
+    progress = []
+    MeteredClient(RetryingClient(), scheduler).upload_file('f', 'bucket', 'key',
+                                                           Callback=progress.append)
+
+    assert progress == [100, 50, -50, 50, 100]
+    assert scheduler.sent == 250           # for good, for the progress
+    assert scheduler.window_bytes == 300   # all that went over the link
+    assert spent == [100, 50, 50, 100]     # nothing paid back to the cap
+
+
+def test_largest_first_within_a_wave():
+    sizes = {'a': 1, 'b': 30, 'c': 2, 'd': 5, 'e': 50}
+    plan = [['a', 'x/a.opex', ''], ['b', 'x/b.opex', ''],
+            ['c', 'x/c', ''], ['d', 'x/d', ''], ['e', 'x/e', '']]
+    scheduler = UploadScheduler(4)
+
+    order = [entry[0] for size, entry in largest_first(sized(plan, sizes.get, scheduler), 2)]
+
+    assert order == ['b', 'a', 'd', 'e', 'c']
+    assert (scheduler.total_files, scheduler.total_bytes, scheduler.totalled) == (5, 88, True)
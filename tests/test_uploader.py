@@ -0,0 +1,159 @@
+import os
+import hashlib
+import threading
+import pytest
+from boto3.s3.transfer import TransferConfig
+from bench.s3stub import StubS3Client, StubError
+from opex.uploader import Uploader
+from opex.upload_journal import UploadJournal, still_to_upload
+from opex.upload_plan import order_key, upload_wave, METADATA_WAVE, CONTENT_WAVE
+
+
+class RecordingClient(StubS3Client):
+    """A stub that notes when each upload starts and ends, and can fail some"""
+
+    def __init__(self, fail=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fail = set(fail)
+        self.events = []  # (event, key), in the order they happened
+        self.events_lock = threading.Lock()
+
+    def _event(self, event, key):
+        with self.events_lock:
+            self.events.append((event, key))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._event('start', Key)
+        try:
+            if Key in self.fail:
+                raise StubError('InternalError', "We encountered an internal error.")
+            return super().put_object(Bucket, Key, Body, **kwargs)
+        finally:
+            self._event('end', Key)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._event('multipart', Key)
+        return super().create_multipart_upload(Bucket, Key, **kwargs)
+
+
+def make_plan(tmp_path, folders=3, assets=4):
+    """A plan like to_opex's: an opex for each folder and file, and the files"""
+    entries = []
+    for folder in range(folders):
+        folder_name = f"folder{folder}"
+        for asset in range(assets):
+            source = tmp_path / f"{folder_name}-{asset}.tif"
+            source.write_bytes(bytes([asset]) * (1000 * (asset + 1)))
+            opex = tmp_path / f"{folder_name}-{asset}.tif.opex"
+            opex.write_bytes(b'<opex/>')
+            entries.append([str(source), f"{folder_name}/{asset}.tif", ''])
+            entries.append([str(opex), f"{folder_name}/{asset}.tif.opex", ''])
+        folder_opex = tmp_path / f"{folder_name}.opex"
+        folder_opex.write_bytes(b'<opex/>')
+        entries.append([str(folder_opex), f"{folder_name}/{folder_name}.opex", ''])
+    return sorted(entries, key=order_key)
+
+
+@pytest.mark.parametrize('checksum', [None, 'MD5', 'SHA-256'])
+def test_uploads_everything(tmp_path, checksum):
+    plan = make_plan(tmp_path)
+    client = RecordingClient()
+    failed = Uploader(client, 'bucket', workers=4, checksum=checksum).upload(plan)
+
+    assert failed == []
+    assert set(client.objects) == {target for source, target, fixities in plan}
+    assert not client.corrupted
+
+
+@pytest.mark.parametrize('lookahead', [0, 5])
+def test_opexes_land_before_content(tmp_path, lookahead):
+    plan = make_plan(tmp_path, folders=5)
+    client = RecordingClient(latency=0.002)
+    Uploader(client, 'bucket', workers=8, lookahead=lookahead).upload(plan)
+
+    opexes = {target for source, target, fixities in plan
+              if upload_wave(target) == METADATA_WAVE}
+    ended = set()
+    for event, key in client.events:
+        if event == 'end' and key in opexes:
+            ended.add(key)
+        elif event == 'start' and upload_wave(key) == CONTENT_WAVE:
+            assert ended == opexes, f"{key} started before every opex had landed"
+    assert ended == opexes
+
+
+def test_failed_opex_stops_the_run(tmp_path):
+    plan = make_plan(tmp_path)
+    client = RecordingClient(fail={'folder1/2.tif.opex'})
+    failed = Uploader(client, 'bucket', workers=4).upload(plan)
+
+    assert [target for source, target, fixities in failed] == ['folder1/2.tif.opex']
+    # The rest of its wave went, but none of the content
+    assert not any(upload_wave(key) == CONTENT_WAVE for event, key in client.events)
+    assert 'folder2/2.tif.opex' in client.objects
+
+
+def test_failed_content_is_returned(tmp_path):
+    plan = make_plan(tmp_path)
+    client = RecordingClient(fail={'folder0/1.tif', 'folder2/3.tif'})
+    failed = Uploader(client, 'bucket', workers=4).upload(plan)
+
+    assert sorted(target for source, target, fixities in failed) == ['folder0/1.tif',
+                                                                       'folder2/3.tif']
+    assert len(client.objects) == len(plan) - 2
+
+
+def test_plan_out_of_order(tmp_path):
+    plan = make_plan(tmp_path)
+    content = [entry for entry in plan if upload_wave(entry[1]) == CONTENT_WAVE]
+    metadata = [entry for entry in plan if upload_wave(entry[1]) == METADATA_WAVE]
+
+    with pytest.raises(ValueError, match='out of order'):
+        Uploader(RecordingClient(), 'bucket', workers=4).upload(content + metadata)
+
+
+def test_resume_with_a_source_gone(tmp_path):
+    plan = make_plan(tmp_path)
+    client = RecordingClient()
+    Uploader(client, 'bucket', workers=4).upload(plan)
+
+    gone = plan[-1]
+    os.remove(gone[0])
+    journal = UploadJournal(None, 'upload')  # that knows no ETags
+    still = list(still_to_upload(plan, journal, dict(client.objects)))
+    assert still == [gone]
+
+    failed = Uploader(client, 'bucket', workers=4).upload(still)
+    assert failed == [gone]
+
+
+@pytest.mark.parametrize('checksum', ['MD5', 'SHA-256'])
+def test_multipart_threshold(tmp_path, checksum):
+    plan = make_plan(tmp_path, folders=1)  # content of 1000 to 4000 bytes
+    client = RecordingClient()
+    config = TransferConfig(multipart_threshold=2500, multipart_chunksize=1500)
+    failed = Uploader(client, 'bucket', workers=4, transfer_config=config,
+                      checksum=checksum).upload(plan)
+
+    assert failed == []
+    assert sorted(key for event, key in client.events if event == 'multipart') == [
+        'folder0/2.tif', 'folder0/3.tif']
+
+
+@pytest.mark.parametrize('checksum', ['MD5', 'SHA-256'])
+@pytest.mark.parametrize('known', [False, True])
+def test_corrupted_puts_are_sent_again(tmp_path, checksum, known):
+    plan = make_plan(tmp_path)
+    if known:
+        for entry in plan:
+            with open(entry[0], 'rb') as f:
+                digest = hashlib.new(checksum.replace('-', ''), f.read()).hexdigest()
+            entry[2] = f"{checksum}:{digest}"
+    client = StubS3Client(corrupt=0.3, seed=1)
+    failed = Uploader(client, 'bucket', workers=4, checksum=checksum, retries=20).upload(plan)
+
+    assert failed == []
+    assert not client.corrupted
+    for source, target, fixities in plan:
+        with open(source, 'rb') as f:
+            assert client.objects[target][1] == hashlib.md5(f.read()).hexdigest()
@@ -2,4 +2,5 @@
 import opex.main
 import sys
 
-opex.main.main(sys.argv)
+if __name__ == '__main__':  # worker processes may import this
+    opex.main.main(sys.argv)